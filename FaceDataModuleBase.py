@@ -27,16 +27,18 @@ import pytorch_lightning as pl
 import torch
 from PIL import Image
 from skimage.io import imread, imsave
-from skvideo.io import FFmpegReader
 from torch.utils.data import DataLoader
 from torchvision.transforms import Resize, Compose, Normalize
 from tqdm import tqdm
 
 # from gdl.datasets.FaceVideoDataset import FaceVideoDataModule
 from gdl.datasets.IO import save_segmentation, save_segmentation_list
-from gdl.datasets.ImageDatasetHelpers import bbox2point, bbpoint_warp
+from gdl.datasets.DetectionStore import DetectionStore
+from gdl.datasets.ImageDatasetHelpers import bbox2point, bbpoint_warp, point2transform
 from gdl.datasets.UnsupervisedImageDataset import UnsupervisedImageDataset
 from gdl.utils.FaceDetector import FAN, MTCNN, save_landmark
+from gdl.utils.Instrumentation import timed
+from gdl.utils.other import is_skvideo_reader
 # try:
 #     from gdl.utils.TFabRecLandmarkDetector import TFabRec
 # except ImportError:
@@ -49,6 +51,30 @@ import pickle as pkl
 import types
 
 
+class StreamedList(object):
+    """
+    Pickles as a list of the items of items_fn(*args) (an iterator), which are written as they come instead of being 
+    collected into a list first. Unpickles as a plain list. I.e. the per-frame lists of a long video can be written 
+    straight from the DetectionStore: 
+        FaceDataModuleBase.save_landmark_list(fname, StreamedList(store.iter_field, "landmarks"))
+    """
+
+    def __init__(self, items_fn, *args):
+        self.items_fn = items_fn
+        self.args = args
+
+    def __reduce__(self):
+        return list, (), None, self.items_fn(*self.args)
+
+
+def _dump_unmemoized(obj, f):
+    pickler = pkl.Pickler(f)
+    # without the memo the pickler does not keep every pickled object alive (which would defeat StreamedList), 
+    # the detections and landmarks have no shared or recursive objects that the memo would be needed for
+    pickler.fast = True
+    pickler.dump(obj)
+
+
 class FaceDataModuleBase(pl.LightningDataModule):
     """
     A base data module for face datasets. This DM can be inherited by any face datasets, which just adapt things 
@@ -69,6 +95,11 @@ class FaceDataModuleBase(pl.LightningDataModule):
                  save_landmarks_one_file=False, # only use for large scale video datasets (that would produce too many files otherwise)
                  save_segmentation_frame_by_frame=True, # default
                  save_segmentation_one_file=False, # only use for large scale video datasets (that would produce too many files otherwise)
+                 face_detector_batch_size=1, # number of frames detected at once (>1 only supported by FAN, the others loop per frame)
+                 face_tracking=False, # if True, video frames between keyframes are tracked from the previous landmarks (FAN only)
+                 tracking_keyframe_interval=10, # the full face detector runs every n-th frame
+                 tracking_score_threshold=0.5, # re-detect if the mean landmark heatmap score of a tracked face drops below this
+                 tracking_iou_threshold=0.5, # re-detect if a tracked face's box overlaps its previous box less than this
                  ):
         super().__init__()
         self.root_dir = root_dir
@@ -97,9 +128,22 @@ class FaceDataModuleBase(pl.LightningDataModule):
 
         self.face_detector_type = face_detector
         self.face_detector_threshold = face_detector_threshold
+        self.face_detector_batch_size = face_detector_batch_size
+        if face_tracking and face_detector != 'fan':
+            raise ValueError("Face tracking is only supported with the 'fan' face detector, not '%s'" % face_detector)
+        self.face_tracking = face_tracking
+        self.tracking_keyframe_interval = tracking_keyframe_interval
+        self.tracking_score_threshold = tracking_score_threshold
+        self.tracking_iou_threshold = tracking_iou_threshold
+        self._reset_face_tracker()
 
         self.image_size = image_size
         self.scale = scale
+        # if set (gdl.datasets.DetectionStore), the detections are appended to it instead of checkpointing bboxes.pkl 
+        # and the landmarks go into it instead of a pickle per detection
+        self._detection_store = None
+        # the detections are saved every n-th frame
+        self._detection_checkpoint_frequency = 100
 
     def _get_max_faces_per_image(self): 
         return 1
@@ -131,10 +175,7 @@ class FaceDataModuleBase(pl.LightningDataModule):
         else:
             raise ValueError("Invalid face detector specifier '%s'" % self.face_detector)
 
-    # @profile
-    def _detect_faces_in_image(self, image_or_path, detected_faces=None):
-        # imagepath = self.imagepath_list[index]
-        # imagename = imagepath.split('/')[-1].split('.')[0]
+    def _read_image_for_detection(self, image_or_path):
         if isinstance(image_or_path, (str, Path)):
             image = np.array(imread(image_or_path))
         elif isinstance(image_or_path, np.ndarray):
@@ -146,13 +187,56 @@ class FaceDataModuleBase(pl.LightningDataModule):
             image = np.tile(image[:, :, None], (1, 1, 3))
         if len(image.shape) == 3 and image.shape[2] > 3:
             image = image[:, :, :3]
+        return image
 
-        h, w, _ = image.shape
+    @timed()
+    def _detect_faces_in_image(self, image_or_path, detected_faces=None):
+        # imagepath = self.imagepath_list[index]
+        # imagename = imagepath.split('/')[-1].split('.')[0]
+        image = self._read_image_for_detection(image_or_path)
+        self._instantiate_detector()
+        bounding_boxes, bbox_type, landmarks = self._run_detector(image, detected_faces)
+        return self._crop_detected_faces(image, bounding_boxes, bbox_type, landmarks)
+
+    @timed()
+    def _detect_faces_in_images(self, images_or_paths, detected_faces=None):
+        """
+        Batched version of _detect_faces_in_image. All the images are passed through the detector at once 
+        (which only makes a difference for detectors that implement run_batch, such as FAN) and then 
+        cropped one by one. The images must all have the same resolution (i.e. frames of one video). 
+        """
+        images = [self._read_image_for_detection(image_or_path) for image_or_path in images_or_paths]
         self._instantiate_detector()
-        bounding_boxes, bbox_type, landmarks = self.face_detector.run(image,
-                                                                      with_landmarks=True,
-                                                                      detected_faces=detected_faces)
+        detections = self._run_detector_batch(images, detected_faces)
+        return [self._crop_detected_faces(image, *detection) for image, detection in zip(images, detections)]
+
+    def _run_detector(self, image, detected_faces=None):
+        try:
+            return self.face_detector.run(image, with_landmarks=True, detected_faces=detected_faces)
+        except RuntimeError as e:
+            # like in _run_detector_batch, the cache is only flushed when the GPU actually runs out of memory
+            if 'out of memory' not in str(e):
+                raise e
+            torch.cuda.empty_cache()
+            return self.face_detector.run(image, with_landmarks=True, detected_faces=detected_faces)
+
+    def _run_detector_batch(self, images, detected_faces=None):
+        try:
+            return self.face_detector.run_batch(images, with_landmarks=True, detected_faces=detected_faces)
+        except RuntimeError as e:
+            # the cache is only flushed when the GPU actually runs out of memory, then the batch is split in halves
+            if 'out of memory' not in str(e) or len(images) == 1:
+                raise e
+            torch.cuda.empty_cache()
+            half = len(images) // 2
+            return self._run_detector_batch(images[:half], detected_faces[:half] if detected_faces is not None else None) \
+                + self._run_detector_batch(images[half:], detected_faces[half:] if detected_faces is not None else None)
+
+    def _crop_detected_faces(self, image, bounding_boxes, bbox_type, landmarks):
+        h, w, _ = image.shape
         image = image / 255.
+        # the landmarks are tracked from and stored in float32, so a resumed tracking continues from the same values
+        landmarks = [np.asarray(lmk, dtype=np.float32) for lmk in landmarks] if landmarks is not None else landmarks
         detection_images = []
         detection_centers = []
         detection_sizes = []
@@ -200,41 +284,206 @@ class FaceDataModuleBase(pl.LightningDataModule):
         del image
         return detection_images, detection_centers, detection_sizes, bbox_type, detection_landmarks, original_landmarks
 
-    # @profile
-    def _detect_faces_in_image_wrapper(self, frame_list, fid, out_detection_folder, out_landmark_folder, bb_outfile,
-                                       centers_all, sizes_all, detection_fnames_all, landmark_fnames_all, 
-                                       out_landmarks_all=None, out_landmarks_orig_all=None, out_bbox_type_all=None):
+    def _reset_face_tracker(self):
+        self._tracked_landmarks = None
+        self._frames_since_keyframe = 0
+
+    def _track_faces_in_image(self, image_or_path):
+        """
+        Tracking version of _detect_faces_in_image for consecutive video frames. The full face detector only runs on 
+        keyframes (every tracking_keyframe_interval frames), when nothing is being tracked or when the tracking 
+        becomes unreliable. On the other frames, the faces are cropped around the previous frame's landmarks and 
+        only the landmark network is run. Faces that enter the frame between keyframes are picked up at the next keyframe. 
+        Returns the output of _detect_faces_in_image and either 'detection' or 'tracking'.
+        """
+        image = self._read_image_for_detection(image_or_path)
+        self._instantiate_detector()
+        tracked = None
+        if self._tracked_landmarks is not None and len(self._tracked_landmarks) > 0 \
+            and self._frames_since_keyframe < self.tracking_keyframe_interval:
+            tracked = self._track_landmarks(image, self._tracked_landmarks)
+
+        if tracked is None:
+            detection_result = self._detect_faces_in_image(image)
+            source = 'detection'
+            self._frames_since_keyframe = 1
+        else: 
+            bounding_boxes, bbox_type, landmarks = tracked
+            detection_result = self._crop_detected_faces(image, bounding_boxes, bbox_type, landmarks)
+            source = 'tracking'
+            self._frames_since_keyframe += 1
+        self._tracked_landmarks = detection_result[5]
+        return detection_result, source
+
+    @torch.no_grad()
+    def _track_landmarks(self, image, previous_landmarks):
+        """
+        Runs the landmark network on crops predicted from the previous landmarks. 
+        Returns (bounding_boxes, bbox_type, landmarks) like FaceDetector.run or None if any of the faces 
+        should be re-detected.
+        """
+        crop_size = self.face_detector.optimal_landmark_detector_im_size()
+        crops = []
+        tforms = []
+        previous_boxes = []
+        for lmk in previous_landmarks:
+            left, top = np.min(lmk[:, :2], axis=0)
+            right, bottom = np.max(lmk[:, :2], axis=0)
+            old_size, center = bbox2point(left, right, top, bottom, type='kpt68')
+            # the landmark network expects the whole head in the crop (like the detector's boxes give it), 
+            # the landmark box only spans the face 
+            size = old_size * 2.
+            crops += [bbpoint_warp(image / 255., center, size, crop_size, order=1)]
+            tforms += [point2transform(center, size, crop_size, crop_size)]
+            previous_boxes += [[left, top, right, bottom]]
+
+        crops = torch.from_numpy(np.stack(crops).transpose(0, 3, 1, 2)).to(self.device, dtype=torch.float32)
+        pts, scores = self.face_detector.landmarks_from_batch_no_face_detection(crops)
+        del crops
+
+        bounding_boxes = []
+        landmarks = []
+        for i in range(len(tforms)):
+            if np.mean(scores[i]) < self.tracking_score_threshold:
+                return None
+            lmk = tforms[i].inverse(pts[i] * crop_size).astype(np.float32)
+            left, top = np.min(lmk, axis=0)
+            right, bottom = np.max(lmk, axis=0)
+            bbox = [left, top, right, bottom]
+            if FaceDataModuleBase._bbox_iou(bbox, previous_boxes[i]) < self.tracking_iou_threshold:
+                return None
+            bounding_boxes += [bbox]
+            landmarks += [lmk]
+        return bounding_boxes, self.face_detector.landmark_type(), landmarks
 
-        if isinstance(frame_list, (str, Path, list)):\
+    @staticmethod
+    def _bbox_iou(bbox1, bbox2):
+        left = max(bbox1[0], bbox2[0])
+        top = max(bbox1[1], bbox2[1])
+        right = min(bbox1[2], bbox2[2])
+        bottom = min(bbox1[3], bbox2[3])
+        intersection = max(right - left, 0) * max(bottom - top, 0)
+        area1 = (bbox1[2] - bbox1[0]) * (bbox1[3] - bbox1[1])
+        area2 = (bbox2[2] - bbox2[0]) * (bbox2[3] - bbox2[1])
+        union = area1 + area2 - intersection
+        if union <= 0:
+            return 0.
+        return intersection / union
+
+    def _get_frame_for_detection(self, frame_list, fid):
+        if isinstance(frame_list, (str, Path, list)):
             # if frame list is a list of image paths
             frame_fname = frame_list[fid]
-            # detect faces in each frames
-            detection_ims, centers, sizes, bbox_type, landmarks, orig_landmarks = self._detect_faces_in_image(Path(self.output_dir) / frame_fname)
+            frame = Path(self.output_dir) / frame_fname
         elif isinstance(frame_list, (np.ndarray, types.GeneratorType)): 
             # frame_list is an array of many images, or a generator (like a video reader)
-            frame_fname =Path(f"{fid:05d}.png")
+            frame_fname = Path(f"{fid:05d}.png")
             if isinstance(frame_list, np.ndarray):
                 frame = frame_list[fid]
             else:   
                 frame = next(frame_list)
-            detection_ims, centers, sizes, bbox_type, landmarks, orig_landmarks = self._detect_faces_in_image(frame)
-            # if len(detection_ims) > 0: # debug visualization
-            #     imsave(frame_fname, detection_ims[0])
-        
+        return frame, frame_fname
+
+    # @profile
+    def _detect_faces_in_image_wrapper(self, frame_list, fid, out_detection_folder, out_landmark_folder, bb_outfile,
+                                       centers_all, sizes_all, detection_fnames_all, landmark_fnames_all, 
+                                       out_landmarks_all=None, out_landmarks_orig_all=None, out_bbox_type_all=None, 
+                                       out_detection_ims_all=None, out_detection_sources_all=None):
+        frame, frame_fname = self._get_frame_for_detection(frame_list, fid)
+        # detect faces in each frames
+        source = 'detection'
+        if self.face_tracking:
+            detection_result, source = self._track_faces_in_image(frame)
+            if out_detection_sources_all is not None:
+                out_detection_sources_all += [source]
+        else:
+            detection_result = self._detect_faces_in_image(frame)
+        # if len(detection_ims) > 0: # debug visualization
+        #     imsave(frame_fname, detection_ims[0])
+
         # self.detection_lists[sequence_id][fid] += [detections]
         # import plotly.graph_objects as go
         # fig = go.Figure(data=go.Image(z=frame,))
         # fig.show()
 
+        self._save_frame_detections(fid, frame_fname, detection_result, out_detection_folder, out_landmark_folder, bb_outfile,
+                                    centers_all, sizes_all, detection_fnames_all, landmark_fnames_all, 
+                                    out_landmarks_all, out_landmarks_orig_all, out_bbox_type_all, out_detection_ims_all, 
+                                    source=source)
+        if fid % self._detection_checkpoint_frequency == 0:
+            self._checkpoint_detections(fid, bb_outfile, centers_all, sizes_all, detection_fnames_all, landmark_fnames_all)
+
+    # @profile
+    def _detect_faces_in_images_wrapper(self, frame_list, fids, out_detection_folder, out_landmark_folder, bb_outfile,
+                                       centers_all, sizes_all, detection_fnames_all, landmark_fnames_all, 
+                                       out_landmarks_all=None, out_landmarks_orig_all=None, out_bbox_type_all=None, 
+                                       out_detection_ims_all=None):
+        """
+        Batched version of _detect_faces_in_image_wrapper. Detects faces in frames fids at once. 
+        Returns the list of frame ids that were actually processed (a video reader may run out of frames 
+        before the end of the batch).
+        """
+        frames = []
+        frame_fnames = []
+        processed_fids = []
+        for fid in fids:
+            try:
+                frame, frame_fname = self._get_frame_for_detection(frame_list, fid)
+            except StopIteration:
+                break
+            frames += [frame]
+            frame_fnames += [frame_fname]
+            processed_fids += [fid]
+        if len(frames) == 0:
+            return processed_fids
+
+        detection_results = self._detect_faces_in_images(frames)
+        for fid, frame_fname, detection_result in zip(processed_fids, frame_fnames, detection_results):
+            self._save_frame_detections(fid, frame_fname, detection_result, out_detection_folder, out_landmark_folder, bb_outfile,
+                                        centers_all, sizes_all, detection_fnames_all, landmark_fnames_all, 
+                                        out_landmarks_all, out_landmarks_orig_all, out_bbox_type_all, out_detection_ims_all)
+        # checkpoints only fall on the ends of batches, so a resumed detection batches the remaining frames the same way
+        if any(fid % self._detection_checkpoint_frequency == 0 for fid in processed_fids):
+            self._checkpoint_detections(processed_fids[-1], bb_outfile, centers_all, sizes_all, 
+                                        detection_fnames_all, landmark_fnames_all)
+        return processed_fids
+
+    def _detect_faces_in_frames_batched(self, frame_list, start_fid, end_fid, *args, **kwargs):
+        """
+        Runs the batched detection wrapper over frames [start_fid, end_fid) in chunks of self.face_detector_batch_size. 
+        Returns the id of the last processed frame.
+        """
+        fid = start_fid - 1
+        batch_size = self.face_detector_batch_size
+        for batch_start in tqdm(range(start_fid, end_fid, batch_size)):
+            fids = list(range(batch_start, min(batch_start + batch_size, end_fid)))
+            processed_fids = self._detect_faces_in_images_wrapper(frame_list, fids, *args, **kwargs)
+            if len(processed_fids) > 0:
+                fid = processed_fids[-1]
+            if len(processed_fids) < len(fids):
+                break
+        return fid
+
+    @timed()
+    def _save_frame_detections(self, fid, frame_fname, detection_result, out_detection_folder, out_landmark_folder, bb_outfile,
+                               centers_all, sizes_all, detection_fnames_all, landmark_fnames_all, 
+                               out_landmarks_all=None, out_landmarks_orig_all=None, out_bbox_type_all=None, 
+                               out_detection_ims_all=None, source='detection'):
+        detection_ims, centers, sizes, bbox_type, landmarks, orig_landmarks = detection_result
         
-        centers_all += [centers]
-        sizes_all += [sizes]
+        # the lists are None if the detections only go into the detection store
+        if centers_all is not None:
+            centers_all += [centers]
+            sizes_all += [sizes]
         if out_landmarks_all is not None:
             out_landmarks_all += [landmarks]
         if out_landmarks_orig_all is not None:
             out_landmarks_orig_all += [orig_landmarks]
         if out_bbox_type_all is not None:
             out_bbox_type_all += [[bbox_type]*len(landmarks)]
+        if out_detection_ims_all is not None:
+            # the detections are kept in memory (and not necessarily written to disk)
+            out_detection_ims_all += [detection_ims]
 
         # save detections
         detection_fnames = []
@@ -242,15 +491,18 @@ class FaceDataModuleBase(pl.LightningDataModule):
         for di, detection in enumerate(detection_ims):
             # save detection
             stem = frame_fname.stem + "_%.03d" % di
+            out_detection_fname = out_detection_folder / (stem + self.processed_ext)
             if self.save_detection_images:
-                out_detection_fname = out_detection_folder / (stem + self.processed_ext)
                 detection_fnames += [out_detection_fname.relative_to(self.output_dir)]
                 if self.processed_ext in ['.JPG', '.jpg', ".jpeg", ".JPEG"]:
                     imsave(out_detection_fname, detection, quality=100)
                 else:
                     imsave(out_detection_fname, detection)
-            # save landmarks
-            if self.save_landmarks_frame_by_frame:
+            elif out_detection_ims_all is not None:
+                # the detection only lives in memory but it still gets a name so that it can be identified later
+                detection_fnames += [out_detection_fname.relative_to(self.output_dir)]
+            # save landmarks (unless they go into the detection store)
+            if self.save_landmarks_frame_by_frame and self._detection_store is None:
                 if self.save_detection_images:
                     out_landmark_fname = out_landmark_folder / (stem + ".pkl")
                     landmark_fnames += [out_landmark_fname.relative_to(self.output_dir)]
@@ -260,12 +512,25 @@ class FaceDataModuleBase(pl.LightningDataModule):
                     landmark_fnames += [out_landmark_fname.relative_to(self.output_dir)]
                     save_landmark(out_landmark_fname, orig_landmarks[di], bbox_type)
 
-        detection_fnames_all += [detection_fnames]
-        landmark_fnames_all += [landmark_fnames]
-
-        torch.cuda.empty_cache()
-        checkpoint_frequency = 100
-        if fid % checkpoint_frequency == 0:
+        if detection_fnames_all is not None:
+            detection_fnames_all += [detection_fnames]
+            landmark_fnames_all += [landmark_fnames]
+
+        if self._detection_store is not None:
+            self._detection_store.append_frame(fid, frame_fname.stem, centers, sizes, landmarks, orig_landmarks, bbox_type, 
+                                               source, crops=detection_ims)
+
+    def _checkpoint_detections(self, fid, bb_outfile, centers_all, sizes_all, detection_fnames_all, landmark_fnames_all):
+        """
+        Saves the detections of all the frames up to fid (included), the detection can be resumed from here.
+        """
+        if self._detection_store is not None:
+            # only the new detections are written, together with the state of the tracker after frame fid
+            state = {}
+            if self.face_tracking:
+                state["frames_since_keyframe"] = self._frames_since_keyframe
+            self._detection_store.commit(fid, **state)
+        else:
             FaceDataModuleBase.save_detections(bb_outfile, detection_fnames_all, landmark_fnames_all,
                                                 centers_all, sizes_all, fid)
 
@@ -300,7 +565,7 @@ class FaceDataModuleBase(pl.LightningDataModule):
 
         if isinstance(detection_fnames_or_ims, types.GeneratorType): 
             im_read = "skvreader"
-        elif isinstance(detection_fnames_or_ims, (FFmpegReader)):
+        elif is_skvideo_reader(detection_fnames_or_ims):
             im_read = "skvffmpeg"
         else:
             im_read = 'pil' if not isinstance(detection_fnames_or_ims[0], np.ndarray) else None
@@ -448,7 +713,7 @@ class FaceDataModuleBase(pl.LightningDataModule):
     @staticmethod
     def save_landmark_list(fname, landmarks):
         with open(fname, "wb" ) as f:
-            pkl.dump(landmarks, f)
+            _dump_unmemoized(landmarks, f)
 
     @staticmethod
     def load_landmark_list(fname):
@@ -476,14 +741,18 @@ class FaceDataModuleBase(pl.LightningDataModule):
     @staticmethod
     def save_detections(fname, detection_fnames, landmark_fnames, centers, sizes, last_frame_id):
         with open(fname, "wb" ) as f:
-            pkl.dump(detection_fnames, f)
-            pkl.dump(centers, f)
-            pkl.dump(sizes, f)
-            pkl.dump(last_frame_id, f)
-            pkl.dump(landmark_fnames, f)
+            _dump_unmemoized(detection_fnames, f)
+            _dump_unmemoized(centers, f)
+            _dump_unmemoized(sizes, f)
+            _dump_unmemoized(last_frame_id, f)
+            _dump_unmemoized(landmark_fnames, f)
 
     @staticmethod
     def load_detections(fname):
+        # the detection store next to bboxes.pkl takes precedence (bboxes.pkl is only written at the end of the detection)
+        store_path = DetectionStore.path_for(fname)
+        if DetectionStore.exists(store_path):
+            return DetectionStore(store_path).to_lists()
         with open(fname, "rb" ) as f:
             detection_fnames = pkl.load(f)
             centers = pkl.load(f)
@@ -2,7 +2,7 @@ from abc import abstractmethod, ABC
 import numpy as np
 import torch
 import pickle as pkl
-from face_alignment.utils import flip, get_preds_fromhm
+from face_alignment.utils import flip, get_preds_fromhm, crop
 # from memory_profiler import profile
 
 
@@ -43,6 +43,20 @@ class FaceDetector(ABC):
     def __call__(self, *args, **kwargs):
         self.run(*args, **kwargs)
 
+    def run_batch(self, images, with_landmarks=False, detected_faces=None):
+        """
+        Runs the detector on a batch of images. Detectors that support batched inference should override this. 
+        Input: 
+            images: a list of images (or an array of shape (N, H, W, 3)), 0-255, uint8, rgb
+            detected_faces: an optional list of per-image bounding boxes
+        Returns: 
+            a list with the output of run() for each of the images
+        """
+        if detected_faces is None:
+            detected_faces = [None] * len(images)
+        return [self.run(images[i], with_landmarks=with_landmarks, detected_faces=detected_faces[i]) 
+                for i in range(len(images))]
+
 
     def landmarks_from_batch_no_face_detection(self, images): 
         """
@@ -94,7 +108,58 @@ class FAN(FaceDetector):
         return: detected box list
         '''
         out = self.model.get_landmarks(image, detected_faces=detected_faces)
-        torch.cuda.empty_cache()
+        return self._landmarks_to_boxes(out, with_landmarks)
+
+    @torch.no_grad()
+    def run_batch(self, images, with_landmarks=False, detected_faces=None):
+        '''
+        images: list of images of the same resolution (or an array [N, h, w, 3]), 0-255, uint8, rgb
+        detected_faces: optional list of per-image bounding boxes, if provided the face detector is not run
+        return: list with the output of run() for each image
+        
+        The face detector runs on the whole batch at once and so does the landmark network (on all the faces 
+        found in the batch). The CUDA cache is not flushed here, that is up to the caller.
+        '''
+        if detected_faces is None:
+            image_batch = torch.from_numpy(np.stack(images).transpose(0, 3, 1, 2).copy())
+            image_batch = image_batch.to(self.model.device, dtype=torch.float32)
+            detected_faces = self.model.face_detector.detect_from_batch(image_batch)
+            del image_batch
+
+        # this follows FaceAlignment.get_landmarks_from_image but crops all the faces in the batch at once
+        reference_scale = getattr(self.model.face_detector, 'reference_scale', 195.)
+        crops = []
+        centers = []
+        scales = []
+        image_indices = []
+        for i, faces in enumerate(detected_faces):
+            if faces is None:
+                continue
+            for d in faces:
+                center = np.array([d[2] - (d[2] - d[0]) / 2.0, d[3] - (d[3] - d[1]) / 2.0])
+                center[1] = center[1] - (d[3] - d[1]) * 0.12
+                scale = (d[2] - d[0] + d[3] - d[1]) / reference_scale
+                crops += [crop(images[i], center, scale)]
+                centers += [center]
+                scales += [scale]
+                image_indices += [i]
+
+        landmarks = [[] for _ in range(len(images))]
+        if len(crops) > 0:
+            inp = torch.from_numpy(np.stack(crops).transpose(0, 3, 1, 2).copy())
+            inp = inp.to(self.model.device, dtype=getattr(self.model, 'dtype', torch.float32)).div_(255.0)
+            out = self.model.face_alignment_net(inp).detach()
+            if self.flip_input:
+                out += flip(self.model.face_alignment_net(flip(inp)).detach(), is_label=True)
+            out = out.to(device='cpu', dtype=torch.float32).numpy()
+            del inp
+            for j in range(out.shape[0]):
+                _, pts_img, _ = get_preds_fromhm(out[j:j+1], centers[j], scales[j])
+                landmarks[image_indices[j]] += [np.asarray(pts_img).reshape(68, 2)]
+
+        return [self._landmarks_to_boxes(lmks if len(lmks) > 0 else None, with_landmarks) for lmks in landmarks]
+
+    def _landmarks_to_boxes(self, out, with_landmarks):
         if out is None:
             del out
             if with_landmarks:
@@ -15,6 +15,8 @@ from pytorch3d.structures import Meshes
 from pytorch3d.io import load_obj
 from pytorch3d.renderer.mesh import rasterize_meshes
 import gdl.utils.DecaUtils as util
+from gdl.utils.AssetBundle import load_assets
+from gdl.utils.Instrumentation import timed
 #import traceback # Walt added to figure out WTF is going on
 #from pytorch3d.renderer import MeshRasterizer # Walt added this
 #from pytorch3d.renderer import PerspectiveCamera # Walt added this
@@ -140,7 +142,10 @@ class Pytorch3dRasterizer(nn.Module):
         raster_settings = util.dict2obj(raster_settings)
         self.raster_settings = raster_settings
 
-    def forward(self, vertices, faces, attributes=None):
+    def rasterize(self, vertices, faces):
+        '''
+        returns the fragments of the rasterization: pix_to_face (N,H,W,K), bary_coords (N,H,W,K,3)
+        '''
         fixed_vertices = vertices.clone()
         fixed_vertices[..., :2] = -fixed_vertices[..., :2]
         meshes_screen = Meshes(verts=fixed_vertices.float(), faces=faces.long())
@@ -178,6 +183,10 @@ class Pytorch3dRasterizer(nn.Module):
             max_faces_per_bin=raster_settings.max_faces_per_bin,
             perspective_correct=raster_settings.perspective_correct,
         )
+        return pix_to_face, bary_coords
+
+    def forward(self, vertices, faces, attributes=None):
+        pix_to_face, bary_coords = self.rasterize(vertices, faces)
 
         # pix_to_face(N,H,W,K), bary_coords(N,H,W,K,3),attribute: (N, nf, 3, D)
         # pixel_vals = interpolate_face_attributes(fragment, attributes.view(attributes.shape[0]*attributes.shape[1], 3, attributes.shape[-1]))
@@ -198,8 +207,22 @@ class Pytorch3dRasterizer(nn.Module):
         return pixel_vals
 
 
+def load_topology_assets(obj_filename, uv_size):
+    """
+    Parses the topology mesh (faces, UV coordinates and UV faces) and triangulates the dense UV grid.
+    These are the arrays SRenderY stores in the asset bundle.
+    """
+    verts, faces, aux = load_obj(obj_filename)
+    return {
+        'raw_uvcoords': aux.verts_uvs[None, ...].numpy(),  # (N, V, 2)
+        'uvfaces': faces.textures_idx[None, ...].numpy(),  # (N, F, 3)
+        'faces': faces.verts_idx[None, ...].numpy(),
+        'dense_faces': util.generate_triangles(uv_size, uv_size).astype(np.int64)[None, :, :],
+    }
+
+
 class SRenderY(nn.Module):
-    def __init__(self, image_size, obj_filename, uv_size=256):
+    def __init__(self, image_size, obj_filename, uv_size=256, asset_bundle=None):
         super(SRenderY, self).__init__()
         self.image_size = image_size
         self.uv_size = uv_size
@@ -207,18 +230,21 @@ class SRenderY(nn.Module):
         uvRes = uv_size
 
         # Load face OBJ verts, faces and UVs
-        verts, faces, aux = load_obj(obj_filename)
-        uvcoords = aux.verts_uvs[None, ...]  # (N, V, 2)
-        uvfaces = faces.textures_idx[None, ...]  # (N, F, 3)
-        faces = faces.verts_idx[None, ...]
+        topology = load_assets(asset_bundle, "topology", {"uv_size": uvRes}, [obj_filename],
+                               lambda: load_topology_assets(obj_filename, uvRes))
+        uvcoords = torch.from_numpy(topology['raw_uvcoords'])  # (N, V, 2)
+        uvfaces = torch.from_numpy(topology['uvfaces'])  # (N, F, 3)
+        faces = torch.from_numpy(topology['faces'])
 
         # Walt changed these so we can override them independent from the model cfg.yaml
         self.rasterizer = Pytorch3dRasterizer(renderRes)
         self.uv_rasterizer = Pytorch3dRasterizer(uvRes)
+        self._uv_fragments = {} # cache of the uv space rasterization, see _get_uv_fragments
+        # Walt's render_shape returns the uv coordinates and ignores the detail normals
+        self.render_shape_uses_detail_normals = False
 
         # faces
-        dense_triangles = util.generate_triangles(uvRes, uvRes)
-        self.register_buffer('dense_faces', torch.from_numpy(dense_triangles).long()[None, :, :])
+        self.register_buffer('dense_faces', torch.from_numpy(topology['dense_faces']))
         self.register_buffer('faces', faces)
         self.register_buffer('raw_uvcoords', uvcoords)
 
@@ -250,6 +276,7 @@ class SRenderY(nn.Module):
         #torch.ones(3, dtype=torch.float32) * scale
         self.register_buffer('constant_factor', torch.ones(9)) # Walt added this to save some computation time
 
+    @timed()
     def forward(self, vertices, transformed_vertices, albedos, lights=None, light_type='point'):
         '''
         -- Texture Rendering
@@ -350,6 +377,20 @@ class SRenderY(nn.Module):
 
         return outputs
 
+    def render_uv_grid(self, transformed_vertices):
+        '''
+        -- only the uv lookup grid of forward(), without texturing and shading
+        transformed_vertices: [batch_size, V, 3], rnage:[-1,1], projected vertices, in image space, for rasterization
+        grid: [batch_size, h, w, 2]
+        '''
+        batch_size = transformed_vertices.shape[0]
+        ## rasterizer near 0 far 100. move mesh so minz larger than 0
+        transformed_vertices[:, :, 2] = transformed_vertices[:, :, 2] + 10
+        rendering = self.rasterizer(transformed_vertices, self.faces.expand(batch_size, -1, -1),
+                                    self.face_uvcoords.expand(batch_size, -1, -1, -1))
+        grid = rendering[:, :3, :, :].permute(0, 2, 3, 1)[:, :, :, :2]
+        return grid
+
     def add_SHlight(self, normal_images, sh_coeff):
         '''
             sh_coeff: [bz, 9, 3]
@@ -396,6 +437,7 @@ class SRenderY(nn.Module):
         shading = normals_dot_lights[:, :, :, None] * light_intensities[:, :, None, :]
         return shading.mean(1)
 
+    @timed()
     def render_shape(self, vertices, transformed_vertices, images=None, detail_normal_images=None, lights=None):
         '''
         -- rendering shape with detail normal map
@@ -514,6 +556,7 @@ class SRenderY(nn.Module):
         normal_images = rendering[:, :3, :, :]
         return normal_images
 
+    @timed()
     def world2uv(self, vertices):
         '''
         project vertices from world space to uv space
@@ -522,6 +565,25 @@ class SRenderY(nn.Module):
         '''
         batch_size = vertices.shape[0]
         face_vertices = util.face_vertices(vertices, self.faces.expand(batch_size, -1, -1))
-        uv_vertices = self.uv_rasterizer(self.uvcoords.expand(batch_size, -1, -1),
-                                         self.uvfaces.expand(batch_size, -1, -1), face_vertices)[:, :3]
+        # the uv layout does not change, so the rasterization is only done once and then only interpolated
+        pix_to_face, bary_coords, vismask = self._get_uv_fragments()
+        pixel_face_vals = face_vertices[:, pix_to_face] # [bz, h, w, 3, 3]
+        uv_vertices = (bary_coords[None, ..., None] * pixel_face_vals).sum(dim=-2) * vismask[None, ..., None]
+        uv_vertices = uv_vertices.permute(0, 3, 1, 2)
         return uv_vertices
+
+    def _get_uv_fragments(self):
+        '''
+        rasterization of the uv layout, computed once per (uv_size, device)
+        pix_to_face: [h, w], bary_coords: [h, w, 3], vismask: [h, w]
+        '''
+        key = (self.uv_rasterizer.raster_settings.image_size, self.uvcoords.device)
+        if key not in self._uv_fragments:
+            with torch.no_grad():
+                pix_to_face, bary_coords = self.uv_rasterizer.rasterize(self.uvcoords[:1], self.uvfaces[:1])
+            pix_to_face = pix_to_face[0, :, :, 0]
+            bary_coords = bary_coords[0, :, :, 0]
+            vismask = (pix_to_face > -1).float()
+            pix_to_face = pix_to_face.clamp(min=0)
+            self._uv_fragments[key] = (pix_to_face, bary_coords, vismask)
+        return self._uv_fragments[key]
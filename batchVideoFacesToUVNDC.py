@@ -0,0 +1,196 @@
+from gdl_apps.EMOCA.utils.load import load_model
+from gdl.utils.AsyncWriter import AsyncWriter
+from gdl.utils.CodeStore import CodeStore
+import gdl.utils.Instrumentation as instrumentation
+from videoFacesToUVNDC import prepare_video, export_video, add_reconstruction_args, get_code_store_path
+import argparse
+import glob
+import json
+import os, shutil
+import queue
+import threading
+import time
+import traceback
+from datetime import timedelta
+from pathlib import Path
+
+
+PROGRESS_FILE = "batch_progress.json"
+
+
+def format_time(seconds):
+    return str(timedelta(seconds=seconds)).split(".")[0]
+
+
+def expand_video_list(inputs):
+    """
+    Expands the given files, folders and glob patterns into a sorted list of videos (without duplicates).
+    """
+    videos = []
+    for item in inputs:
+        if os.path.isdir(item):
+            matches = sorted(glob.glob(os.path.join(item, "*.mov")) + glob.glob(os.path.join(item, "*.mp4")))
+        else:
+            matches = sorted(glob.glob(item)) or [item]
+        for video in matches:
+            video = str(Path(video).absolute())
+            if video not in videos:
+                videos += [video]
+    return videos
+
+
+def load_progress(progress_path):
+    if os.path.isfile(progress_path):
+        with open(progress_path, "r") as f:
+            progress = json.load(f)
+    else:
+        progress = {}
+    progress.setdefault("done", {})
+    progress.setdefault("failed", {})
+    return progress
+
+
+def save_progress(progress_path, progress):
+    # written to a temporary file first, an interrupted run never leaves a corrupted progress file behind
+    tmp_path = progress_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(progress, f, indent=2)
+    os.replace(tmp_path, progress_path)
+
+
+def _prepare_videos(videos, tmp_root, args, prepared, stop):
+    """
+    Runs the frame extraction and face detection of the videos one after another and hands them over through
+    the prepared queue. The face detector of the first video is reused for all the following ones.
+    """
+    face_detector = None
+    for vi, video in enumerate(videos):
+        if stop.is_set():
+            break
+        start = time.time()
+        tmp_output_folder = str(Path(tmp_root) / ("%03d_%s" % (vi, Path(video).stem)))
+        try:
+            dm = prepare_video(video, tmp_output_folder, args, face_detector=face_detector)
+            face_detector = getattr(dm, "face_detector", face_detector)
+            prepared.put((video, tmp_output_folder, dm, time.time() - start, None))
+        except Exception:
+            prepared.put((video, tmp_output_folder, None, time.time() - start, traceback.format_exc()))
+    prepared.put(None)
+
+
+def reconstruct_videos(args):
+    start_time = time.time()
+    outputPath = args.tmp_output_folder
+    Path(outputPath).mkdir(parents=True, exist_ok=True)
+    if args.profile:
+        # the spans of the detection thread and of the model add up over all the videos
+        instrumentation.enable(cuda_events=args.profile_cuda)
+    progress_path = os.path.join(outputPath, PROGRESS_FILE)
+    progress = load_progress(progress_path) if not args.restart else {"done": {}, "failed": {}}
+
+    videos = expand_video_list(args.input_videos)
+    pending = [video for video in videos if video not in progress["done"]]
+    print(f"{len(videos)} video(s) selected, {len(videos) - len(pending)} already done, {len(pending)} to process.")
+    if len(pending) == 0:
+        return progress
+
+    # the decoding and detection of the next videos runs in the background while EMOCA works on the current one,
+    # the queue bounds how many processed videos (and their in-memory detections) can wait for the model
+    prepared = queue.Queue(maxsize=max(args.prefetch_videos, 1))
+    stop = threading.Event()
+    preparer = threading.Thread(target=_prepare_videos, args=(pending, args.tmp_folder, args, prepared, stop), daemon=True)
+    preparer.start()
+
+    # the model is only loaded once for all the videos (in parallel with the detection of the first one)
+    with instrumentation.span("load_model"):
+        emoca, conf = load_model(args.path_to_models, args.model_name, args.mode)
+        emoca.cuda()
+        emoca.eval()
+        emoca.set_inference_precision(args.precision, args.channels_last)
+
+    writer = AsyncWriter(num_workers=args.num_writers) if args.num_writers > 0 else None
+    try:
+        while True:
+            item = prepared.get()
+            if item is None:
+                break
+            video, tmp_output_folder, dm, prepare_time, error = item
+            reconstruct_time = 0.
+            if error is None:
+                start = time.time()
+                code_store = CodeStore(get_code_store_path(outputPath, video), mode='w') if args.save_codes else None
+                try:
+                    destPath = export_video(emoca, dm, video, tmp_output_folder, outputPath, args, writer=writer, 
+                        code_store=code_store)
+                except Exception:
+                    error = traceback.format_exc()
+                    if writer is not None:
+                        # the writes of the failed video must be done before its folder is removed and must not 
+                        # fail the next video
+                        try:
+                            writer.flush()
+                        except Exception:
+                            error += "\nWriting the outputs failed as well:\n" + traceback.format_exc()
+                if code_store is not None:
+                    code_store.close()
+                reconstruct_time = time.time() - start
+            del dm
+
+            if error is None:
+                progress["done"][video] = {
+                    "output": str(destPath),
+                    "detection_time": prepare_time,
+                    "reconstruction_time": reconstruct_time,
+                }
+                progress["failed"].pop(video, None)
+                print(f"Done {video} (detection {format_time(prepare_time)}, reconstruction {format_time(reconstruct_time)})")
+            else:
+                progress["failed"][video] = {"error": error}
+                print(f"Failed {video}:\n{error}")
+            save_progress(progress_path, progress)
+
+            if not args.keep_tmp_folder:
+                shutil.rmtree(tmp_output_folder, ignore_errors=True)
+    finally:
+        stop.set()
+        if writer is not None:
+            writer.close()
+
+    failed = [video for video in pending if video in progress["failed"]]
+    print()
+    print(f"Processed {len(pending) - len(failed)} of {len(pending)} video(s) in {format_time(time.time() - start_time)}")
+    if len(failed) > 0:
+        print(f"{len(failed)} video(s) failed (see {progress_path}):")
+        for video in failed:
+            print("  " + video)
+    if args.profile:
+        print()
+        report_path = Path(args.profile_output) if args.profile_output else Path(outputPath) / "timings.json"
+        instrumentation.report(report_path)
+        print("Saved the timings to " + str(report_path))
+    return progress
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_videos', type=str, nargs='+', required=True,
+        help="Videos to reconstruct. Files, folders (all their .mov and .mp4 files) or glob patterns.")
+    parser.add_argument('--tmp_output_folder', type=str, default="emocaOutput", help="Output folder to save the results to.")
+    parser.add_argument('--tmp_folder', type=str, default="emoca_temp",
+        help="Folder for the intermediate files of the videos (each video gets its own subfolder).")
+    parser.add_argument('--prefetch_videos', type=int, default=1,
+        help="Number of videos that can be decoded and detected ahead of the one being reconstructed.")
+    parser.add_argument('--restart', action='store_true',
+        help="If set, the progress of a previous run is ignored and all the videos are processed again.")
+    add_reconstruction_args(parser)
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    reconstruct_videos(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,397 @@
+"""
+Author: Radek Danecek
+Copyright (c) 2022, Radek Danecek
+All rights reserved.
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2022 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at emoca@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+"""
+
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+
+from gdl.utils.CodeStore import CodeStore
+
+
+# the detections of a frame as DetectionStore.iter_frames yields them, every field but source has an item per face
+DetectionFrame = namedtuple("DetectionFrame", ["detection_fnames", "landmark_fnames", "centers", "sizes", "landmarks",
+                                               "landmarks_original", "landmark_types", "source"])
+
+
+class DetectionStore(object):
+    """
+    Append-only store of the face detections of a sequence, next to (and instead of) the bboxes.pkl checkpoints
+    and the per-detection landmark pickles. There is one fixed-size record per detection (frame id, face id,
+    center, size, landmarks in the crop, landmarks in the frame, landmark type, the frame name and whether the face 
+    was detected or tracked) in a CodeStore. With store_crops, the face crops (uint8, [image size, image size, 3]) 
+    are stored as well, so that they never have to be written as images nor kept in memory (see crop_view).
+    The test data of a sequence is indexed by the records themselves (see detection_index and detection_names), 
+    in the order of sorted_rows.
+
+    The frames are appended as they are detected and committed every now and then. A commit only writes the new
+    records and the small index, so checkpointing costs the same at frame 100 as at frame 100 000.
+    The committed frames are [first_frame_id, last_frame_id], frames in this range without any record have no
+    detections. A store reopened with mode='a' drops everything after the last commit and continues from there.
+
+    Usage:
+        store = DetectionStore(DetectionStore.path_for(bb_outfile), mode='w')
+        store.set_naming(detection_folder, landmark_folder, processed_ext)
+        for fid in ...:
+            store.append_frame(fid, frame_fname.stem, centers, sizes, landmarks, orig_landmarks, bbox_type, crops=crops)
+            if fid % 100 == 0:
+                store.commit(fid)
+        store.commit(fid)
+        for frame in store.iter_frames(): # or to_lists() for short sequences
+            ...
+
+        # resuming an interrupted detection
+        store = DetectionStore(DetectionStore.path_for(bb_outfile), mode='a')
+        start_fid = store.last_frame_id + 1
+    """
+
+    STORE_NAME = "detection_store"
+    # frame names are stored as fixed-size byte strings
+    FRAME_NAME_DTYPE = "S64"
+    # whether the faces of a frame come from the face detector or were tracked from the previous frame
+    SOURCES = ["detection", "tracking"]
+    CROP_COLUMN = "crop"
+
+    def __init__(self, path, mode='r'):
+        self.store = CodeStore(path, mode=mode)
+        self._pending = []
+
+    @staticmethod
+    def path_for(bb_outfile):
+        """
+        The store that belongs to a bboxes.pkl file.
+        """
+        return Path(bb_outfile).parent / DetectionStore.STORE_NAME
+
+    @staticmethod
+    def exists(path):
+        return (Path(path) / CodeStore.INDEX_FILE).is_file()
+
+    @property
+    def attrs(self):
+        return self.store.attrs
+
+    @property
+    def first_frame_id(self):
+        return self.attrs.get("first_frame_id", None)
+
+    @property
+    def last_frame_id(self):
+        """
+        The last committed frame, -1 if nothing was committed yet.
+        """
+        return self.attrs.get("last_frame_id", -1)
+
+    @property
+    def store_crops(self):
+        return self.attrs.get("store_crops", False)
+
+    @store_crops.setter
+    def store_crops(self, value):
+        assert len(self.store) == 0, "Whether the crops are stored is fixed by the first commit"
+        self.attrs["store_crops"] = bool(value)
+
+    def set_naming(self, detection_folder, landmark_folder, processed_ext, detection_names=True, landmark_names=False):
+        """
+        How the detection (and landmark) file names of load_detections are derived from the frame names,
+        the folders are relative to the output dir of the data module.
+        """
+        self.attrs.update({
+            "detection_folder": str(detection_folder),
+            "landmark_folder": str(landmark_folder),
+            "processed_ext": processed_ext,
+            "detection_names": detection_names,
+            "landmark_names": landmark_names,
+        })
+
+    def append_frame(self, fid, frame_name, centers, sizes, landmarks, orig_landmarks, landmark_type, source="detection", 
+                     crops=None):
+        """
+        Adds the detections of a frame. Nothing is written before the next commit. 
+        The crops are only kept if the store stores them (see store_crops).
+        """
+        if self.first_frame_id is None and len(self._pending) == 0:
+            self.attrs["first_frame_id"] = fid
+        if self.store_crops:
+            assert crops is not None and len(crops) == len(centers), "The store needs the crops of all the faces"
+        else:
+            crops = None
+        self._pending += [(fid, frame_name, centers, sizes, landmarks, orig_landmarks, landmark_type, source, crops)]
+
+    def commit(self, last_frame_id, **state):
+        """
+        Writes the pending frames and marks all the frames up to last_frame_id as processed. The keyword arguments
+        are saved into the attrs (i.e. the state of the face tracker needed to resume after last_frame_id).
+        """
+        frame_ids, face_ids, rows = [], [], {"center": [], "size": [], "landmarks": [], "landmarks_original": [],
+                                             "landmark_type": [], "frame_name": [], "source": [], "crop": []}
+        landmark_types = self.attrs.setdefault("landmark_types", [])
+        for fid, frame_name, centers, sizes, landmarks, orig_landmarks, landmark_type, source, crops in self._pending:
+            if landmark_type not in landmark_types:
+                landmark_types += [landmark_type]
+            for nd in range(len(centers)):
+                frame_ids += [fid]
+                face_ids += [nd]
+                rows["center"] += [np.asarray(centers[nd]).reshape(2)]
+                rows["size"] += [np.asarray(sizes[nd]).reshape(-1)[0]]
+                rows["landmarks"] += [np.asarray(landmarks[nd], dtype=np.float32)]
+                rows["landmarks_original"] += [np.asarray(orig_landmarks[nd], dtype=np.float32)]
+                rows["landmark_type"] += [landmark_types.index(landmark_type)]
+                rows["frame_name"] += [frame_name.encode()]
+                rows["source"] += [DetectionStore.SOURCES.index(source)]
+                if crops is not None:
+                    rows["crop"] += [np.asarray(crops[nd], dtype=np.uint8)]
+        if len(frame_ids) > 0:
+            columns = {
+                "center": np.stack(rows["center"]),
+                "size": np.array(rows["size"]),
+                "landmarks": np.stack(rows["landmarks"]),
+                "landmarks_original": np.stack(rows["landmarks_original"]),
+                "landmark_type": np.array(rows["landmark_type"], dtype=np.int16),
+                "frame_name": np.array(rows["frame_name"], dtype=DetectionStore.FRAME_NAME_DTYPE),
+                "source": np.array(rows["source"], dtype=np.int8),
+            }
+            if self.store_crops:
+                columns[DetectionStore.CROP_COLUMN] = np.stack(rows["crop"])
+            self.store.append(frame_ids, face_ids, columns)
+        self._pending = []
+        self.attrs["last_frame_id"] = last_frame_id
+        self.attrs.update(state)
+        self.store.flush()
+
+    def close(self):
+        self.store.close()
+
+    def iter_frames(self, chunk_size=1024):
+        """
+        The committed detections frame by frame (frames without faces included) as DetectionFrame tuples, in the format 
+        of the lists of to_lists and landmark_lists. A frame without faces counts as detected (there is nothing to track 
+        from). Only the (frame id, face id) index and the records of chunk_size frames are in memory at a time, 
+        so this is what long sequences are read with.
+        """
+        first_frame_id = self.first_frame_id if self.first_frame_id is not None else 0
+        if len(self.store) > 0:
+            frame_ids = np.asarray(self.store.frame_ids)
+            order = np.lexsort((np.asarray(self.store.face_ids), frame_ids))
+            sorted_frame_ids = frame_ids[order]
+            columns = {name: self.store.column(name) for name in 
+                       ["center", "size", "landmarks", "landmarks_original", "landmark_type", "frame_name", "source"]}
+        landmark_types = self.attrs.get("landmark_types", [])
+        detection_folder = Path(self.attrs.get("detection_folder", ""))
+        landmark_folder = Path(self.attrs.get("landmark_folder", ""))
+        ext = self.attrs.get("processed_ext", ".png")
+        for chunk_start in range(first_frame_id, self.last_frame_id + 1, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, self.last_frame_id + 1)
+            if len(self.store) == 0:
+                for fid in range(chunk_start, chunk_end):
+                    yield DetectionFrame([], [], [], [], [], [], [], "detection")
+                continue
+            # the records of the frame chunk_start + i are rows[bounds[i]:bounds[i + 1]]
+            bounds = np.searchsorted(sorted_frame_ids, np.arange(chunk_start, chunk_end + 1))
+            rows = order[bounds[0]:bounds[-1]]
+            bounds = bounds - bounds[0]
+            chunk = {name: np.asarray(column[rows]) for name, column in columns.items()}
+            for i in range(chunk_end - chunk_start):
+                start, end = bounds[i], bounds[i + 1]
+                detection_fnames, landmark_fnames = [], []
+                for nd in range(end - start):
+                    stem = chunk["frame_name"][start + nd].decode() + "_%.03d" % nd
+                    if self.attrs.get("detection_names", True):
+                        detection_fnames += [detection_folder / (stem + ext)]
+                    if self.attrs.get("landmark_names", False):
+                        landmark_fnames += [landmark_folder / (stem + ".pkl")]
+                # copies and Python ints, like the detector produces them 
+                yield DetectionFrame(
+                    detection_fnames, landmark_fnames, 
+                    [np.array(center) for center in chunk["center"][start:end]],
+                    [size.item() for size in chunk["size"][start:end]],
+                    [np.array(landmarks) for landmarks in chunk["landmarks"][start:end]],
+                    [np.array(landmarks) for landmarks in chunk["landmarks_original"][start:end]],
+                    [landmark_types[t] for t in chunk["landmark_type"][start:end]],
+                    DetectionStore.SOURCES[chunk["source"][start]] if end > start else "detection")
+
+    def sorted_rows(self, start_frame_id=None):
+        """
+        The rows of the committed detections of the frames from start_frame_id on (all by default), in the order of 
+        iter_frames (by frame, then by face). The crops, names and index of the test data all follow this order.
+        """
+        if len(self.store) == 0:
+            return np.zeros(0, dtype=np.int64)
+        frame_ids = np.asarray(self.store.frame_ids)
+        order = np.lexsort((np.asarray(self.store.face_ids), frame_ids))
+        if start_frame_id is not None:
+            order = order[frame_ids[order] >= start_frame_id]
+        # only the committed frames
+        return order[frame_ids[order] <= self.last_frame_id]
+
+    def detection_index(self, start_frame_id=None):
+        """
+        The frame ids (in the whole video), face ids, crop centers [N, 2] and crop sizes [N] of the detections of 
+        the frames from start_frame_id on, in the order of sorted_rows. Only these numeric columns are read.
+        """
+        rows = self.sorted_rows(start_frame_id)
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), \
+                np.zeros((0, 2), dtype=np.float32), np.zeros(0, dtype=np.float32)
+        return np.asarray(self.store.frame_ids)[rows].astype(np.int64), \
+            np.asarray(self.store.face_ids)[rows].astype(np.int64), \
+            np.asarray(self.store.column("center"))[rows].astype(np.float32).reshape(-1, 2), \
+            np.asarray(self.store.column("size"))[rows].astype(np.float32).reshape(-1)
+
+    def detection_names(self, start_frame_id=None, folder=None):
+        """
+        The names of the detections of the frames from start_frame_id on (the stems of their detection images, 
+        <frame name>_<face id>), in the order of sorted_rows, as a StoredDetectionNames that derives them one at a 
+        time from the frame names. With a folder, these are the paths of the detection images in that folder.
+        """
+        ext = self.attrs.get("processed_ext", ".png") if folder is not None else ""
+        return StoredDetectionNames([(self.store.path, self.sorted_rows(start_frame_id))], 
+            folders=[folder] if folder is not None else None, ext=ext)
+
+    def crop_view(self, start_frame_id=None):
+        """
+        The stored face crops of the frames from start_frame_id on (all by default), in the order of sorted_rows 
+        (by frame, then by face), as a StoredCrops that reads them from disk one at a time.
+        """
+        assert self.store_crops, f"The detection store '{self.store.path}' does not store the crops"
+        return StoredCrops([(self.store.path, self.sorted_rows(start_frame_id))])
+
+    def iter_field(self, field, chunk_size=1024):
+        """
+        One field of iter_frames, i.e. store.iter_field("centers") yields the list of the face centers of every frame.
+        """
+        return (getattr(frame, field) for frame in self.iter_frames(chunk_size))
+
+    def to_lists(self):
+        """
+        The committed detections in the format of FaceDataModuleBase.load_detections:
+        (detection_fnames, landmark_fnames, centers, sizes, last_frame_id), all lists with an item per frame.
+        """
+        detection_fnames_all, landmark_fnames_all, centers_all, sizes_all = [], [], [], []
+        for frame in self.iter_frames():
+            detection_fnames_all += [frame.detection_fnames]
+            landmark_fnames_all += [frame.landmark_fnames]
+            centers_all += [frame.centers]
+            sizes_all += [frame.sizes]
+        return detection_fnames_all, landmark_fnames_all, centers_all, sizes_all, self.last_frame_id
+
+    def landmark_lists(self):
+        """
+        The committed landmarks with an item per frame like the detection outputs them: (landmarks, original landmarks, 
+        landmark types, sources), the first three hold a list per frame with an item per face, the sources an item per frame.
+        """
+        landmarks_all, orig_landmarks_all, types_all, sources_all = [], [], [], []
+        for frame in self.iter_frames():
+            landmarks_all += [frame.landmarks]
+            orig_landmarks_all += [frame.landmarks_original]
+            types_all += [frame.landmark_types]
+            sources_all += [frame.source]
+        return landmarks_all, orig_landmarks_all, types_all, sources_all
+
+    def landmarks(self, fid, original=True):
+        """
+        The landmarks of the faces of a frame ([num faces, num landmarks, 2 or 3]) and their landmark types.
+        """
+        rows = self.store.rows_of_frame(fid)
+        landmarks = np.asarray(self.store.column("landmarks_original" if original else "landmarks")[rows]) \
+            if len(rows) > 0 else np.zeros((0,))
+        landmark_types = self.attrs.get("landmark_types", [])
+        types = [landmark_types[t] for t in np.asarray(self.store.column("landmark_type")[rows])] if len(rows) > 0 else []
+        return landmarks, types
+
+
+class StoredRows(object):
+    """
+    A sequence over records of detection stores read lazily from their memory-mapped columns: item i only reads 
+    the columns of one record, so a dataset over the detections of a long video needs no memory for them. 
+    sources is a list of (store path, rows), the rows of the sources follow each other. It pickles as the paths 
+    and the rows (i.e. into DataLoader workers), not as the data. Subclasses define the COLUMNS they read and 
+    _read, which makes an item out of them.
+    """
+
+    COLUMNS = []
+
+    def __init__(self, sources):
+        self.sources = [(Path(path), np.asarray(rows, dtype=np.int64)) for path, rows in sources]
+        self._offsets = np.cumsum([0] + [len(rows) for _, rows in self.sources])
+        self._columns = None
+
+    def __len__(self):
+        return int(self._offsets[-1])
+
+    def __add__(self, other):
+        return type(self)(self.sources + other.sources)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError(f"Index {index} out of range")
+        if self._columns is None:
+            self._columns = []
+            for path, _ in self.sources:
+                store = CodeStore(path)
+                self._columns += [{name: store.column(name) for name in self.COLUMNS}]
+        si = int(np.searchsorted(self._offsets, index, side='right')) - 1
+        return self._read(si, self._columns[si], self.sources[si][1][index - self._offsets[si]])
+
+    def _read(self, source_index, columns, row):
+        raise NotImplementedError()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_columns'] = None
+        return state
+
+
+class StoredCrops(StoredRows):
+    """
+    The face crops of the crop columns of detection stores, crops[i] is a uint8 [image size, image size, 3] copy.
+    """
+
+    COLUMNS = [DetectionStore.CROP_COLUMN]
+
+    def _read(self, source_index, columns, row):
+        return np.array(columns[DetectionStore.CROP_COLUMN][row])
+
+
+class StoredDetectionNames(StoredRows):
+    """
+    The detection names (<frame name>_<face id>, the stems of the detection images) derived from the records of 
+    detection stores. With folders (one per source), the items are the paths <folder>/<name><ext> instead.
+    """
+
+    COLUMNS = ["frame_name", "face_id"]
+
+    def __init__(self, sources, folders=None, ext=""):
+        super().__init__(sources)
+        self.folders = folders
+        self.ext = ext
+
+    def __add__(self, other):
+        assert (self.folders is None) == (other.folders is None) and self.ext == other.ext
+        return StoredDetectionNames(self.sources + other.sources, 
+            folders=self.folders + other.folders if self.folders is not None else None, ext=self.ext)
+
+    def _read(self, source_index, columns, row):
+        # the same names as iter_frames gives the detection images
+        name = columns["frame_name"][row].decode() + "_%.03d" % columns["face_id"][row]
+        if self.folders is None:
+            return name
+        return str(Path(self.folders[source_index]) / (name + self.ext))
@@ -27,28 +27,28 @@ import torch
 # import torchaudio
 from typing import Optional, Union, List
 import pickle as pkl
-import hickle as hkl
 # from collections import OrderedDict
 from tqdm import tqdm, auto
 # import subprocess
 from torchvision.transforms import Resize, Compose
 import gdl
-from gdl.datasets.ImageTestDataset import TestData
-from gdl.datasets.FaceDataModuleBase import FaceDataModuleBase
+from gdl.datasets.ImageTestDataset import TestData, InMemoryTestData, DetectionIndexedData
+from gdl.datasets.FaceDataModuleBase import FaceDataModuleBase, StreamedList
+from gdl.datasets.DetectionStore import DetectionStore
 from gdl.datasets.ImageDatasetHelpers import point2bbox, bbpoint_warp
 from gdl.datasets.UnsupervisedImageDataset import UnsupervisedImageDataset
-from facenet_pytorch import InceptionResnetV1
 from collections import OrderedDict
 from gdl.datasets.IO import save_emotion, save_segmentation_list, save_reconstruction_list, save_emotion_list
 from PIL import Image, ImageDraw, ImageFont
 import cv2
 from skimage.io import imread
-from skvideo.io import vreader, vread
-import skvideo.io
+from gdl.datasets.VideoFrameSource import VideoFrameSource
+from gdl.utils.other import is_skvideo_reader
 import torch.nn.functional as F
 
 from gdl.datasets.VideoFaceDetectionDataset import VideoFaceDetectionDataset
 import types
+import itertools
 
 from gdl.utils.FaceDetector import save_landmark, save_landmark_v2
 
@@ -86,6 +86,13 @@ class FaceVideoDataModule(FaceDataModuleBase):
                  preload_videos = False,
                  inflate_by_video_size = False,
                  read_video=True,
+                 keep_detections_in_memory=False,
+                 face_detector_batch_size=1,
+                 face_tracking=False,
+                 tracking_keyframe_interval=10,
+                 tracking_score_threshold=0.5,
+                 tracking_iou_threshold=0.5,
+                 resume_detection=True,
                  ):
         super().__init__(root_dir, output_dir,
                          processed_subfolder=processed_subfolder,
@@ -101,6 +108,11 @@ class FaceVideoDataModule(FaceDataModuleBase):
                          save_segmentation_one_file=save_segmentation_one_file, # only use for large scale video datasets (that would produce too many files otherwise)
                          bb_center_shift_x=bb_center_shift_x, # in relative numbers
                          bb_center_shift_y=bb_center_shift_y, # in relative numbers (i.e. -0.1 for 10% shift upwards, ...)
+                         face_detector_batch_size=face_detector_batch_size,
+                         face_tracking=face_tracking,
+                         tracking_keyframe_interval=tracking_keyframe_interval,
+                         tracking_score_threshold=tracking_score_threshold,
+                         tracking_iou_threshold=tracking_iou_threshold,
                          )
         self.unpack_videos = unpack_videos
         self.detect_landmarks_on_restored_images = None
@@ -131,6 +143,14 @@ class FaceVideoDataModule(FaceDataModuleBase):
         self._must_include_audio = False
         self.read_video=read_video
 
+        # if True, the detected face crops that are not saved as images are stored in the detection store 
+        # (and read from there one at a time, see _get_detection_test_data) instead of being discarded
+        self.keep_detections_in_memory = keep_detections_in_memory
+        # if face tracking is on, for each frame whether the faces come from the detector or were tracked (sequence_id -> int8 array of indices into DetectionStore.SOURCES)
+        self.detection_sources = {}
+        # if True, an interrupted face detection continues after the last frame saved into its detection store
+        self.resume_detection = resume_detection
+
     @property
     def metadata_path(self):
         return os.path.join(self.output_dir, "metadata.pkl")
@@ -180,10 +200,8 @@ class FaceVideoDataModule(FaceDataModuleBase):
             out_folder.mkdir(exist_ok=True, parents=True)
 
             out_format = out_folder / (self.get_frame_number_format() + ".png")
-            out_format = '-r 1 -i %s -r 1 ' % str(video_file) + ' "' + str(out_format) + '"'
-            # out_format = ' -r 1 -i %s ' % str(video_file) + ' "' + "$frame.%03d.png" + '"'
-            # subprocess.call(['ffmpeg', out_format])
-            os.system("ffmpeg " + out_format)
+            # the PNGs are only an on-disk cache of the frames the frame source streams otherwise
+            self._get_frame_source(video_idx).write_frames(out_format)
 
             # import ffmpeg
             # stream = ffmpeg.input(str(video_file))
@@ -247,6 +265,102 @@ class FaceVideoDataModule(FaceDataModuleBase):
     def _get_path_to_sequence_frames(self, sequence_id):
         return self._get_path_to_sequence_files(sequence_id, "videos")
 
+    def _get_frame_source(self, sequence_id, video_path=None, start_frame=0, end_frame=None):
+        """
+        Returns the frame source decoding the video of the sequence (or the given video, i.e. a restored one). 
+        The geometry of the frames comes from the cached video metas.
+        """
+        video_path = video_path or Path(self.root_dir) / self.video_list[sequence_id]
+        video_meta = self.video_metas[sequence_id] if self.video_metas is not None else None
+        return VideoFrameSource(video_path, video_meta, start_frame=start_frame, end_frame=end_frame)
+
+    def _get_frame_range(self, sequence_id):
+        """
+        Returns the range of frames [start, end) of the sequence that the detection runs on, the whole sequence by default. 
+        The i-th detection of the sequence belongs to frame start + i.
+        """
+        return 0, int(self.video_metas[sequence_id]['num_frames'])
+
+    def _open_detection_store(self, sequence_id, out_file_boxes, start_fid, end_fid, out_detection_folder, out_landmark_folder):
+        """
+        Opens the detection store of the sequence for appending. The store left behind by an interrupted detection 
+        of the same frames with the same settings is continued (its last_frame_id tells where), otherwise a new 
+        one is started. If the detections are not saved as images (keep_detections_in_memory), the face crops go 
+        into the store as well, so they are continued like everything else.
+        """
+        settings = {
+            "video": str(self.video_list[sequence_id]),
+            "restored_video": self.detect_landmarks_on_restored_images,
+            "start_frame": int(start_fid),
+            "end_frame": int(end_fid),
+            "face_detector": self.face_detector_type,
+            "face_detector_threshold": self.face_detector_threshold,
+            "face_detector_batch_size": self.face_detector_batch_size,
+            "face_tracking": self.face_tracking,
+            "tracking_keyframe_interval": self.tracking_keyframe_interval,
+            "tracking_score_threshold": self.tracking_score_threshold,
+            "tracking_iou_threshold": self.tracking_iou_threshold,
+            "image_size": self.image_size,
+            "scale": self.scale,
+            "bb_center_shift_x": self.bb_center_shift_x,
+            "bb_center_shift_y": self.bb_center_shift_y,
+            "save_detection_images": self.save_detection_images,
+            "keep_detections_in_memory": self.keep_detections_in_memory,
+        }
+        store_path = DetectionStore.path_for(out_file_boxes)
+        mode = 'w'
+        if self.resume_detection and DetectionStore.exists(store_path) \
+            and DetectionStore(store_path).attrs.get("settings") == settings:
+            mode = 'a'
+        store = DetectionStore(store_path, mode=mode)
+        if mode == 'w':
+            store.attrs["settings"] = settings
+            store.store_crops = self.keep_detections_in_memory
+            store.set_naming(out_detection_folder.relative_to(self.output_dir), 
+                out_landmark_folder.relative_to(self.output_dir), self.processed_ext, 
+                detection_names=self.save_detection_images or self.keep_detections_in_memory)
+        return store
+
+    def get_frame_shards(self, sequence_id, num_shards, overlap=0):
+        """
+        Splits the frames of the sequence into num_shards contiguous ranges that can be processed independently. 
+        Returns a list of (start, end, warmup), each shard also needs to process the warmup frames before start 
+        (at most overlap of them), i.e. so that the face tracker is warmed up when reaching its first frame.
+        """
+        num_frames = int(self.video_metas[sequence_id]['num_frames'])
+        num_shards = max(min(num_shards, num_frames), 1)
+        bounds = [num_frames * si // num_shards for si in range(num_shards + 1)]
+        return [(bounds[si], bounds[si + 1], min(overlap, bounds[si])) for si in range(num_shards)]
+
+    def _merge_frame_shards(self, sequence_id, shards):
+        """
+        Merges the detections of the shards of a sequence back into one bboxes.pkl of this sequence, in frame order. 
+        shards is a list of (output_dir, warmup) of the data modules that processed the shards (sorted by their frames), 
+        the detections of the warmup frames are dropped. The detection paths stay relative to this output_dir.
+        The detections are streamed from the detection stores of the shards frame by frame.
+        """
+        shard_stores = []
+        for shard_output_dir, warmup in shards:
+            shard_dm_out = Path(shard_output_dir)
+            shard_file = shard_dm_out / self._get_path_to_sequence_detections(sequence_id).relative_to(self.output_dir) / "bboxes.pkl"
+            shard_stores += [(shard_dm_out, DetectionStore(DetectionStore.path_for(shard_file)), warmup)]
+
+        def merged_field(field):
+            for shard_dm_out, shard_store, warmup in shard_stores:
+                for values in itertools.islice(shard_store.iter_field(field), warmup, None):
+                    if field in ["detection_fnames", "landmark_fnames"]:
+                        values = [Path(os.path.relpath(shard_dm_out / fname, self.output_dir)) for fname in values]
+                    yield values
+
+        last_frame_id = shard_stores[-1][1].last_frame_id if len(shard_stores) > 0 else 0
+        out_detection_folder = self._get_path_to_sequence_detections(sequence_id)
+        out_detection_folder.mkdir(exist_ok=True, parents=True)
+        FaceVideoDataModule.save_detections(out_detection_folder / "bboxes.pkl",
+                                            StreamedList(merged_field, "detection_fnames"), 
+                                            StreamedList(merged_field, "landmark_fnames"), 
+                                            StreamedList(merged_field, "centers"), 
+                                            StreamedList(merged_field, "sizes"), last_frame_id)
+
     def _get_path_to_aligned_videos(self, sequence_id):
         return self._get_path_to_sequence_files(sequence_id, "videos_aligned").with_suffix(".mp4")
 
@@ -355,81 +469,124 @@ class FaceVideoDataModule(FaceDataModuleBase):
                 return
 
 
-        centers_all = []
-        sizes_all = []
-        detection_fnames_all = []
-        landmark_fnames_all = []
+        # the detections only go into the detection store (below), which writes them to disk in chunks, 
+        # so nothing grows in memory with the length of the video
+        centers_all = None
+        sizes_all = None
+        detection_fnames_all = None
+        landmark_fnames_all = None
         # save_folder = frame_fname.parents[3] / 'detections'
 
-        # # TODO: resuming is not tested, probably doesn't work yet
-        # checkpoint_frequency = 100
-        # resume = False
-        # if resume and out_file.exists():
-        #     detection_fnames_all, landmark_fnames_all, centers_all, sizes_all, start_fid = \
-        #         FaceVideoDataModule.load_detections(out_file)
-        # else:
-        #     start_fid = 0
-        #
         # # hack trying to circumvent memory leaks on the cluster
         # detector_instantion_frequency = 200
-        start_fid = 0
+        # only a range of the frames is processed if the sequence is split into shards
+        start_fid, end_fid = self._get_frame_range(sequence_id)
+
+        # the crops that are not saved as images go into the detection store (see _open_detection_store) 
+        out_detection_ims_all = None
+
+        # the detections (and landmarks) are appended to the store and committed every 100 frames, 
+        # an interrupted detection continues after the last commit
+        self._detection_store = self._open_detection_store(sequence_id, out_file_boxes, start_fid, end_fid, 
+            out_detection_folder, out_landmark_folder)
+        resumed = self._detection_store.last_frame_id >= start_fid
+        if resumed:
+            last_frame_id = self._detection_store.last_frame_id
+            print("Resuming the detection in sequence '%s' from frame %d" % (self.video_list[sequence_id], last_frame_id + 1))
+            start_fid = last_frame_id + 1
+        # the last processed frame
+        fid = start_fid - 1
+
+        if self.face_tracking:
+            # tracking is sequential, so it takes precedence over batched detection
+            self._reset_face_tracker()
+            if resumed:
+                # the tracker continues from the landmarks of the last committed frame
+                self._tracked_landmarks = list(self._detection_store.landmarks(last_frame_id, original=True)[0])
+                self._frames_since_keyframe = self._detection_store.attrs.get("frames_since_keyframe", 0)
+        # the sources of the frames are in the detection store
+        out_detection_sources_all = None
 
         if self.unpack_videos:
             frame_list = self.frame_lists[sequence_id]
-            fid = 0
+            end_fid = min(end_fid, len(frame_list))
             if len(frame_list) == 0:
                 print("Nothing to detect in: '%s'. All frames have been processed" % self.video_list[sequence_id])
-            for fid, frame_fname in enumerate(tqdm(range(start_fid, len(frame_list)))):
+            if self.face_detector_batch_size > 1 and not self.face_tracking:
+                fid = self._detect_faces_in_frames_batched(frame_list, start_fid, end_fid, 
+                                            out_detection_folder, out_landmark_folder, out_file_boxes,
+                                            centers_all, sizes_all, detection_fnames_all, landmark_fnames_all, 
+                                            out_detection_ims_all=out_detection_ims_all)
+            else:
+                for fid in tqdm(range(start_fid, end_fid)):
 
-                # if fid % detector_instantion_frequency == 0:
-                #     self._instantiate_detector(overwrite=True)
+                    # if fid % detector_instantion_frequency == 0:
+                    #     self._instantiate_detector(overwrite=True)
 
-                self._detect_faces_in_image_wrapper(frame_list, fid, out_detection_folder, out_landmark_folder, out_file_boxes,
-                                            centers_all, sizes_all, detection_fnames_all, landmark_fnames_all)
+                    self._detect_faces_in_image_wrapper(frame_list, fid, out_detection_folder, out_landmark_folder, out_file_boxes,
+                                                centers_all, sizes_all, detection_fnames_all, landmark_fnames_all, 
+                                                out_detection_ims_all=out_detection_ims_all, 
+                                                out_detection_sources_all=out_detection_sources_all)
 
         else: 
-            num_frames = self.video_metas[sequence_id]['num_frames']
+            num_frames = end_fid
             if self.detect_landmarks_on_restored_images is None:
                 video_name = self.root_dir / self.video_list[sequence_id]
             else: 
                 video_name = video_file = self._get_path_to_sequence_restored(
                     sequence_id, method=self.detect_landmarks_on_restored_images)
             assert video_name.is_file()
-            if start_fid == 0:
-                videogen =  vreader(str(video_name))
-                # videogen =  vread(str(video_name))
-                # for i in range(start_fid): 
-                    # _discarded_frame = next(videogen
-            else: 
-                videogen =  vread(str(video_name))
+            # the frames are decoded once and streamed, the source seeks to start_fid (i.e. if resuming)
+            videogen = self._get_frame_source(sequence_id, video_name, start_frame=start_fid, end_frame=end_fid).images()
 
-            if self.save_landmarks_one_file: 
-                out_landmarks_all = [] # landmarks wrt to the aligned image
-                out_landmarks_original_all = [] # landmarks wrt to the original image
-                out_bbox_type_all = []
-            else: 
-                out_landmarks_all = None
-                out_landmarks_original_all = None
-                out_bbox_type_all = None
+            # the landmarks are in the detection store as well, the one-file landmark lists are written from it at the end
+            out_landmarks_all = None
+            out_landmarks_original_all = None
+            out_bbox_type_all = None
 
-            for fid in tqdm(range(start_fid, num_frames)):
-                self._detect_faces_in_image_wrapper(videogen, fid, out_detection_folder, out_landmark_folder, out_file_boxes,
+            if self.face_detector_batch_size > 1 and not self.face_tracking:
+                fid = self._detect_faces_in_frames_batched(videogen, start_fid, num_frames, 
+                                            out_detection_folder, out_landmark_folder, out_file_boxes,
                                             centers_all, sizes_all, detection_fnames_all, landmark_fnames_all,
-                                            out_landmarks_all, out_landmarks_original_all, out_bbox_type_all)
+                                            out_landmarks_all, out_landmarks_original_all, out_bbox_type_all, 
+                                            out_detection_ims_all)
+            else:
+                for fid in tqdm(range(start_fid, num_frames)):
+                    self._detect_faces_in_image_wrapper(videogen, fid, out_detection_folder, out_landmark_folder, out_file_boxes,
+                                                centers_all, sizes_all, detection_fnames_all, landmark_fnames_all,
+                                                out_landmarks_all, out_landmarks_original_all, out_bbox_type_all, 
+                                                out_detection_ims_all, out_detection_sources_all)
                                             
+        store = self._detection_store
+        store.commit(fid)
+        store.close()
+        self._detection_store = None
+
+        # the per-sequence files of the tools that do not read the detection store are written from it frame by frame
+        if self.face_tracking:
+            # an index into DetectionStore.SOURCES per frame
+            sources = np.array([DetectionStore.SOURCES.index(source) for source in store.iter_field("source")], dtype=np.int8)
+            self.detection_sources[sequence_id] = sources
+            FaceVideoDataModule.save_landmark_list(out_detection_folder / "detection_sources.pkl", 
+                                                   StreamedList(store.iter_field, "source"))
+            print(f"Full detector ran on {np.count_nonzero(sources == 0)} out of {len(sources)} frames")
+
         if self.save_landmarks_one_file: 
             # saves all landmarks per video  
             out_file = out_landmark_folder / "landmarks.pkl"
-            FaceVideoDataModule.save_landmark_list(out_file, out_landmarks_all)
+            FaceVideoDataModule.save_landmark_list(out_file, StreamedList(store.iter_field, "landmarks"))
             out_file = out_landmark_folder / "landmarks_original.pkl"
-            FaceVideoDataModule.save_landmark_list(out_file, out_landmarks_original_all)
+            FaceVideoDataModule.save_landmark_list(out_file, StreamedList(store.iter_field, "landmarks_original"))
             print(f"Landmarks for sequence saved into one file: {out_file}")
             out_file = out_landmark_folder / "landmark_types.pkl"
-            FaceVideoDataModule.save_landmark_list(out_file, out_bbox_type_all)
-
+            FaceVideoDataModule.save_landmark_list(out_file, StreamedList(store.iter_field, "landmark_types"))
 
+        # written once at the end, for the tools that read bboxes.pkl directly
         FaceVideoDataModule.save_detections(out_file_boxes,
-                                            detection_fnames_all, landmark_fnames_all, centers_all, sizes_all, fid)
+                                            StreamedList(store.iter_field, "detection_fnames"), 
+                                            StreamedList(store.iter_field, "landmark_fnames"), 
+                                            StreamedList(store.iter_field, "centers"), 
+                                            StreamedList(store.iter_field, "sizes"), fid)
         print("Done detecting faces in sequence: '%s'" % self.video_list[sequence_id])
         return 
 
@@ -467,6 +624,7 @@ class FaceVideoDataModule(FaceDataModuleBase):
         else: 
             # if start_fid == 0:
                 # videogen =  vreader(str(video_name))
+            import skvideo.io
             videogen =  skvideo.io.FFmpegReader(str(video_file))
                 # videogen =  vread(str(video_name))
                 # for i in range(start_fid): 
@@ -510,7 +668,7 @@ class FaceVideoDataModule(FaceDataModuleBase):
 
         if isinstance(detection_fnames_or_ims, types.GeneratorType): 
             im_read = "skvreader"
-        elif isinstance(detection_fnames_or_ims, (skvideo.io.FFmpegReader)):
+        elif is_skvideo_reader(detection_fnames_or_ims):
             im_read = "skvffmpeg"
         else:
             im_read = 'pil' if not isinstance(detection_fnames_or_ims[0], np.ndarray) else None
@@ -612,10 +770,12 @@ class FaceVideoDataModule(FaceDataModuleBase):
             # video_path = str( Path(self.output_dir) / "videos_aligned" / self.video_list[sequence_id])
             video_path = self._get_path_to_aligned_videos(sequence_id)
             # detections = vreader( video_path)
+            import skvideo.io
             detections = skvideo.io.FFmpegReader(str(video_path))
             # detections = detections.astype(np.float32) / 255.
         else: 
-            detections = vread( str(self.root_dir / self.video_list[sequence_id]))
+            import skvideo.io
+            detections = skvideo.io.vread( str(self.root_dir / self.video_list[sequence_id]))
             detections = detections.astype(np.float32) / 255.
             
 
@@ -808,6 +968,7 @@ class FaceVideoDataModule(FaceDataModuleBase):
         print("Done running emotion recognition in sequence '%s'" % self.video_list[sequence_id])
 
     def _get_recognition_net(self, device):
+        from facenet_pytorch import InceptionResnetV1
         resnet = InceptionResnetV1(pretrained='vggface2').eval().to(device)
         return resnet
 
@@ -1179,7 +1340,7 @@ class FaceVideoDataModule(FaceDataModuleBase):
         # add_pretrained_deca_to_path()
         # from decalib.utils import util
         import gdl.utils.DecaUtils as util
-        from scipy.io.matlab import savemat
+        from gdl.utils.CodeStore import CodeStore
 
         if retarget_from is not None:
             import datetime
@@ -1223,8 +1384,18 @@ class FaceVideoDataModule(FaceDataModuleBase):
 
 
         video_writer = None
+        # the codes of all the faces of the sequence go into one columnar store (instead of a .mat file per face)
+        code_store = CodeStore(out_folder / 'codes', mode='w') if save_mat else None
+        # the frame and face ids of the detection images, in the order of the images
+        detection_index = None
         if self.unpack_videos:
-            detections_fnames_or_images = sorted(list(in_folder.glob("*.png")))
+            store = self._get_detection_store(sequence_id)
+            if store is not None and self.save_detection_images:
+                # the detection images are listed by the records of the store, which also give their ids
+                detections_fnames_or_images = store.detection_names(folder=self._get_detection_folder(store))
+                detection_index = store.detection_index()
+            else:
+                detections_fnames_or_images = sorted(list(in_folder.glob("*.png")))
         else:
             from skvideo.io import vread
             detections_fnames_or_images = vread(str(in_folder))
@@ -1248,6 +1419,15 @@ class FaceVideoDataModule(FaceDataModuleBase):
                     del encoded_values["images"]
                 if "image" in encoded_values.keys(): 
                     del encoded_values["image"]
+                if code_store is not None:
+                    start, end = i * batch_size, i * batch_size + len(batch['path'])
+                    if detection_index is not None:
+                        frame_ids, face_ids = detection_index[0][start:end], detection_index[1][start:end]
+                    else:
+                        # the images are not detections of the store, they are numbered in the order they were read
+                        frame_ids, face_ids = list(range(start, end)), [0] * (end - start)
+                    code_store.append(frame_ids, face_ids, {key: value for key, value in codedict.items() 
+                        if isinstance(value, torch.Tensor) and key not in ["image", "images"] and value.shape[0] == end - start})
 
                 # opdict, visdict = reconstruction_net.decode(codedict)
                 if codedict_retarget is not None:
@@ -1277,11 +1457,6 @@ class FaceVideoDataModule(FaceDataModuleBase):
                         mesh_folder = out_folder / 'meshes'
                         mesh_folder.mkdir(exist_ok=True, parents=True)
                         reconstruction_net.deca.save_obj(str(mesh_folder / (name + '.obj')), encoded_values)
-                    if save_mat:
-                        # if i*j == 0:
-                        mat_folder = out_folder / 'mat'
-                        mat_folder.mkdir(exist_ok=True, parents=True)
-                        savemat(str(mat_folder / (name + '.mat')), encoded_values)
                     if save_vis or save_video:
                         # if i*j == 0:
                         vis_folder = out_folder / 'vis'
@@ -1315,6 +1490,8 @@ class FaceVideoDataModule(FaceDataModuleBase):
                             cv2.imwrite(str(ims_folder / vis_name / (name +'.png')), image)
         if video_writer is not None:
             video_writer.release()
+        if code_store is not None:
+            code_store.close()
         print("Done running face reconstruction in sequence '%s'" % self.video_list[sequence_id])
 
     def _reconstruct_faces_in_sequence_v2(self, sequence_id, reconstruction_net=None, device=None,
@@ -1532,6 +1709,7 @@ class FaceVideoDataModule(FaceDataModuleBase):
                 vid_meta['num_frames'] = int(subprocess.check_output(["ffprobe", "-v", "error", "-select_streams", "v:0", "-count_packets", "-show_entries", "stream=nb_read_packets", "-of", "csv=p=0", 
                     video_path]))
             if vid_meta['num_frames'] == 0: 
+                import skvideo.io
                 _vr = skvideo.io.FFmpegReader(video_path)
                 vid_meta['num_frames'] = _vr.getShape()[0]
                 del _vr
@@ -1641,7 +1819,7 @@ class FaceVideoDataModule(FaceDataModuleBase):
     def _get_detection_for_sequence(self, sid):
         out_folder = self._get_path_to_sequence_detections(sid)
         out_file = out_folder / "bboxes.pkl"
-        if not out_file.exists():
+        if not out_file.exists() and not DetectionStore.exists(DetectionStore.path_for(out_file)):
             print("Detections don't exist")
             return [], [], [], 0
         detection_fnames, landmark_fnames, centers, sizes, last_frame_id = \
@@ -1670,6 +1848,36 @@ class FaceVideoDataModule(FaceDataModuleBase):
 
         return relative_detection_fnames, centers, sizes, last_frame_id
 
+    def _get_detection_store(self, sequence_id):
+        """
+        The DetectionStore of the sequence, None if there is none (i.e. detections from before the store). 
+        Its records are the frame -> faces index of the sequence (see DetectionStore.detection_index).
+        """
+        store_path = DetectionStore.path_for(self._get_path_to_sequence_detections(sequence_id) / "bboxes.pkl")
+        if not DetectionStore.exists(store_path):
+            return None
+        return DetectionStore(store_path)
+
+    def _get_detection_folder(self, store):
+        # the folder the detection images of the store were saved into
+        return Path(self.output_dir) / store.attrs.get("detection_folder", "")
+
+    def get_detection_landmarks(self, sequence_id, frame_ids, face_ids):
+        """
+        The landmarks (in the frame, [N, num landmarks, 2 or 3]) of the detections with the given frame ids 
+        (in the whole video) and face ids, read from the DetectionStore of the sequence. 
+        None if they are not available (i.e. detections from before the store).
+        """
+        store = self._get_detection_store(sequence_id)
+        if store is None:
+            return None
+        store = store.store
+        rows = [store.rows_of_frame(int(fid), int(nd)) for fid, nd in zip(frame_ids, face_ids)]
+        if any(len(frame_rows) != 1 for frame_rows in rows):
+            return None
+        landmarks = np.asarray(store.column("landmarks_original"))
+        return landmarks[np.concatenate(rows)] if len(rows) > 0 else landmarks[:0]
+
     def _get_validated_annotations_for_sequence(self, sid, crash_on_failure=True):
         out_folder = self._get_path_to_sequence_detections(sid)
         out_file = out_folder / "valid_annotations.pkl"
@@ -1724,19 +1932,35 @@ class FaceVideoDataModule(FaceDataModuleBase):
         from PIL import Image, ImageDraw
         # fid = 0
         image_type = image_type or "geometry_detail"
-        detection_fnames, centers, sizes, last_frame_id = self._get_detection_for_sequence(sequence_id)
-        vis_fnames = self._get_reconstructions_for_sequence(sequence_id, rec_method=rec_method, 
-            retarget_suffix=retarget_suffix, image_type=image_type, out_folder=out_folder)
+        store = self._get_detection_store(sequence_id)
+        if store is None:
+            raise RuntimeError(f"The detections of sequence '{self.video_list[sequence_id]}' have no detection store, "
+                               "run the face detection again")
+        # the faces of every frame come straight from the records of the detection store (by frame, then by face), 
+        # the reconstruction of a face is in the folder of its detection name
+        frame_ids, _, centers, sizes = store.detection_index()
+        detection_names = store.detection_names()
+        reconstruction_folder = self._get_reconstruction_folder(sequence_id, rec_method=rec_method, 
+            retarget_suffix=retarget_suffix, out_folder=out_folder)
         
         vid_frames = self._get_frames_for_sequence(sequence_id)
-
-        vis_fnames.sort()
         vid_frames.sort()
+        if self.save_detection_images:
+            detection_paths = store.detection_names(folder=self._get_detection_folder(store))
+
+        if self.unpack_videos:
+            num_frames = len(vid_frames)
+        else: 
+            # the frames have never been unpacked to disk, stream them from the video instead
+            vid_frames = self._get_frame_source(sequence_id).images()
+            num_frames = self.video_metas[sequence_id]['num_frames']
+        # the records of the frame fid are rows frame_starts[fid]:frame_starts[fid + 1]
+        frame_starts = np.searchsorted(frame_ids, np.arange(num_frames + 1))
 
         if image_type == "detail":
-            outfile = vis_fnames[0].parents[1] / "video.mp4"
+            outfile = reconstruction_folder / "video.mp4"
         else:
-            outfile = vis_fnames[0].parents[1] /( "video_" + image_type + ".mp4")
+            outfile = reconstruction_folder /( "video_" + image_type + ".mp4")
 
         print("Creating reconstruction video for sequence num %d: '%s' " % (sequence_id, self.video_list[sequence_id]))
         if outfile.exists() and not overwrite:
@@ -1746,21 +1970,18 @@ class FaceVideoDataModule(FaceDataModuleBase):
             return
 
         writer = None  # cv2.VideoWriter()
-        broken = False
-        did = 0
-        for fid in tqdm(range(len(vid_frames))):
-            if broken:
-                break
-
-            frame_name = vid_frames[fid]
-            frame = imread(frame_name)
-
-            if len(centers) > 0 and len(sizes) > 0:
-                c = centers[fid]
-                s = sizes[fid]
+        for fid in tqdm(range(num_frames)):
+            if self.unpack_videos:
+                frame_name = vid_frames[fid]
+                frame = imread(frame_name)
             else: 
-                c = [[frame.shape[0] / 2, frame.shape[0] / 2]]
-                s = frame.shape[0]
+                try:
+                    frame = next(vid_frames)
+                except StopIteration:
+                    break
+
+            c = centers[frame_starts[fid]:frame_starts[fid + 1]]
+            s = sizes[frame_starts[fid]:frame_starts[fid + 1]]
 
 
             frame_pill_bb = Image.fromarray(frame)
@@ -1774,23 +1995,17 @@ class FaceVideoDataModule(FaceDataModuleBase):
             frame_draw = ImageDraw.Draw(frame_pill_bb)
 
             for nd in range(len(c)):
-                detection_name = detection_fnames[fid][nd]
-
-                if did >= len(vis_fnames):
-                    broken = True
-                    break
-
-                vis_name = vis_fnames[did]
-
-                if detection_name.stem not in str(vis_name) :
-                    print("%s != %s" % (detection_name.stem, vis_name.stem))
-                    raise RuntimeError("Detection and visualization filenames should match but they don't.")
+                row = frame_starts[fid] + nd
+                vis_name = self._get_reconstruction_file(reconstruction_folder, detection_names[row], image_type)
+                if vis_name is None:
+                    # this face has not been reconstructed
+                    continue
 
-                try:
-                    detection_im = imread(self.output_dir / detection_name)
-                except:
-                    # ugly hack to deal with the old AffWild2 dataset
-                    detection_im = imread(self.output_dir / detection_name.relative_to(detection_name.parents[4]))
+                if self.save_detection_images:
+                    detection_size = imread(detection_paths[row]).shape[0]
+                else: 
+                    # detections were not written to disk, they have the size they were cropped to
+                    detection_size = self.image_size
                 try:
                     vis_im = imread(vis_name)
                 except ValueError as e:
@@ -1819,10 +2034,10 @@ class FaceVideoDataModule(FaceDataModuleBase):
 
                 # vis_im = np.concatenate([vis_im, vis_mask[..., np.newaxis]], axis=2)
 
-                warped_im = bbpoint_warp(vis_im, c[nd], s[nd], detection_im.shape[0],
+                warped_im = bbpoint_warp(vis_im, c[nd], s[nd], detection_size,
                                          output_shape=(frame.shape[0], frame.shape[1]), inv=False)
                 # warped_im = bbpoint_warp(vis_im, c[nd], s[nd], frame.shape[0], frame.shape[1], False)
-                warped_mask = bbpoint_warp(vis_mask, c[nd], s[nd], detection_im.shape[0],
+                warped_mask = bbpoint_warp(vis_mask, c[nd], s[nd], detection_size,
                                            output_shape=(frame.shape[0], frame.shape[1]), inv=False)
                 # warped_mask = bbpoint_warp(vis_mask, c[nd], s[nd], frame.shape[0], frame.shape[1], False)
 
@@ -1844,7 +2059,6 @@ class FaceVideoDataModule(FaceDataModuleBase):
                 if include_transparent:
                     frame_deca_trans.paste(vis_pil, (0, 0), mask_pil_transparent)
                 # tform =
-                did += 1
 
             final_im = np.array(frame_pill_bb)
             final_im2 = np.array(frame_deca_full)
@@ -2217,7 +2431,8 @@ class FaceVideoDataModule(FaceDataModuleBase):
         if with_recognitions:
             out_file_recognitions = out_folder / "embeddings.pkl"
 
-        if out_file_detections.exists() and (not with_recognitions or out_file_recognitions.exists()):
+        detections_exist = out_file_detections.exists() or DetectionStore.exists(DetectionStore.path_for(out_file_detections))
+        if detections_exist and (not with_recognitions or out_file_recognitions.exists()):
             detection_fnames, landmark_fnames, centers, sizes, last_frame_id = \
                 FaceVideoDataModule.load_detections(out_file_detections)
             if with_recognitions:
@@ -2485,6 +2700,7 @@ class FaceVideoDataModule(FaceDataModuleBase):
         # 4) generate a new video 
 
         # video = skvideo.io.vread(str(self.root_dir / self.video_list[sequence_id]))
+        import skvideo.io
         video = skvideo.io.vreader(str(self.root_dir / self.video_list[sequence_id]))
 
         from gdl.datasets.FaceAlignmentTools import align_video, align_and_save_video
@@ -2551,6 +2767,7 @@ class FaceVideoDataModule(FaceDataModuleBase):
 
     def _save_unsuccessfully_aligned_video(self, sequence_id, output_video_file): 
         desired_processed_video_size = self.processed_video_size
+        import skvideo.io
         videogen = skvideo.io.vreader(str(self.root_dir / self.video_list[sequence_id]))
         first_frame = None
         for frame in videogen:
@@ -3165,18 +3382,37 @@ class TestFaceVideoDM(FaceVideoDataModule):
                  detect = True,
                  batch_size=8,
                  num_workers=4,
-                 device=None):
+                 device=None, 
+                 unpack_videos=True, # if False, frames are streamed from the video and never written to disk
+                 save_detection_images=True, # if False, face crops go into the detection store and are passed to the model directly
+                 face_detector_batch_size=1, # number of frames passed through the face detector at once
+                 face_tracking=False, # if True, the face detector only runs on keyframes and the faces are tracked in between
+                 tracking_keyframe_interval=10,
+                 start_frame=0, # only the frames [start_frame, end_frame) are processed (i.e. one shard of a long video)
+                 end_frame=None, 
+                 warmup_frames=0, # number of frames before start_frame that are detected (but not reconstructed) to warm up the tracker
+                 ):
         self.video_path = Path(video_path)
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        self.warmup_frames = warmup_frames
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.detect = detect
         super().__init__(self.video_path.parent, output_dir, 
                 processed_subfolder,
-                 face_detector,
-                 face_detector_threshold,
-                 image_size,
-                 scale,
-                 device)
+                 face_detector=face_detector,
+                 face_detector_threshold=face_detector_threshold,
+                 image_size=image_size,
+                 scale=scale,
+                 device=device, 
+                 unpack_videos=unpack_videos,
+                 save_detection_images=save_detection_images,
+                 keep_detections_in_memory=not save_detection_images,
+                 face_detector_batch_size=face_detector_batch_size,
+                 face_tracking=face_tracking and detect, # nothing to track if the frames are already detections
+                 tracking_keyframe_interval=tracking_keyframe_interval,
+                 )
     
     def prepare_data(self, *args, **kwargs):
         outdir = Path(self.output_dir)
@@ -3189,7 +3425,8 @@ class TestFaceVideoDM(FaceVideoDataModule):
             return
         # else:
         self._gather_data(exist_ok=True)
-        self._unpack_videos() 
+        if self.unpack_videos:
+            self._unpack_videos() 
         # if self.detect:
         self._detect_faces()
         # else: 
@@ -3212,27 +3449,60 @@ class TestFaceVideoDM(FaceVideoDataModule):
         self.annotation_list = []
         self._gather_video_metadata()
 
-    def _detect_faces_in_image(self, image_path, detected_faces=None):
-        if self.detect:
-            return super()._detect_faces_in_image(image_path, None)
-        else: 
-            # the image is already a detection 
+    def _full_image_detection(self, image_path):
+        # the image is already a detection 
+        if isinstance(image_path, np.ndarray):
+            # a frame streamed from the video
+            height, width = image_path.shape[:2]
+        else:
             # get the size of the image from image_path using PIL 
             img = Image.open(image_path, mode="r") # mode=r does not load the whole image
             #get the image dimensions 
             width, height = img.size
-            detected_faces = [np.array([0,0, width, height]) ]
+        return [np.array([0,0, width, height]) ]
+
+    def _detect_faces_in_image(self, image_path, detected_faces=None):
+        if self.detect:
+            return super()._detect_faces_in_image(image_path, None)
+        else: 
+            detected_faces = self._full_image_detection(image_path)
             return super()._detect_faces_in_image(image_path, detected_faces)
 
+    def _detect_faces_in_images(self, image_paths, detected_faces=None):
+        if self.detect:
+            return super()._detect_faces_in_images(image_paths, None)
+        else: 
+            detected_faces = [self._full_image_detection(image_path) for image_path in image_paths]
+            return super()._detect_faces_in_images(image_paths, detected_faces)
+
+    def _get_frame_range(self, sequence_id):
+        start, end = super()._get_frame_range(sequence_id)
+        if self.end_frame is not None:
+            end = min(self.end_frame, end)
+        return max(self.start_frame - self.warmup_frames, start), end
+
+    def _get_num_warmup_frames(self, sequence_id):
+        return self.start_frame - self._get_frame_range(sequence_id)[0]
+
     def _get_path_to_sequence_results(self, sequence_id, rec_method='EMOCA', suffix=''):
         return self._get_path_to_sequence_files(sequence_id, "results", rec_method, suffix)
 
-    def _get_reconstructions_for_sequence(self, sid, rec_method='emoca', retarget_suffix=None, image_type=None, out_folder=None):
+    def _get_reconstruction_folder(self, sid, rec_method='emoca', retarget_suffix=None, out_folder=None):
+        # the reconstructions of the faces are in <folder>/<detection name>/<image type>.png
         if out_folder is None:
-            out_folder = self._get_path_to_sequence_results(sid, rec_method=rec_method, 
-                suffix=retarget_suffix)
-        else: 
-            out_folder = Path(out_folder)
+            return self._get_path_to_sequence_results(sid, rec_method=rec_method, suffix=retarget_suffix)
+        return Path(out_folder)
+
+    def _get_reconstruction_file(self, reconstruction_folder, detection_name, image_type):
+        # the reconstruction of one face, None if it has not been reconstructed
+        vis_name = Path(reconstruction_folder) / detection_name / (image_type + ".png")
+        if vis_name.is_file():
+            return vis_name
+        return None
+
+    def _get_reconstructions_for_sequence(self, sid, rec_method='emoca', retarget_suffix=None, image_type=None, out_folder=None):
+        out_folder = self._get_reconstruction_folder(sid, rec_method=rec_method, retarget_suffix=retarget_suffix, 
+            out_folder=out_folder)
         if image_type is None:
             image_type = "geometry_detail"
         assert image_type in ["geometry_detail", "geometry_coarse", "out_im_detail", "out_im_coarse"], f"Invalid image type: '{image_type}'"
@@ -3261,12 +3531,40 @@ class TestFaceVideoDM(FaceVideoDataModule):
         return out_folder
 
     def setup(self, stage: Optional[str] = None):
-        sequence_ids = [0]
-        images = []
+        # the frame -> faces index travels with every crop through the DataLoader (see create_reconstruction_frames)
+        self.testdata = self._get_detection_test_data([0])
+
+    def _get_detection_test_data(self, sequence_ids):
+        """
+        The face crops of the sequences with their frame -> faces index (a DetectionIndexedData), all straight from 
+        the records of the detection stores: the crops are read from the store (or from the detection images if 
+        they were saved) one at a time, only the numeric index columns are in memory.
+        """
+        images, image_names, index = None, None, []
         for sid in sequence_ids:
-            detection_path = self._get_path_to_sequence_detections(sid)
-            images += sorted(list(detection_path.glob("*.png")))
-        self.testdata = TestData(images, iscrop=False)
+            store = self._get_detection_store(sid)
+            if store is None or not (self.save_detection_images or store.store_crops):
+                # the detections of an older run have neither the crops in the store nor as images
+                self._detect_faces_in_sequence(sid)
+                store = self._get_detection_store(sid)
+            # the detections of the warmup frames were only needed by the tracker
+            start_frame_id = self._get_frame_range(sid)[0] + self._get_num_warmup_frames(sid)
+            if self.save_detection_images:
+                sequence_images = store.detection_names(start_frame_id, folder=self._get_detection_folder(store))
+            else:
+                sequence_images = store.crop_view(start_frame_id)
+            names = store.detection_names(start_frame_id)
+            images = sequence_images if images is None else images + sequence_images
+            image_names = names if image_names is None else image_names + names
+            index += [store.detection_index(start_frame_id)]
+        if images is None:
+            return DetectionIndexedData(InMemoryTestData([], []), [], [], [], [])
+        if self.save_detection_images:
+            testdata = TestData(images, iscrop=False, sort=False)
+        else:
+            testdata = InMemoryTestData(images, image_names)
+        frame_ids, face_ids, centers, sizes = [np.concatenate(column) for column in zip(*index)]
+        return DetectionIndexedData(testdata, frame_ids, face_ids, centers, sizes)
 
 
     def test_dataloader(self, *args, **kwargs) -> Union[DataLoader, List[DataLoader]]:
@@ -19,32 +19,36 @@ All rights reserved.
 
 
 import pickle as pkl
-import compress_pickle as cpkl
-import hickle as hkl
+# compress_pickle and hickle are imported by the functions that use them (they are not needed for inference)
 from pathlib import Path
 import numpy as np
 from timeit import default_timer as timer
 
 
 def load_reconstruction_list(filename):
+    import hickle as hkl
     reconstructions = hkl.load(filename)
     return reconstructions
 
 
 def save_reconstruction_list(filename, reconstructions):
+    import hickle as hkl
     hkl.dump(reconstructions, filename)
 
 
 def load_emotion_list(filename):
+    import hickle as hkl
     emotions = hkl.load(filename)
     return emotions
 
 
 def save_emotion_list(filename, emotions):
+    import hickle as hkl
     hkl.dump(emotions, filename)
 
 
 def save_segmentation_list(filename, seg_images, seg_types, seg_names):
+    import compress_pickle as cpkl
     with open(filename, "wb") as f:
         # for some reason compressed pickle can only load one object (EOF bug)
         # so put it in the list
@@ -54,6 +58,7 @@ def save_segmentation_list(filename, seg_images, seg_types, seg_names):
 
 
 def load_segmentation_list(filename):
+    import compress_pickle as cpkl
     try:
         with open(filename, "rb") as f:
             seg = cpkl.load(f, compression='gzip')
@@ -67,6 +72,7 @@ def load_segmentation_list(filename):
 
 
 def load_segmentation(filename):
+    import compress_pickle as cpkl
     with open(filename, "rb") as f:
         seg = cpkl.load(f, compression='gzip')
         seg_type = seg[0]
@@ -78,6 +84,7 @@ def load_segmentation(filename):
 
 
 def save_segmentation(filename, seg_image, seg_type):
+    import compress_pickle as cpkl
     with open(filename, "wb") as f:
         # for some reason compressed pickle can only load one object (EOF bug)
         # so put it in the list
@@ -87,6 +94,7 @@ def save_segmentation(filename, seg_image, seg_type):
 
 
 def load_segmentation(filename):
+    import compress_pickle as cpkl
     with open(filename, "rb") as f:
         seg = cpkl.load(f, compression='gzip')
         seg_type = seg[0]
@@ -97,6 +105,7 @@ def load_segmentation(filename):
 
 
 def save_emotion(filename, emotion_features, emotion_type, version=0):
+    import compress_pickle as cpkl
     with open(filename, "wb") as f:
         # for some reason compressed pickle can only load one object (EOF bug)
         # so put it in the list
@@ -104,6 +113,7 @@ def save_emotion(filename, emotion_features, emotion_type, version=0):
 
 
 def load_emotion(filename):
+    import compress_pickle as cpkl
     with open(filename, "rb") as f:
         emo = cpkl.load(f, compression='gzip')
         version = emo[0]
@@ -19,8 +19,12 @@ All rights reserved.
 
 
 import numpy as np
+import torch
+import torch.nn.functional as F
 from skimage.transform import estimate_transform, warp
 
+from gdl.utils.Instrumentation import timed
+
 
 def bbox2point(left, right, top, bottom, type='bbox'):
     ''' bbox from detector and landmarks are different
@@ -66,6 +70,7 @@ def point2transform(center, size, target_size_height, target_size_width):
     return tform
 
 
+@timed()
 def bbpoint_warp(image, center, size, target_size_height, target_size_width=None, output_shape=None, inv=True, landmarks=None, 
         order=3 # order of interpolation, bicubic by default
         ):
@@ -93,4 +98,30 @@ def bbpoint_warp(image, center, size, target_size_height, target_size_width=None
             dst_landmarks[key] = tf_lmk(landmarks[key][:, :2])
     else: 
         raise ValueError("landmarks must be np.ndarray, list or dict")
-    return dst_image, dst_landmarks
\ No newline at end of file
+    return dst_image, dst_landmarks
+
+
+@timed()
+def bbpoint_warp_torch(images, centers, sizes, output_shape):
+    """
+    Batched torch version of bbpoint_warp(image, center, size, image.shape[0], output_shape=output_shape, inv=False, order=1), 
+    i.e. places square crops back into the full frame. Runs on the device of the images. 
+    images: [N, C, h, h] crops
+    centers: [N, 2] crop centers (x, y) in the frame
+    sizes: [N] crop sizes in the frame
+    output_shape: (height, width) of the frame
+    returns: [N, C, height, width]
+    """
+    N = images.shape[0]
+    height, width = output_shape
+    centers = torch.as_tensor(np.asarray(centers), dtype=images.dtype, device=images.device).view(N, 2)
+    sizes = torch.as_tensor(np.asarray(sizes), dtype=images.dtype, device=images.device).view(N)
+    # the similarity of point2transform maps frame pixel x to crop pixel (x - center + size / 2) * (h - 1) / size, 
+    # which in normalized coordinates of both images (align_corners=True) is the following affine map
+    theta = torch.zeros((N, 2, 3), dtype=images.dtype, device=images.device)
+    theta[:, 0, 0] = (width - 1) / sizes
+    theta[:, 0, 2] = (width - 1 - 2 * centers[:, 0]) / sizes
+    theta[:, 1, 1] = (height - 1) / sizes
+    theta[:, 1, 2] = (height - 1 - 2 * centers[:, 1]) / sizes
+    grid = F.affine_grid(theta, (N, images.shape[1], height, width), align_corners=True)
+    return F.grid_sample(images, grid, mode='bilinear', padding_mode='zeros', align_corners=True)
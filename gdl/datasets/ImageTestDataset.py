@@ -34,11 +34,30 @@ from gdl.utils.FaceDetector import FAN
 
 import os
 
+
+def _precropped_image_to_tensor(image, crop_size):
+    """
+    A uint8 face crop ([h, w], [h, w, 3] or [h, w, 4]) to the [3, crop_size, crop_size] float tensor of the model, 
+    resized with cv2 if it is not crop_size yet.
+    """
+    if len(image.shape) == 2:
+        image = np.tile(image[:, :, None], (1, 1, 3))
+    if len(image.shape) == 3 and image.shape[2] > 3:
+        image = image[:, :, :3]
+    if image.shape[0] != crop_size or image.shape[1] != crop_size:
+        image = cv2.resize(image, (crop_size, crop_size), interpolation=cv2.INTER_LINEAR)
+    image = image.astype(np.float32) / 255.
+    return torch.from_numpy(image.transpose(2, 0, 1).copy())
+
+
 class TestData(Dataset):
     def __init__(self, testpath, iscrop=True, crop_size=224, scale=1.25, face_detector='fan',
-                 scaling_factor=1.0, max_detection=None):
+                 scaling_factor=1.0, max_detection=None, 
+                 sort=True, # if False, the images stay in the given order (i.e. the order of their detection index)
+                 ):
         self.max_detection = max_detection
-        if isinstance(testpath, list):
+        if not isinstance(testpath, str):
+            # a list of image paths (or a sequence that derives them, such as DetectionStore.detection_names)
             self.imagepath_list = testpath
         elif os.path.isdir(testpath):
             self.imagepath_list = glob(testpath + '/*.jpg') + glob(testpath + '/*.png') + glob(testpath + '/*.bmp')
@@ -50,7 +69,8 @@ class TestData(Dataset):
             print(f'please check the test path: {testpath}')
             exit()
         print('total {} images'.format(len(self.imagepath_list)))
-        self.imagepath_list = sorted(self.imagepath_list)
+        if sort:
+            self.imagepath_list = sorted(self.imagepath_list)
         self.scaling_factor = scaling_factor
         self.crop_size = crop_size
         self.scale = scale
@@ -58,13 +78,27 @@ class TestData(Dataset):
         self.resolution_inp = crop_size
         # add_pretrained_deca_to_path()
         # from decalib.datasets import detectors
-        if face_detector == 'fan':
-            self.face_detector = FAN()
+        if face_detector not in ['fan']:
         # elif face_detector == 'mtcnn':
         #     self.face_detector = detectors.MTCNN()
-        else:
             print(f'please check the detector: {face_detector}')
             exit()
+        self.face_detector_type = face_detector
+        # the detector is only created once a crop actually needs it (it is not needed if iscrop=False)
+        self._face_detector = None
+
+    @property
+    def face_detector(self):
+        if self._face_detector is None:
+            if self.face_detector_type == 'fan':
+                self._face_detector = FAN()
+        return self._face_detector
+
+    def __getstate__(self):
+        # do not pickle the detector into the dataloader workers, each of them creates its own if need be
+        state = self.__dict__.copy()
+        state['_face_detector'] = None
+        return state
 
     def __len__(self):
         return len(self.imagepath_list)
@@ -83,6 +117,13 @@ class TestData(Dataset):
             image = rescale(image, (self.scaling_factor, self.scaling_factor, 1))*255.
 
         h, w, _ = image.shape
+        # a crop of the input resolution would go through an identity warp, other sizes keep the skimage warp below
+        if not self.iscrop and h == w == self.resolution_inp and image.dtype == np.uint8:
+            return {'image': _precropped_image_to_tensor(image, self.resolution_inp),
+                    'image_name': imagename,
+                    'image_path': imagepath,
+                    }
+
         if self.iscrop:
             # provide kpt as txt file, or mat file (for AFLW2000)
             kpt_matpath = imagepath.replace('.jpg', '.mat').replace('.png', '.mat')
@@ -181,6 +222,58 @@ class TestData(Dataset):
 
 
 
+class InMemoryTestData(Dataset):
+    """
+    Test dataset over face crops that are not image files (such as the detections of a video that was 
+    never unpacked to disk). images and image_names are lists or sequences that read them lazily (i.e. the 
+    gdl.datasets.DetectionStore.StoredCrops and StoredDetectionNames of the detection store). The crops are 
+    expected to be already cropped, no face detection is run.
+    """
+
+    def __init__(self, images, image_names, crop_size=224):
+        assert len(images) == len(image_names)
+        self.images = images
+        self.image_names = image_names
+        self.crop_size = crop_size
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        return {'image': _precropped_image_to_tensor(self.images[index], self.crop_size),
+                'image_name': self.image_names[index],
+                'image_path': self.image_names[index],
+                }
+
+
+class DetectionIndexedData(Dataset):
+    """
+    Adds the frame -> faces index of the detections of a video to the crops of a test dataset: the frame id
+    (in the whole video), the face id (among the faces of the frame) and the crop center and size in the frame.
+    The index travels with every crop through the DataLoader, so a batch can pack the faces of any number of frames
+    and its outputs are placed back into their frames by index, not by matching the file names.
+    """
+
+    def __init__(self, dataset, frame_ids, face_ids, centers, sizes):
+        assert len(dataset) == len(frame_ids) == len(face_ids) == len(centers) == len(sizes)
+        self.dataset = dataset
+        self.frame_ids = np.asarray(frame_ids, dtype=np.int64)
+        self.face_ids = np.asarray(face_ids, dtype=np.int64)
+        self.centers = np.asarray(centers, dtype=np.float32).reshape(-1, 2)
+        self.sizes = np.asarray(sizes, dtype=np.float32).reshape(-1)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        sample = self.dataset[index]
+        sample['frame_id'] = torch.tensor(self.frame_ids[index])
+        sample['face_id'] = torch.tensor(self.face_ids[index])
+        sample['center'] = torch.from_numpy(self.centers[index])
+        sample['size'] = torch.tensor(self.sizes[index])
+        return sample
+
+
 def video2sequence(video_path):
     videofolder = video_path.split('.')[0]
     util.check_mkdir(videofolder)
@@ -27,7 +27,6 @@ from torchvision.transforms import ToTensor
 from gdl.utils.FaceDetector import load_landmark
 from gdl.datasets.FaceAlignmentTools import align_face
 
-from skvideo.io import vread, vreader 
 from types import GeneratorType
 import pickle as pkl
 
@@ -54,8 +53,10 @@ class VideoFaceDetectionDataset(torch.utils.data.Dataset):
 
         self.video_frames = None 
         if self.vid_read == "skvread": 
+            from skvideo.io import vread
             self.video_frames = vread(str(self.video_name))
         elif self.vid_read == "skvreader": 
+            from skvideo.io import vreader
             self.video_frames = vreader(str(self.video_name))
 
         with open(self.landmark_path, "rb") as f: 
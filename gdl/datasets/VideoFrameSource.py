@@ -0,0 +1,194 @@
+"""
+Author: Radek Danecek
+Copyright (c) 2022, Radek Danecek
+All rights reserved.
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms
+# in the LICENSE file included with this software distribution.
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2022 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at emoca@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+"""
+
+import subprocess
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+
+
+VideoFrame = namedtuple("VideoFrame", ["index", "pts", "image"])
+
+
+def parse_frame_rate(fps):
+    """
+    Converts an ffprobe frame rate ('30000/1001', '25' or a number) into a float.
+    """
+    if isinstance(fps, str):
+        if "/" in fps:
+            num, den = fps.split("/")
+            return float(num) / float(den) if float(den) != 0 else 0.
+        return float(fps)
+    return float(fps)
+
+
+class VideoFrameSource(object):
+    """
+    Decodes a video once through a persistent ffmpeg rawvideo pipe and yields the frames as RGB uint8 numpy
+    arrays (HxWx3), together with their frame index and presentation timestamp.
+
+    The frames are decoded in presentation order without any frame rate conversion (-vsync passthrough),
+    so the frame indices match the frames of an unpacked PNG directory (see write_frames).
+
+    The geometry is taken from the video meta (as gathered by FaceVideoDataModule._gather_video_metadata),
+    if it is not given, the video is probed.
+
+    A source starting at start_frame > 0 seeks there (see _seek_args) instead of decoding and dropping all 
+    the frames before it.
+
+    Usage:
+        source = VideoFrameSource(video_path, video_meta)
+        for frame in source:
+            frame.index, frame.pts, frame.image
+    """
+
+    def __init__(self, video_path, video_meta=None, start_frame=0, end_frame=None, hwaccel=None, ffmpeg="ffmpeg"):
+        self.video_path = Path(video_path)
+        self.video_meta = video_meta or VideoFrameSource.probe(self.video_path)
+        self.width = int(self.video_meta['width'])
+        self.height = int(self.video_meta['height'])
+        self.num_frames = int(self.video_meta.get('num_frames', 0))
+        self.fps = parse_frame_rate(self.video_meta.get('fps', 0))
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        # i.e. 'cuda', 'videotoolbox' or 'auto', None decodes on the CPU. The frames are piped back as rgb24 either way
+        self.hwaccel = hwaccel
+        self.ffmpeg = ffmpeg
+        self._timestamps = None
+        # whether the timestamps were read from the packets (only then they can be used to seek)
+        self._exact_timestamps = False
+
+    @staticmethod
+    def probe(video_path):
+        import ffmpeg
+        vid = ffmpeg.probe(str(video_path))
+        vid_info = [stream for stream in vid['streams'] if stream['codec_type'] == 'video'][0]
+        video_meta = {}
+        video_meta['fps'] = vid_info['avg_frame_rate']
+        video_meta['width'] = int(vid_info['width'])
+        video_meta['height'] = int(vid_info['height'])
+        video_meta['num_frames'] = int(vid_info.get('nb_frames', 0))
+        return video_meta
+
+    @property
+    def shape(self):
+        return (self.height, self.width, 3)
+
+    def __len__(self):
+        end_frame = self.end_frame if self.end_frame is not None else self.num_frames
+        return max(end_frame - self.start_frame, 0)
+
+    def timestamps(self):
+        """
+        Presentation timestamps (in seconds) of all the frames of the video. They are read from the packets
+        (no decoding). If that fails, they are computed from the frame rate.
+        """
+        if self._timestamps is not None:
+            return self._timestamps
+        try:
+            out = subprocess.check_output(["ffprobe", "-v", "error", "-select_streams", "v:0",
+                "-show_entries", "packet=pts_time", "-of", "csv=p=0", str(self.video_path)])
+            timestamps = sorted([float(line.strip().strip(",")) for line in out.decode().splitlines()
+                if len(line.strip().strip(",")) > 0 and line.strip().strip(",") != "N/A"])
+        except (subprocess.CalledProcessError, FileNotFoundError, ValueError):
+            timestamps = []
+        self._exact_timestamps = len(timestamps) > 0
+        if len(timestamps) == 0 and self.fps > 0:
+            timestamps = [fid / self.fps for fid in range(self.num_frames)]
+        self._timestamps = timestamps
+        return self._timestamps
+
+    def _pts(self, fid):
+        timestamps = self.timestamps()
+        if fid < len(timestamps):
+            return timestamps[fid]
+        return fid / self.fps if self.fps > 0 else None
+
+    def _seek_args(self):
+        """
+        Returns the (input options, output options) that start the decoding at start_frame or None if the source 
+        cannot seek. ffmpeg seeks to the last keyframe a few frames before start_frame (so only the frames from 
+        there on are decoded), keeps the original timestamps and the frames before start_frame are dropped by their
+        timestamp. The decoded frames are the same as when decoding from the beginning.
+        """
+        timestamps = self.timestamps()
+        if not self._exact_timestamps or self.start_frame >= len(timestamps):
+            return None
+        frame_time = timestamps[self.start_frame]
+        # half way to the previous frame, robust to the rounding of the printed timestamps
+        threshold = (frame_time + timestamps[self.start_frame - 1]) / 2
+        # seek positions are relative to the start of the file, which is at (or before) the first video frame
+        seek_time = max(frame_time - timestamps[0] - 5. / max(self.fps, 1.), 0.)
+        input_args = ["-noaccurate_seek", "-ss", "%.6f" % seek_time, "-copyts"]
+        output_args = ["-vf", "select=gte(t\\,%.6f)" % threshold]
+        if self.end_frame is not None:
+            output_args += ["-frames:v", str(max(self.end_frame - self.start_frame, 0))]
+        return input_args, output_args
+
+    def _command(self):
+        cmd = [self.ffmpeg, "-v", "error", "-nostdin"]
+        if self.hwaccel is not None:
+            cmd += ["-hwaccel", self.hwaccel]
+        seek_args = self._seek_args() if self.start_frame > 0 else None
+        input_args, output_args = seek_args if seek_args is not None else ([], [])
+        cmd += input_args + ["-i", str(self.video_path), "-map", "0:v:0", "-vsync", "0"] + output_args
+        if seek_args is None and (self.start_frame > 0 or self.end_frame is not None):
+            # the frames before start_frame are decoded and dropped
+            select = "gte(n\\,%d)" % self.start_frame
+            if self.end_frame is not None:
+                select += "*lt(n\\,%d)" % self.end_frame
+            cmd += ["-vf", "select=%s" % select]
+        cmd += ["-f", "rawvideo", "-pix_fmt", "rgb24", "-"]
+        return cmd
+
+    def images(self):
+        """
+        Generator of the decoded frames only (HxWx3 uint8), a drop-in replacement for skvideo.io.vreader.
+        """
+        frame_size = self.width * self.height * 3
+        process = subprocess.Popen(self._command(), stdout=subprocess.PIPE, bufsize=frame_size)
+        try:
+            while True:
+                # read straight into the (writable) frame array, no intermediate bytes copy
+                image = np.empty(self.shape, dtype=np.uint8)
+                if process.stdout.readinto(memoryview(image).cast("B")) < frame_size:
+                    break
+                yield image
+        finally:
+            process.stdout.close()
+            if process.poll() is None:
+                # the consumer stopped before the end of the video
+                process.kill()
+            process.wait()
+
+    def __iter__(self):
+        for fid, image in enumerate(self.images(), start=self.start_frame):
+            yield VideoFrame(fid, self._pts(fid), image)
+
+    def write_frames(self, out_format):
+        """
+        Unpacks the frames into images (the optional on-disk cache), i.e. out_format = 'frames/%06d.png'.
+        Uses the same decoding settings as the pipe, so the n-th image is the n-th frame yielded by the source.
+        """
+        cmd = [self.ffmpeg, "-v", "error", "-nostdin"]
+        if self.hwaccel is not None:
+            cmd += ["-hwaccel", self.hwaccel]
+        cmd += ["-i", str(self.video_path), "-map", "0:v:0", "-vsync", "0", str(out_format)]
+        subprocess.run(cmd, check=True)
@@ -22,14 +22,12 @@ https://github.com/YadiraF/DECA/
 
 
 import os, sys
+import contextlib
 import torch
 import torchvision
 import torch.nn.functional as F
 import torchvision.transforms.functional as F_v
-import adabound
 from pytorch_lightning import LightningModule
-from pytorch_lightning.loggers import WandbLogger
-from gdl.layers.losses.EmoNetLoss import EmoNetLoss, create_emo_loss, create_au_loss
 import numpy as np
 # from time import time
 from skimage.io import imread
@@ -41,23 +39,27 @@ from gdl.models.Renderer import SRenderY
 from gdl.models.DecaEncoder import ResnetEncoder, SecondHeadResnet, SwinEncoder
 from gdl.models.DecaDecoder import Generator, GeneratorAdaIn
 from gdl.models.DecaFLAME import FLAME, FLAMETex, FLAME_mediapipe
-from gdl.models.EmotionMLP import EmotionMLP
+from gdl.utils.AssetBundle import get_asset_bundle, load_assets
 
-import gdl.layers.losses.DecaLosses as lossfunc
 import gdl.layers.losses.MediaPipeLandmarkLosses as lossfunc_mp
 import gdl.utils.DecaUtils as util
-from gdl.datasets.AffWild2Dataset import Expression7
-from gdl.datasets.AffectNetDataModule import AffectNetExpressions
-from gdl.utils.lightning_logging import _log_array_image, _log_wandb_image, _torch_image2np
 
 torch.backends.cudnn.benchmark = True
 from enum import Enum
 from gdl.utils.other import class_from_str, get_path_to_assets
-from gdl.layers.losses.VGGLoss import VGG19Loss
+from gdl.utils.Instrumentation import timed
 from omegaconf import OmegaConf, open_dict
 
 import pytorch_lightning.plugins.environments.lightning_environment as le
 
+# The training-only dependencies (losses, optimizers, loggers, datasets) are imported on first use, 
+# so that loading a model for inference does not pull them in.
+
+
+def _is_wandb_logger(logger):
+    from pytorch_lightning.loggers import WandbLogger
+    return isinstance(logger, WandbLogger)
+
 
 class DecaMode(Enum):
     COARSE = 1 # when switched on, only coarse part of DECA-based networks is used
@@ -141,10 +143,15 @@ class DecaModule(LightningModule):
         # MPL regressor from the encoded space to emotion labels (not used in EMOCA but could be used for direct emotion supervision)
         if 'mlp_emotion_predictor' in self.deca.config.keys():
             # self._build_emotion_mlp(self.deca.config.mlp_emotion_predictor)
+            from gdl.models.EmotionMLP import EmotionMLP
             self.emotion_mlp = EmotionMLP(self.deca.config.mlp_emotion_predictor, model_params)
         else:
             self.emotion_mlp = None
 
+        # precision and memory format of the encoders and the detail decoder at inference (see set_inference_precision)
+        self.inference_precision = 'fp32'
+        self.inference_channels_last = False
+
     def get_input_image_size(self): 
         return (self.deca.config.image_size, self.deca.config.image_size)
 
@@ -194,6 +201,7 @@ class DecaModule(LightningModule):
             emo_feat_loss = self.deca.config.emo_feat_loss if 'emo_feat_loss' in self.deca.config.keys() else None
             old_emonet_loss = self.emonet_loss
 
+            from gdl.layers.losses.EmoNetLoss import create_emo_loss
             self.emonet_loss = create_emo_loss(self.device, emoloss=emonet_model_path, trainable=emoloss_trainable,
                                                dual=emoloss_dual,
                                                normalize_features=normalize_features,
@@ -226,6 +234,7 @@ class DecaModule(LightningModule):
                     print("The old AU loss is not trainable. It will be replaced.")
 
             old_au_loss = self.emonet_loss
+            from gdl.layers.losses.EmoNetLoss import create_au_loss
             self.au_loss = create_au_loss(self.device, self.deca.config.au_loss)
         else:
             self.au_loss = None
@@ -357,6 +366,57 @@ class DecaModule(LightningModule):
         values = self.decode(values, training=False)
         return values
 
+    # autocast dtypes of the inference precisions, None runs in fp32
+    _inference_dtypes = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+    def set_inference_precision(self, precision='fp32', channels_last=False):
+        """
+        Sets how the networks run at inference (in eval mode). The encoders (E_flame, E_expression, E_detail) and the 
+        detail decoder run under 'fp32', 'bf16' or 'fp16' autocast and, if channels_last, in the channels_last memory 
+        format. Their outputs are cast back to fp32, so FLAME (LBS), the renderer and the rasterizer always run in fp32. 
+        bf16 is also supported on the CPU, fp16 only on the GPU. Training is not affected.
+        """
+        if precision not in DecaModule._inference_dtypes:
+            raise ValueError(f"Invalid inference precision '{precision}', "
+                             f"supported: {list(DecaModule._inference_dtypes.keys())}")
+        self.inference_precision = precision
+        self.inference_channels_last = channels_last
+        memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        for name in ['E_flame', 'E_expression', 'E_detail', 'D_detail']:
+            net = getattr(self.deca, name, None)
+            if net is not None:
+                net.to(memory_format=memory_format)
+        return self
+
+    def _inference_autocast(self, device):
+        """
+        The autocast context the networks run in, a no-op when training or in fp32.
+        """
+        dtype = DecaModule._inference_dtypes[self.inference_precision]
+        if dtype is None or self.training:
+            return contextlib.nullcontext()
+        if device.type == 'cpu' and dtype == torch.float16:
+            raise ValueError("fp16 autocast is not supported on the CPU, use 'bf16' instead")
+        return torch.autocast(device_type=device.type, dtype=dtype)
+
+    def _to_inference_format(self, images):
+        if self.inference_channels_last and not self.training:
+            return images.contiguous(memory_format=torch.channels_last)
+        return images
+
+    @staticmethod
+    def _to_fp32(values):
+        """
+        Casts the (possibly nested) network outputs back to fp32.
+        """
+        if isinstance(values, torch.Tensor):
+            return values.float()
+        if isinstance(values, (list, tuple)):
+            return type(values)(DecaModule._to_fp32(v) for v in values)
+        if isinstance(values, dict):
+            return {k: DecaModule._to_fp32(v) for k, v in values.items()}
+        return values
+
     def _unwrap_list(self, codelist): 
         shapecode, texcode, expcode, posecode, cam, lightcode = codelist
         return shapecode, texcode, expcode, posecode, cam, lightcode
@@ -371,13 +431,15 @@ class DecaModule(LightningModule):
         if self.mode == DecaMode.COARSE or \
                 (self.mode == DecaMode.DETAIL and self.deca.config.train_coarse):
             # forward pass with gradients (for coarse stage (used), or detail stage with coarse training (not used))
-            parameters = self.deca._encode_flame(images)
+            with self._inference_autocast(images.device):
+                parameters = self.deca._encode_flame(self._to_inference_format(images))
         elif self.mode == DecaMode.DETAIL:
             # in detail stage, the coarse forward pass does not need gradients
-            with torch.no_grad():
-                parameters = self.deca._encode_flame(images)
+            with torch.no_grad(), self._inference_autocast(images.device):
+                parameters = self.deca._encode_flame(self._to_inference_format(images))
         else:
             raise ValueError(f"Invalid EMOCA Mode {self.mode}")
+        parameters = self._to_fp32(parameters)
         code_list, original_code = self.deca.decompose_code(parameters)
         # shapecode, texcode, expcode, posecode, cam, lightcode = code_list
         # return shapecode, texcode, expcode, posecode, cam, lightcode, original_code
@@ -466,6 +528,7 @@ class DecaModule(LightningModule):
         # return expcode, posecode, shapecode, lightcode, texcode, images, cam, lmk, masks, va, expr7
 
 
+    @timed()
     def encode(self, batch, training=True) -> dict:
         """
         Forward encoding pass of the model. Takes a batch of images and returns the corresponding latent codes for each image.
@@ -741,7 +804,8 @@ class DecaModule(LightningModule):
 
         # 2) DETAIL STAGE
         if self.mode == DecaMode.DETAIL:
-            all_detailcode = self.deca.E_detail(images)
+            with self._inference_autocast(images.device):
+                all_detailcode = self.deca.E_detail(self._to_inference_format(images)).float()
 
             # identity-based detail code
             detailcode = all_detailcode[:, :self.deca.n_detail]
@@ -935,12 +999,18 @@ class DecaModule(LightningModule):
         return detail_conditioning_list
 
 
-    def decode(self, codedict, training=True, render=True, **kwargs) -> dict:
+    @timed()
+    def decode(self, codedict, training=True, render=True, outputs=None, **kwargs) -> dict:
         """
         Forward decoding pass of the model. Takes the latent code predicted by the encoding stage and reconstructs and renders the shape.
         :param codedict: Batch dict of the predicted latent codes
         :param training: Whether the forward pass is for training or testing.
+        :param outputs: Optional set of the requested outputs (i.e. {"geometry_detail"} or {"verts", "trans_verts"}). 
+            If specified, only these and the values they depend on are computed (see DecaModule.decode_outputs).
         """
+        if outputs is not None:
+            return self.decode_outputs(codedict, outputs)
+
         shapecode = codedict['shapecode']
         expcode = codedict['expcode']
         posecode = codedict['posecode']
@@ -956,23 +1026,8 @@ class DecaModule(LightningModule):
         effective_batch_size = images.shape[0]  # this is the current batch size after all training augmentations modifications
 
         # 1) Reconstruct the face mesh
-        # FLAME - world space
-        if not isinstance(self.deca.flame, FLAME_mediapipe):
-            verts, landmarks2d, landmarks3d = self.deca.flame(shape_params=shapecode, expression_params=expcode,
-                                                          pose_params=posecode)
-            landmarks2d_mediapipe = None
-        else:
-            verts, landmarks2d, landmarks3d, landmarks2d_mediapipe = self.deca.flame(shapecode, expcode, posecode)
-        # world to camera
-        trans_verts = util.batch_orth_proj(verts, cam)
-        predicted_landmarks = util.batch_orth_proj(landmarks2d, cam)[:, :, :2]
-        # camera to image space
-        trans_verts[:, :, 1:] = -trans_verts[:, :, 1:]
-        predicted_landmarks[:, :, 1:] = - predicted_landmarks[:, :, 1:]
-
-        if landmarks2d_mediapipe is not None:
-            predicted_landmarks_mediapipe = util.batch_orth_proj(landmarks2d_mediapipe, cam)[:, :, :2]
-            predicted_landmarks_mediapipe[:, :, 1:] = - predicted_landmarks_mediapipe[:, :, 1:]
+        verts, landmarks2d, landmarks3d, landmarks2d_mediapipe, trans_verts, predicted_landmarks, predicted_landmarks_mediapipe = \
+            self._reconstruct_mesh(shapecode, expcode, posecode, cam)
 
         if self.uses_texture():
             albedo = self.deca.flametex(texcode)
@@ -1052,28 +1107,7 @@ class DecaModule(LightningModule):
 
         # 3) Render the detail image
         if self.mode == DecaMode.DETAIL:
-            detailcode = codedict['detailcode']
-            detailemocode = codedict['detailemocode']
-
-            # a) Create the detail conditioning lists
-            detail_conditioning_list = self._create_conditioning_lists(codedict, self.detail_conditioning)
-            detailemo_conditioning_list = self._create_conditioning_lists(codedict, self.detailemo_conditioning)
-            final_detail_conditioning_list = detail_conditioning_list + detailemo_conditioning_list
-
-
-            # b) Pass the detail code and the conditions through the detail generator to get displacement UV map
-            if isinstance(self.deca.D_detail, Generator):
-                uv_z = self.deca.D_detail(torch.cat(final_detail_conditioning_list, dim=1))
-            elif isinstance(self.deca.D_detail, GeneratorAdaIn):
-                uv_z = self.deca.D_detail(z=torch.cat([detailcode, detailemocode], dim=1),
-                                          cond=torch.cat(final_detail_conditioning_list, dim=1))
-            else:
-                raise ValueError(f"This class of generarator is not supported: '{self.deca.D_detail.__class__.__name__}'")
-
-            # if there is a displacement mask, apply it (DEPRECATED and not USED in DECA or EMOCA)
-            if hasattr(self.deca, 'displacement_mask') and self.deca.displacement_mask is not None:
-                if 'apply_displacement_masks' in self.deca.config.keys() and self.deca.config.apply_displacement_masks:
-                    uv_z = uv_z * self.deca.displacement_mask
+            uv_z = self._decode_displacement(codedict)
 
             # uv_z = self.deca.D_detail(torch.cat([posecode[:, 3:], expcode, detailcode], dim=1))
             # render detail
@@ -1772,6 +1806,7 @@ class DecaModule(LightningModule):
 
 
     def _compute_loss(self, codedict, batch, training=True, testing=False) -> (dict, dict):
+        import gdl.layers.losses.DecaLosses as lossfunc
         #### ----------------------- Losses
         losses = {}
         metrics = {}
@@ -2315,7 +2350,7 @@ class DecaModule(LightningModule):
                     vis_dict = self._create_visualizations_to_log(stage_str[:-1], visualizations, values, batch_idx, indices=0, dataloader_idx=dataloader_idx)
                     # image = Image(grid_image, caption="full visualization")
                     # vis_dict[prefix + '_val_' + "visualization"] = image
-                    if isinstance(self.logger, WandbLogger):
+                    if _is_wandb_logger(self.logger):
                         self.logger.log_metrics(vis_dict)
 
         return None
@@ -2442,7 +2477,7 @@ class DecaModule(LightningModule):
                                                    uv_detail_normals, values, batch_idx, "train", prefix)
                     visdict = self._create_visualizations_to_log('train', visualizations, values, batch_idx, indices=0)
 
-                    if isinstance(self.logger, WandbLogger):
+                    if _is_wandb_logger(self.logger):
                         self.logger.log_metrics(visdict)#, step=self.global_step)
                         # self.log_dict(visdict, sync_dist=True)
 
@@ -2476,6 +2511,8 @@ class DecaModule(LightningModule):
 
 
     def vae_2_str(self, valence=None, arousal=None, affnet_expr=None, expr7=None, prefix=""):
+        from gdl.datasets.AffWild2Dataset import Expression7
+        from gdl.datasets.AffectNetDataModule import AffectNetExpressions
         caption = ""
         if len(prefix) > 0:
             prefix += "_"
@@ -2492,6 +2529,7 @@ class DecaModule(LightningModule):
 
     def _create_visualizations_to_log(self, stage, visdict, values, step, indices=None,
                                       dataloader_idx=None, output_dir=None):
+        from gdl.utils.lightning_logging import _log_array_image, _log_wandb_image, _torch_image2np
         mode_ = str(self.mode.name).lower()
         prefix = self._get_logging_prefix()
 
@@ -2510,7 +2548,7 @@ class DecaModule(LightningModule):
                 image = np.concatenate([images[i] for i in range(images.shape[0])], axis=1)
                 savepath = Path(f'{output_dir}/{prefix}_{stage}/{key}/{self.current_epoch:04d}_{step:04d}_all.png')
                 # im2log = Image(image, caption=key)
-                if isinstance(self.logger, WandbLogger):
+                if _is_wandb_logger(self.logger):
                     im2log = _log_wandb_image(savepath, image)
                 else:
                     im2log = _log_array_image(savepath, image)
@@ -2577,7 +2615,7 @@ class DecaModule(LightningModule):
                     savepath = Path(f'{output_dir}/{prefix}_{stage}/{key}/{self.current_epoch:04d}_{step:04d}_{i:02d}.png')
                     image = images[i]
                     # im2log = Image(image, caption=caption)
-                    if isinstance(self.logger, WandbLogger):
+                    if _is_wandb_logger(self.logger):
                         im2log = _log_wandb_image(savepath, image, caption)
                     elif self.logger is not None:
                         im2log = _log_array_image(savepath, image, caption)
@@ -2589,6 +2627,144 @@ class DecaModule(LightningModule):
                     log_dict[name] = im2log
         return log_dict
 
+    def _reconstruct_mesh(self, shapecode, expcode, posecode, cam):
+        """
+        Runs FLAME and projects the mesh and the landmarks to the image space.
+        """
+        # FLAME - world space
+        if not isinstance(self.deca.flame, FLAME_mediapipe):
+            verts, landmarks2d, landmarks3d = self.deca.flame(shape_params=shapecode, expression_params=expcode,
+                                                          pose_params=posecode)
+            landmarks2d_mediapipe = None
+        else:
+            verts, landmarks2d, landmarks3d, landmarks2d_mediapipe = self.deca.flame(shapecode, expcode, posecode)
+        # world to camera
+        trans_verts = util.batch_orth_proj(verts, cam)
+        predicted_landmarks = util.batch_orth_proj(landmarks2d, cam)[:, :, :2]
+        # camera to image space
+        trans_verts[:, :, 1:] = -trans_verts[:, :, 1:]
+        predicted_landmarks[:, :, 1:] = - predicted_landmarks[:, :, 1:]
+
+        predicted_landmarks_mediapipe = None
+        if landmarks2d_mediapipe is not None:
+            predicted_landmarks_mediapipe = util.batch_orth_proj(landmarks2d_mediapipe, cam)[:, :, :2]
+            predicted_landmarks_mediapipe[:, :, 1:] = - predicted_landmarks_mediapipe[:, :, 1:]
+        return verts, landmarks2d, landmarks3d, landmarks2d_mediapipe, trans_verts, predicted_landmarks, predicted_landmarks_mediapipe
+
+    def _decode_displacement(self, codedict):
+        """
+        Runs the detail generator to get the displacement UV map (uv_z).
+        """
+        detailcode = codedict['detailcode']
+        detailemocode = codedict['detailemocode']
+
+        # a) Create the detail conditioning lists
+        detail_conditioning_list = self._create_conditioning_lists(codedict, self.detail_conditioning)
+        detailemo_conditioning_list = self._create_conditioning_lists(codedict, self.detailemo_conditioning)
+        final_detail_conditioning_list = detail_conditioning_list + detailemo_conditioning_list
+
+
+        # b) Pass the detail code and the conditions through the detail generator to get displacement UV map
+        with self._inference_autocast(detailcode.device):
+            if isinstance(self.deca.D_detail, Generator):
+                uv_z = self.deca.D_detail(torch.cat(final_detail_conditioning_list, dim=1))
+            elif isinstance(self.deca.D_detail, GeneratorAdaIn):
+                uv_z = self.deca.D_detail(z=torch.cat([detailcode, detailemocode], dim=1),
+                                          cond=torch.cat(final_detail_conditioning_list, dim=1))
+            else:
+                raise ValueError(f"This class of generarator is not supported: '{self.deca.D_detail.__class__.__name__}'")
+        uv_z = uv_z.float()
+
+        # if there is a displacement mask, apply it (DEPRECATED and not USED in DECA or EMOCA)
+        if hasattr(self.deca, 'displacement_mask') and self.deca.displacement_mask is not None:
+            if 'apply_displacement_masks' in self.deca.config.keys() and self.deca.config.apply_displacement_masks:
+                uv_z = uv_z * self.deca.displacement_mask
+        return uv_z
+
+    # outputs that decode_outputs can compute and the intermediate values each of them needs
+    _decode_output_dependencies = {
+        'verts': [],
+        'trans_verts': [],
+        'landmarks2d': [],
+        'landmarks3d': [],
+        'predicted_landmarks': [],
+        'normals': [],
+        'uv_z': [],
+        'displacement_map': ['uv_z'],
+        'uv_detail_normals': ['uv_z', 'normals'],
+        'geometry_coarse': [],
+        'geometry_detail': ['grid', 'uv_detail_normals'],
+    }
+
+    def decode_outputs(self, codedict, outputs) -> dict:
+        """
+        Output-driven version of decode (without training losses and visualizations). Only the requested outputs 
+        and the values they depend on are computed. For instance {"geometry_detail"} skips the albedo, the shading, 
+        the texture extraction and the coarse shape rendering. The values are the same as the ones produced 
+        by decode() followed by _visualization_checkpoint() (except for the depth of trans_verts which the renderer 
+        shifts in place every time it rasterizes). 
+        :param codedict: Batch dict of the predicted latent codes
+        :param outputs: Iterable of the requested outputs, the supported ones are the keys of _decode_output_dependencies
+        """
+        outputs = set(outputs)
+        unsupported = outputs - set(DecaModule._decode_output_dependencies.keys())
+        if len(unsupported) > 0:
+            raise ValueError(f"Outputs {sorted(unsupported)} are not supported by output-driven decoding. "
+                             f"Use decode() without 'outputs' instead.")
+        dependencies = dict(DecaModule._decode_output_dependencies)
+        if not getattr(self.deca.render, 'render_shape_uses_detail_normals', True):
+            # the renderer does not shade the shape, so the detail normals are not needed
+            dependencies['geometry_detail'] = []
+        # resolve the dependencies
+        required = set()
+        to_visit = list(outputs)
+        while len(to_visit) > 0:
+            key = to_visit.pop()
+            if key in required:
+                continue
+            required.add(key)
+            to_visit += dependencies.get(key, [])
+        if self.mode != DecaMode.DETAIL and ('uv_z' in required or 'geometry_detail' in required):
+            raise ValueError(f"Outputs {sorted(outputs)} require the detail model but the model is in {self.mode} mode")
+
+        effective_batch_size = codedict['shapecode'].shape[0]
+        verts, landmarks2d, landmarks3d, landmarks2d_mediapipe, trans_verts, predicted_landmarks, predicted_landmarks_mediapipe = \
+            self._reconstruct_mesh(codedict['shapecode'], codedict['expcode'], codedict['posecode'], codedict['cam'])
+        codedict['verts'] = verts
+        codedict['trans_verts'] = trans_verts
+        codedict['landmarks2d'] = landmarks2d
+        codedict['landmarks3d'] = landmarks3d
+        codedict['predicted_landmarks'] = predicted_landmarks
+        if predicted_landmarks_mediapipe is not None:
+            codedict['predicted_landmarks_mediapipe'] = predicted_landmarks_mediapipe
+
+        grid = None
+        if 'grid' in required:
+            # the same uv lookup as the coarse render in decode()
+            grid = self.deca.render.render_uv_grid(trans_verts)
+        if 'normals' in required:
+            normals = util.vertex_normals(verts, self.deca.render.faces.expand(effective_batch_size, -1, -1))
+            codedict['normals'] = normals
+        if 'uv_z' in required:
+            uv_z = self._decode_displacement(codedict)
+            codedict['uv_z'] = uv_z
+            codedict['displacement_map'] = uv_z + self.deca.fixed_uv_dis[None, None, :, :]
+        if 'uv_detail_normals' in required:
+            detach_from_coarse_geometry = not self.deca.config.train_coarse
+            uv_detail_normals, _ = self.deca.displacement2normal(uv_z, verts, normals, detach=detach_from_coarse_geometry)
+            codedict['uv_detail_normals'] = uv_detail_normals
+        if 'geometry_coarse' in required:
+            codedict['geometry_coarse'] = self.deca.render.render_shape(verts, trans_verts)
+        if 'geometry_detail' in required:
+            if 'uv_detail_normals' in required:
+                detail_normal_images = F.grid_sample(uv_detail_normals.detach(), grid.detach(), align_corners=False)
+            else: 
+                detail_normal_images = None
+            codedict['geometry_detail'] = self.deca.render.render_shape(verts, trans_verts,
+                                                                        detail_normal_images=detail_normal_images)
+        return codedict
+
+    @timed()
     def _visualization_checkpoint(self, verts, trans_verts, ops, uv_detail_normals, additional, batch_idx, stage, prefix,
                                   save=False):
         batch_size = verts.shape[0]
@@ -2697,6 +2873,7 @@ class DecaModule(LightningModule):
                 lr=self.learning_params.learning_rate,
                 amsgrad=False)
         elif self.config.learning.optimizer == 'AdaBound':
+            import adabound
             self.deca.opt = adabound.AdaBound(
                 trainable_params,
                 lr=self.config.learning.learning_rate,
@@ -2793,6 +2970,7 @@ class DECA(torch.nn.Module):
             self.perceptual_loss = None
         else:
             if self.perceptual_loss is None:
+                import gdl.layers.losses.DecaLosses as lossfunc
                 self.perceptual_loss = lossfunc.IDMRFLoss().eval()
                 self.perceptual_loss.requires_grad_(False)  # TODO, move this to the constructor
 
@@ -2803,6 +2981,7 @@ class DECA(torch.nn.Module):
                 id_metric = self.config.id_metric if 'id_metric' in self.config.keys() else None
                 id_trainable = self.config.id_trainable if 'id_trainable' in self.config.keys() else False
                 self.id_loss_start_step = self.config.id_loss_start_step if 'id_loss_start_step' in self.config.keys() else 0
+                import gdl.layers.losses.DecaLosses as lossfunc
                 self.id_loss = lossfunc.VGGFace2Loss(self.config.pretrained_vgg_face_path, id_metric, id_trainable)
                 self.id_loss.freeze_nontrainable_layers()
 
@@ -2811,20 +2990,22 @@ class DECA(torch.nn.Module):
         else:
             if self.vgg_loss is None:
                 vgg_loss_batch_norm = 'vgg_loss_batch_norm' in self.config.keys() and self.config.vgg_loss_batch_norm
+                from gdl.layers.losses.VGGLoss import VGG19Loss
                 self.vgg_loss = VGG19Loss(dict(zip(self.config.vgg_loss_layers, self.config.lambda_vgg_layers)), batch_norm=vgg_loss_batch_norm).eval()
                 self.vgg_loss.requires_grad_(False) # TODO, move this to the constructor
 
     def _setup_renderer(self):
+        asset_bundle = get_asset_bundle(self.config)
         self.render = SRenderY(self.config.image_size, obj_filename=self.config.topology_path,
-                               uv_size=self.config.uv_size)  # .to(self.device)
-        # face mask for rendering details
-        mask = imread(self.config.face_mask_path).astype(np.float32) / 255.
-        mask = torch.from_numpy(mask[:, :, 0])[None, None, :, :].contiguous()
-        self.uv_face_mask = F.interpolate(mask, [self.config.uv_size, self.config.uv_size])
-        mask = imread(self.config.face_eye_mask_path).astype(np.float32) / 255.
-        mask = torch.from_numpy(mask[:, :, 0])[None, None, :, :].contiguous()
-        uv_face_eye_mask = F.interpolate(mask, [self.config.uv_size, self.config.uv_size])
-        self.register_buffer('uv_face_eye_mask', uv_face_eye_mask)
+                               uv_size=self.config.uv_size, asset_bundle=asset_bundle)  # .to(self.device)
+        # face masks for rendering details and the displacement correction
+        uv_sources = [self.config.face_mask_path, self.config.face_eye_mask_path]
+        if os.path.isfile(self.config.fixed_displacement_path):
+            uv_sources += [self.config.fixed_displacement_path]
+        uv_assets = load_assets(asset_bundle, "uv_masks", {"uv_size": self.config.uv_size}, uv_sources,
+                                lambda: DECA._build_uv_mask_assets(self.config))
+        self.uv_face_mask = torch.from_numpy(uv_assets['uv_face_mask'])
+        self.register_buffer('uv_face_eye_mask', torch.from_numpy(uv_assets['uv_face_eye_mask']))
 
         # displacement mask is deprecated and not used by DECA or EMOCA
         if 'displacement_mask' in self.config.keys():
@@ -2835,13 +3016,22 @@ class DECA(torch.nn.Module):
             self.register_buffer('displacement_mask', displacement_mask_)
 
         ## displacement correct
-        if os.path.isfile(self.config.fixed_displacement_path):
-            fixed_dis = np.load(self.config.fixed_displacement_path)
-            fixed_uv_dis = torch.tensor(fixed_dis).float()
-        else:
-            fixed_uv_dis = torch.zeros([512, 512]).float()
+        if not os.path.isfile(self.config.fixed_displacement_path):
             print("Warning: fixed_displacement_path not found, using zero displacement")
-        self.register_buffer('fixed_uv_dis', fixed_uv_dis)
+        self.register_buffer('fixed_uv_dis', torch.from_numpy(uv_assets['fixed_uv_dis']))
+
+    @staticmethod
+    def _build_uv_mask_assets(config):
+        assets = {}
+        for name, path in [('uv_face_mask', config.face_mask_path), ('uv_face_eye_mask', config.face_eye_mask_path)]:
+            mask = imread(path).astype(np.float32) / 255.
+            mask = torch.from_numpy(mask[:, :, 0])[None, None, :, :].contiguous()
+            assets[name] = F.interpolate(mask, [config.uv_size, config.uv_size]).numpy()
+        if os.path.isfile(config.fixed_displacement_path):
+            assets['fixed_uv_dis'] = np.load(config.fixed_displacement_path).astype(np.float32)
+        else:
+            assets['fixed_uv_dis'] = np.zeros([512, 512], dtype=np.float32)
+        return assets
 
     def uses_texture(self): 
         if 'use_texture' in self.config.keys():
@@ -2922,15 +3112,16 @@ class DECA(torch.nn.Module):
             raise ValueError(f"Invalid 'e_flame_type' = {e_flame_type}")
 
         import copy 
+        asset_bundle = get_asset_bundle(self.config)
         flame_cfg = copy.deepcopy(self.config)
         flame_cfg.n_shape = self._get_num_shape_params()
         if 'flame_mediapipe_lmk_embedding_path' not in flame_cfg.keys():
-            self.flame = FLAME(flame_cfg)
+            self.flame = FLAME(flame_cfg, asset_bundle=asset_bundle)
         else:
-            self.flame = FLAME_mediapipe(flame_cfg)
+            self.flame = FLAME_mediapipe(flame_cfg, asset_bundle=asset_bundle)
 
         if self.uses_texture():
-            self.flametex = FLAMETex(self.config)
+            self.flametex = FLAMETex(self.config, asset_bundle=asset_bundle)
         else: 
             self.flametex = None
 
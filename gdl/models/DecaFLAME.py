@@ -13,6 +13,7 @@ import pickle
 import torch.nn.functional as F
 
 from gdl.utils.lbs import lbs, batch_rodrigues, vertices2landmarks
+from gdl.utils.AssetBundle import load_assets
 
 
 def to_tensor(array, dtype=torch.float32):
@@ -47,33 +48,26 @@ class FLAME(nn.Module):
     which outputs the a mesh and 2D/3D facial landmarks
     """
 
-    def __init__(self, config):
+    def __init__(self, config, asset_bundle=None):
         super(FLAME, self).__init__()
         print("creating the FLAME Decoder")
-        with open(config.flame_model_path, 'rb') as f:
-            # flame_model = Struct(**pickle.load(f, encoding='latin1'))
-            ss = pickle.load(f, encoding='latin1')
-            flame_model = Struct(**ss)
+        assets = load_assets(asset_bundle, "flame", {"n_shape": config.n_shape, "n_exp": config.n_exp},
+                             [config.flame_model_path, config.flame_lmk_embedding_path],
+                             lambda: FLAME._build_assets(config))
 
         self.cfg = config
         self.dtype = torch.float32
-        self.register_buffer('faces_tensor', to_tensor(to_np(flame_model.f, dtype=np.int64), dtype=torch.long))
+        self.register_buffer('faces_tensor', torch.from_numpy(assets['faces_tensor']))
         # The vertices of the template model
-        self.register_buffer('v_template', to_tensor(to_np(flame_model.v_template), dtype=self.dtype))
+        self.register_buffer('v_template', torch.from_numpy(assets['v_template']))
         # The shape components and expression
-        shapedirs = to_tensor(to_np(flame_model.shapedirs), dtype=self.dtype)
-        shapedirs = torch.cat([shapedirs[:, :, :config.n_shape], shapedirs[:, :, 300:300 + config.n_exp]], 2)
-        self.register_buffer('shapedirs', shapedirs)
+        self.register_buffer('shapedirs', torch.from_numpy(assets['shapedirs']))
         # The pose components
-        num_pose_basis = flame_model.posedirs.shape[-1]
-        posedirs = np.reshape(flame_model.posedirs, [-1, num_pose_basis]).T
-        self.register_buffer('posedirs', to_tensor(to_np(posedirs), dtype=self.dtype))
+        self.register_buffer('posedirs', torch.from_numpy(assets['posedirs']))
         #
-        self.register_buffer('J_regressor', to_tensor(to_np(flame_model.J_regressor), dtype=self.dtype))
-        parents = to_tensor(to_np(flame_model.kintree_table[0])).long();
-        parents[0] = -1
-        self.register_buffer('parents', parents)
-        self.register_buffer('lbs_weights', to_tensor(to_np(flame_model.weights), dtype=self.dtype))
+        self.register_buffer('J_regressor', torch.from_numpy(assets['J_regressor']))
+        self.register_buffer('parents', torch.from_numpy(assets['parents']))
+        self.register_buffer('lbs_weights', torch.from_numpy(assets['lbs_weights']))
 
         # Fixing Eyeball and neck rotation
         default_eyball_pose = torch.zeros([1, 6], dtype=self.dtype, requires_grad=False)
@@ -84,18 +78,9 @@ class FLAME(nn.Module):
                                                           requires_grad=False))
 
         # Static and Dynamic Landmark embeddings for FLAME
-        lmk_embeddings = np.load(config.flame_lmk_embedding_path, allow_pickle=True, encoding='latin1')
-        lmk_embeddings = lmk_embeddings[()]
-        self.register_buffer('lmk_faces_idx', torch.tensor(lmk_embeddings['static_lmk_faces_idx'], dtype=torch.long))
-        self.register_buffer('lmk_bary_coords',
-                             torch.tensor(lmk_embeddings['static_lmk_bary_coords'], dtype=self.dtype))
-        self.register_buffer('dynamic_lmk_faces_idx',
-                             torch.tensor(lmk_embeddings['dynamic_lmk_faces_idx'], dtype=torch.long))
-        self.register_buffer('dynamic_lmk_bary_coords',
-                             torch.tensor(lmk_embeddings['dynamic_lmk_bary_coords'], dtype=self.dtype))
-        self.register_buffer('full_lmk_faces_idx', torch.tensor(lmk_embeddings['full_lmk_faces_idx'], dtype=torch.long))
-        self.register_buffer('full_lmk_bary_coords',
-                             torch.tensor(lmk_embeddings['full_lmk_bary_coords'], dtype=self.dtype))
+        for name in ['lmk_faces_idx', 'lmk_bary_coords', 'dynamic_lmk_faces_idx', 'dynamic_lmk_bary_coords',
+                     'full_lmk_faces_idx', 'full_lmk_bary_coords']:
+            self.register_buffer(name, torch.from_numpy(assets[name]))
 
         neck_kin_chain = [];
         NECK_IDX = 1
@@ -105,6 +90,40 @@ class FLAME(nn.Module):
             curr_idx = self.parents[curr_idx]
         self.register_buffer('neck_kin_chain', torch.stack(neck_kin_chain))
 
+    @staticmethod
+    def _build_assets(config):
+        """
+        Parses the FLAME model and the landmark embedding into the arrays of the buffers (in their final dtype).
+        This is what the asset bundle stores, so the pickles only need to be read once.
+        """
+        with open(config.flame_model_path, 'rb') as f:
+            # flame_model = Struct(**pickle.load(f, encoding='latin1'))
+            ss = pickle.load(f, encoding='latin1')
+            flame_model = Struct(**ss)
+
+        assets = {}
+        assets['faces_tensor'] = to_np(flame_model.f, dtype=np.int64)
+        assets['v_template'] = to_np(flame_model.v_template)
+        shapedirs = to_np(flame_model.shapedirs)
+        assets['shapedirs'] = np.concatenate([shapedirs[:, :, :config.n_shape], shapedirs[:, :, 300:300 + config.n_exp]], 2)
+        num_pose_basis = flame_model.posedirs.shape[-1]
+        assets['posedirs'] = to_np(np.reshape(flame_model.posedirs, [-1, num_pose_basis]).T)
+        assets['J_regressor'] = to_np(flame_model.J_regressor)
+        parents = to_np(flame_model.kintree_table[0]).astype(np.int64)
+        parents[0] = -1
+        assets['parents'] = parents
+        assets['lbs_weights'] = to_np(flame_model.weights)
+
+        lmk_embeddings = np.load(config.flame_lmk_embedding_path, allow_pickle=True, encoding='latin1')
+        lmk_embeddings = lmk_embeddings[()]
+        assets['lmk_faces_idx'] = to_np(lmk_embeddings['static_lmk_faces_idx'], dtype=np.int64)
+        assets['lmk_bary_coords'] = to_np(lmk_embeddings['static_lmk_bary_coords'])
+        assets['dynamic_lmk_faces_idx'] = to_np(lmk_embeddings['dynamic_lmk_faces_idx'], dtype=np.int64)
+        assets['dynamic_lmk_bary_coords'] = to_np(lmk_embeddings['dynamic_lmk_bary_coords'])
+        assets['full_lmk_faces_idx'] = to_np(lmk_embeddings['full_lmk_faces_idx'], dtype=np.int64)
+        assets['full_lmk_bary_coords'] = to_np(lmk_embeddings['full_lmk_bary_coords'])
+        return assets
+
     def _find_dynamic_lmk_idx_and_bcoords(self, pose, dynamic_lmk_faces_idx,
                                           dynamic_lmk_b_coords,
                                           neck_kin_chain, dtype=torch.float32):
@@ -271,16 +290,23 @@ class FLAME(nn.Module):
 
 class FLAME_mediapipe(FLAME): 
 
-    def __init__(self, config):
-        super().__init__(config)
+    def __init__(self, config, asset_bundle=None):
+        super().__init__(config, asset_bundle=asset_bundle)
         # static MEDIAPIPE landmark embeddings for FLAME
+        assets = load_assets(asset_bundle, "flame_mediapipe", {}, [config.flame_mediapipe_lmk_embedding_path],
+                             lambda: FLAME_mediapipe._build_mediapipe_assets(config))
+        self.register_buffer('lmk_faces_idx_mediapipe', torch.from_numpy(assets['lmk_faces_idx_mediapipe']))
+        self.register_buffer('lmk_bary_coords_mediapipe', torch.from_numpy(assets['lmk_bary_coords_mediapipe']))
+
+    @staticmethod
+    def _build_mediapipe_assets(config):
         lmk_embeddings_mediapipe = np.load(config.flame_mediapipe_lmk_embedding_path, 
             allow_pickle=True, encoding='latin1')
         # indices = lmk_embeddings_mediapipe['landmark_indices']
-        self.register_buffer('lmk_faces_idx_mediapipe', 
-            torch.tensor(lmk_embeddings_mediapipe['lmk_face_idx'].astype(np.int64), dtype=torch.long))
-        self.register_buffer('lmk_bary_coords_mediapipe',
-            torch.tensor(lmk_embeddings_mediapipe['lmk_b_coords'], dtype=self.dtype))
+        return {
+            'lmk_faces_idx_mediapipe': lmk_embeddings_mediapipe['lmk_face_idx'].astype(np.int64),
+            'lmk_bary_coords_mediapipe': to_np(lmk_embeddings_mediapipe['lmk_b_coords']),
+        }
         
     def forward(self, shape_params=None, expression_params=None, pose_params=None, eye_pose_params=None):
         vertices, landmarks2d, landmarks3d = super().forward(shape_params, expression_params, pose_params, eye_pose_params)
@@ -421,8 +447,20 @@ class FLAMETex(nn.Module):
     tex_path: '/ps/scratch/yfeng/Data/FLAME/texture/FLAME_albedo_from_BFM.npz'
     """
 
-    def __init__(self, config):
+    def __init__(self, config, asset_bundle=None):
         super(FLAMETex, self).__init__()
+        if config.tex_type not in ['BFM', 'FLAME']:
+            print('texture type ', config.tex_type, 'not exist!')
+            exit()
+        assets = load_assets(asset_bundle, "flame_tex", {"tex_type": config.tex_type, "n_tex": config.n_tex},
+                             [config.tex_path], lambda: FLAMETex._build_assets(config))
+        texture_mean = torch.from_numpy(assets['texture_mean'])
+        texture_basis = torch.from_numpy(assets['texture_basis'])
+        self.register_buffer('texture_mean', texture_mean)
+        self.register_buffer('texture_basis', texture_basis)
+
+    @staticmethod
+    def _build_assets(config):
         if config.tex_type == 'BFM':
             mu_key = 'MU'
             pc_key = 'PC'
@@ -441,16 +479,10 @@ class FLAMETex(nn.Module):
             texture_mean = tex_space[mu_key].reshape(1, -1) / 255.
             texture_basis = tex_space[pc_key].reshape(-1, n_pc) / 255.
 
-        else:
-            print('texture type ', config.tex_type, 'not exist!')
-            exit()
-
         n_tex = config.n_tex
-        num_components = texture_basis.shape[1]
-        texture_mean = torch.from_numpy(texture_mean).float()[None, ...]
-        texture_basis = torch.from_numpy(texture_basis[:, :n_tex]).float()[None, ...]
-        self.register_buffer('texture_mean', texture_mean)
-        self.register_buffer('texture_basis', texture_basis)
+        texture_mean = to_np(texture_mean)[None, ...]
+        texture_basis = to_np(texture_basis[:, :n_tex])[None, ...]
+        return {'texture_mean': texture_mean, 'texture_basis': texture_basis}
 
     def forward(self, texcode):
         texture = self.texture_mean + (self.texture_basis * texcode[:, None, :]).sum(-1)
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+
+# bump whenever the layout or the content of the stored arrays changes, all the older entries are then rebuilt
+ASSET_BUNDLE_VERSION = 1
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class AssetBundle(object):
+    """
+    A cache of the model assets (FLAME, texture space, topology, UV masks, ...) in a form that loads in milliseconds.
+    Every entry is a folder of .npy files (loaded memory-mapped) and a manifest. An entry is identified by its group
+    (i.e. 'flame') and its key (the config values the arrays depend on, i.e. n_shape and n_exp).
+
+    The manifest records the source files the arrays were computed from. If the size or modification time of a source
+    changes, its SHA1 is compared to the recorded one and the entry is rebuilt if it differs.
+
+    Usage:
+        arrays = bundle.get("flame", {"n_shape": 100, "n_exp": 50}, [flame_model_path], build_fn)
+    build_fn() computes the dict of numpy arrays from the sources, it is only called if the entry is missing or stale.
+    """
+
+    def __init__(self, bundle_dir):
+        self.bundle_dir = Path(bundle_dir)
+
+    def _entry_dir(self, group, key, sources):
+        # the source paths are a part of the name, models with different asset files do not overwrite each other
+        sources_hash = hashlib.sha1("\n".join([str(Path(source).absolute()) for source in sources]).encode()).hexdigest()[:10]
+        key_str = "".join(["_%s-%s" % (name, key[name]) for name in sorted(key.keys())])
+        return self.bundle_dir / ("%s%s_%s" % (group, key_str, sources_hash))
+
+    @staticmethod
+    def _describe_sources(sources):
+        description = {}
+        for source in sources:
+            stat = os.stat(source)
+            description[str(source)] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha1": file_checksum(source)}
+        return description
+
+    @staticmethod
+    def _sources_match(recorded, sources):
+        if sorted(recorded.keys()) != sorted([str(source) for source in sources]):
+            return False
+        for source in sources:
+            if not os.path.isfile(source):
+                return False
+            stat = os.stat(source)
+            record = recorded[str(source)]
+            if stat.st_size == record["size"] and stat.st_mtime == record["mtime"]:
+                continue
+            # touched or copied, only the content matters
+            if stat.st_size != record["size"] or file_checksum(source) != record["sha1"]:
+                return False
+        return True
+
+    def load(self, group, key, sources):
+        """
+        Returns the (memory-mapped) arrays of the entry or None if it does not exist or is stale.
+        """
+        entry_dir = self._entry_dir(group, key, sources)
+        manifest_path = entry_dir / "manifest.json"
+        if not manifest_path.is_file():
+            return None
+        try:
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get("version") != ASSET_BUNDLE_VERSION or manifest.get("key") != {k: key[k] for k in key} \
+                or not AssetBundle._sources_match(manifest.get("sources", {}), sources):
+            return None
+        # copy on write, the arrays can be wrapped by torch.from_numpy without being read from disk first
+        return {name: np.load(entry_dir / (name + ".npy"), mmap_mode="c") for name in manifest["arrays"]}
+
+    def save(self, group, key, sources, arrays):
+        entry_dir = self._entry_dir(group, key, sources)
+        # written next to the final folder and renamed, readers never see a half written entry
+        tmp_dir = entry_dir.parent / (entry_dir.name + ".tmp_" + uuid.uuid4().hex[:8])
+        tmp_dir.mkdir(parents=True)
+        try:
+            for name, array in arrays.items():
+                np.save(tmp_dir / (name + ".npy"), np.ascontiguousarray(array))
+            manifest = {
+                "version": ASSET_BUNDLE_VERSION,
+                "group": group,
+                "key": key,
+                "sources": AssetBundle._describe_sources(sources),
+                "arrays": {name: {"dtype": str(array.dtype), "shape": list(array.shape)} for name, array in arrays.items()},
+            }
+            with open(tmp_dir / "manifest.json", "w") as f:
+                json.dump(manifest, f, indent=2)
+            if entry_dir.exists():
+                shutil.rmtree(entry_dir)
+            os.replace(tmp_dir, entry_dir)
+        finally:
+            if tmp_dir.exists():
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def get(self, group, key, sources, build_fn):
+        arrays = self.load(group, key, sources)
+        if arrays is not None:
+            return arrays
+        arrays = build_fn()
+        try:
+            self.save(group, key, sources, arrays)
+        except OSError as e:
+            # i.e. a read-only asset folder, the assets still work, they are just not cached
+            print(f"[WARNING] Could not write the '{group}' assets into the bundle '{self.bundle_dir}': {e}")
+        return arrays
+
+
+def get_asset_bundle(config=None):
+    """
+    Returns the asset bundle of the model config. It lives in assets/compiled unless the config specifies an
+    'asset_bundle_dir' (an empty one disables the bundle, None is returned then).
+    """
+    if config is not None and 'asset_bundle_dir' in config.keys():
+        bundle_dir = config.asset_bundle_dir
+    else:
+        from gdl.utils.other import get_path_to_assets
+        bundle_dir = get_path_to_assets() / "compiled"
+    if bundle_dir is None or len(str(bundle_dir)) == 0:
+        return None
+    return AssetBundle(bundle_dir)
+
+
+def load_assets(bundle, group, key, sources, build_fn):
+    """
+    Gets the arrays from the bundle (building and storing them if needed), or builds them directly if there is no bundle.
+    """
+    if bundle is None:
+        return build_fn()
+    return bundle.get(group, key, sources, build_fn)
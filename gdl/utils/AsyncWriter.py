@@ -0,0 +1,126 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+
+import torch
+
+
+class AsyncWriter(object):
+    """
+    A bounded pool of background threads that write the per-frame outputs (images, TIFFs, codes)
+    while the GPU already works on the next batch.
+
+    - submit() blocks once max_pending writes are waiting (backpressure), so the memory held by the outputs
+      that have not been written yet stays bounded
+    - to_host() starts the GPU->CPU copy of the outputs on a separate CUDA stream, the writes submitted after
+      it wait for the copy in the worker thread, not in the inference loop
+    - an error of any write is re-raised in the calling thread by the next submit(), flush() or close()
+
+    Usage:
+        writer = AsyncWriter(num_workers=4)
+        for batch in loader:
+            ...
+            visdict = writer.to_host(visdict)
+            writer.submit(save_images, outfolder, name, visdict, i)
+        writer.close() # waits for all the writes of the sequence
+    """
+
+    def __init__(self, num_workers=4, max_pending=None):
+        self.num_workers = num_workers
+        self.max_pending = max_pending or 4 * num_workers
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._futures = []
+        self._copy_stream = None
+        self._copy_done = None
+
+    def to_host(self, values):
+        """
+        Asynchronously copies the tensors in values (a tensor, or a dict/list of them) to pinned CPU memory.
+        Returns the same structure with the CPU tensors. The tensors must not be read before the copy finishes,
+        which is taken care of for all the writes submitted afterwards.
+        """
+        if not torch.cuda.is_available():
+            return values
+        if self._copy_stream is None:
+            self._copy_stream = torch.cuda.Stream()
+        self._copy_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self._copy_stream):
+            host_values = self._copy_to_host(values)
+            self._copy_done = torch.cuda.Event()
+            self._copy_done.record(self._copy_stream)
+        return host_values
+
+    def _copy_to_host(self, values):
+        if isinstance(values, torch.Tensor):
+            if not values.is_cuda:
+                return values
+            host = torch.empty(values.shape, dtype=values.dtype, device='cpu', pin_memory=True)
+            host.copy_(values.detach(), non_blocking=True)
+            # the source must not be freed by the caching allocator before the copy stream is done with it
+            values.record_stream(self._copy_stream)
+            return host
+        if isinstance(values, dict):
+            return {key: self._copy_to_host(value) for key, value in values.items()}
+        if isinstance(values, (list, tuple)):
+            return type(values)(self._copy_to_host(value) for value in values)
+        return values
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Runs fn(*args, **kwargs) in the background. Blocks if there are already max_pending writes waiting.
+        """
+        self._raise_errors()
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._run, self._copy_done, fn, *args, **kwargs)
+        except Exception as e:
+            self._slots.release()
+            raise e
+        future.add_done_callback(lambda f: self._slots.release())
+        with self._lock:
+            self._futures += [future]
+        return future
+
+    @staticmethod
+    def _run(copy_done, fn, *args, **kwargs):
+        if copy_done is not None:
+            copy_done.synchronize()
+        return fn(*args, **kwargs)
+
+    def _raise_errors(self, wait=False):
+        with self._lock:
+            futures = self._futures
+            if wait:
+                self._futures = []
+            else:
+                self._futures = [f for f in futures if not f.done()]
+                futures = [f for f in futures if f.done()]
+        if wait:
+            # all the writes finish before an error is raised, so none is still running afterwards
+            wait_futures(futures)
+        for f in futures:
+            # raises the exception of the write if there was one
+            f.result()
+
+    def flush(self):
+        """
+        Waits until everything submitted so far is written (or failed). Re-raises the first write error.
+        """
+        self._raise_errors(wait=True)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # do not hide the original exception by a write error
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,222 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+
+CODE_STORE_VERSION = 1
+
+
+class CodeStore(object):
+    """
+    A columnar store of the per-face codes of a sequence (shapecode, expcode, posecode, ...), replacing the
+    per-frame .npy/.mat files. Every code is one array, a row per detected face, indexed by (frame id, face id).
+
+    On disk, the store is a folder with one raw binary file per column (<column>.bin, rows of a fixed shape and dtype,
+    appended to) and an index.json with the schema, the number of committed rows and the attrs (a JSON serializable
+    dict of the sequence metadata, i.e. the frame size). The rows are only visible
+    once flush() updated the index, bytes of an interrupted append past the committed rows are dropped on the next open.
+
+    Usage:
+        with CodeStore(path, mode='w') as store:
+            for batch in loader:
+                store.append(frame_ids, face_ids, {"shapecode": vals["shapecode"], ...})
+
+        store = CodeStore(path)
+        store.get(frame_id) # all the faces of the frame
+        codes = store.load(device="cuda") # the whole sequence as tensors
+    """
+
+    INDEX_FILE = "index.json"
+    ID_COLUMNS = {"frame_id": np.int64, "face_id": np.int32}
+
+    def __init__(self, path, mode='r'):
+        assert mode in ['r', 'a', 'w'], f"Invalid mode '{mode}'"
+        self.path = Path(path)
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._files = {}
+        self._lookup = None
+        if mode == 'w' or (mode == 'a' and not (self.path / CodeStore.INDEX_FILE).is_file()):
+            self.path.mkdir(parents=True, exist_ok=True)
+            for column_file in self.path.glob("*.bin"):
+                column_file.unlink()
+            self.columns = {}
+            self.num_rows = 0
+            self.attrs = {}
+            self._write_index()
+        else:
+            with open(self.path / CodeStore.INDEX_FILE, "r") as f:
+                index = json.load(f)
+            if index.get("version") != CODE_STORE_VERSION:
+                raise RuntimeError(f"Unsupported code store version {index.get('version')} in '{self.path}'")
+            self.columns = {name: (np.dtype(c["dtype"]), tuple(c["shape"])) for name, c in index["columns"].items()}
+            self.num_rows = index["num_rows"]
+            self.attrs = index.get("attrs", {})
+            if mode == 'a':
+                self._truncate_to_committed()
+
+    def _row_bytes(self, column):
+        dtype, shape = self.columns[column]
+        return int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+
+    def _column_file(self, column):
+        return self.path / (column + ".bin")
+
+    def _truncate_to_committed(self):
+        for column in self.columns:
+            committed = self.num_rows * self._row_bytes(column)
+            column_file = self._column_file(column)
+            if column_file.is_file() and column_file.stat().st_size > committed:
+                os.truncate(column_file, committed)
+
+    def _write_index(self):
+        index = {
+            "version": CODE_STORE_VERSION,
+            "num_rows": self.num_rows,
+            "columns": {name: {"dtype": dtype.str, "shape": list(shape)} for name, (dtype, shape) in self.columns.items()},
+            "attrs": self.attrs,
+        }
+        tmp_path = self.path / (CodeStore.INDEX_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, self.path / CodeStore.INDEX_FILE)
+
+    @staticmethod
+    def _to_numpy(values):
+        if hasattr(values, "detach"):
+            values = values.detach().cpu().numpy()
+        return np.asarray(values)
+
+    def append(self, frame_ids, face_ids, codes):
+        """
+        Appends a batch of N faces. codes is a dict {column: [N, ...] tensor or array}, the columns and their
+        shapes are fixed by the first append. Thread safe (i.e. it can be submitted to an AsyncWriter).
+        """
+        assert self.mode != 'r', "The code store is opened read-only"
+        rows = {"frame_id": np.asarray(frame_ids, dtype=np.int64), "face_id": np.asarray(face_ids, dtype=np.int32)}
+        for name, values in codes.items():
+            rows[name] = self._to_numpy(values)
+        num_new_rows = len(rows["frame_id"])
+        with self._lock:
+            for name, values in rows.items():
+                if values.shape[0] != num_new_rows:
+                    raise ValueError(f"Column '{name}' has {values.shape[0]} rows, expected {num_new_rows}")
+                if name not in self.columns:
+                    if self.num_rows > 0:
+                        raise ValueError(f"Column '{name}' is not in the code store '{self.path}'")
+                    self.columns[name] = (values.dtype, tuple(values.shape[1:]))
+                dtype, shape = self.columns[name]
+                if tuple(values.shape[1:]) != shape:
+                    raise ValueError(f"Column '{name}' has rows of shape {tuple(values.shape[1:])}, expected {shape}")
+                if name not in self._files:
+                    self._files[name] = open(self._column_file(name), "ab")
+                self._files[name].write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+            missing = [name for name in self.columns if name not in rows]
+            if len(missing) > 0:
+                raise ValueError(f"Columns {missing} are missing in the appended batch")
+            self.num_rows += num_new_rows
+            self._lookup = None
+
+    def flush(self):
+        with self._lock:
+            for f in self._files.values():
+                f.flush()
+            if self.mode != 'r':
+                self._write_index()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.num_rows
+
+    def column(self, name):
+        """
+        The committed rows of the column as a read-only memory-mapped array (nothing is read until it is accessed).
+        """
+        dtype, shape = self.columns[name]
+        if self.num_rows == 0 or self._row_bytes(name) == 0:
+            # empty files cannot be mapped (i.e. the [N, 0] detailemocode of models without the emotion detail code)
+            return np.zeros((self.num_rows,) + shape, dtype=dtype)
+        return np.memmap(self._column_file(name), dtype=dtype, mode='r', shape=(self.num_rows,) + shape)
+
+    @property
+    def code_names(self):
+        return [name for name in self.columns if name not in CodeStore.ID_COLUMNS]
+
+    @property
+    def frame_ids(self):
+        return self.column("frame_id")
+
+    @property
+    def face_ids(self):
+        return self.column("face_id")
+
+    def rows_of_frame(self, frame_id, face_id=None):
+        """
+        Row indices of the faces of the given frame (sorted by face id), or of the single face if face_id is given.
+        """
+        if self._lookup is None:
+            frame_ids = np.asarray(self.frame_ids)
+            face_ids = np.asarray(self.face_ids)
+            order = np.lexsort((face_ids, frame_ids))
+            self._lookup = (order, frame_ids[order], face_ids[order])
+        order, sorted_frame_ids, sorted_face_ids = self._lookup
+        start, end = np.searchsorted(sorted_frame_ids, [frame_id, frame_id + 1])
+        rows = order[start:end]
+        if face_id is not None:
+            rows = rows[sorted_face_ids[start:end] == face_id]
+        return rows
+
+    def get(self, frame_id, face_id=None, columns=None):
+        """
+        The codes of the faces of a frame, {column: [num faces, ...] array}.
+        """
+        rows = self.rows_of_frame(frame_id, face_id)
+        columns = columns or list(self.columns.keys())
+        return {name: np.asarray(self.column(name)[rows]) for name in columns}
+
+    def load(self, columns=None, device=None, frame_range=None):
+        """
+        Bulk loads the codes (sorted by frame and face) as torch tensors, i.e. for decoding them again.
+        frame_range = (start, end) only loads the frames in [start, end).
+        """
+        import torch
+        frame_ids = np.asarray(self.frame_ids)
+        order = np.lexsort((np.asarray(self.face_ids), frame_ids))
+        if frame_range is not None:
+            order = order[(frame_ids[order] >= frame_range[0]) & (frame_ids[order] < frame_range[1])]
+        columns = columns or list(self.columns.keys())
+        codes = {}
+        for name in columns:
+            values = torch.from_numpy(np.asarray(self.column(name))[order])
+            codes[name] = values.to(device) if device is not None else values
+        return codes
+
+    @staticmethod
+    def merge(store_paths, out_path):
+        """
+        Concatenates the stores (i.e. of the shards of a video) into a new one.
+        """
+        with CodeStore(out_path, mode='w') as out_store:
+            for store_path in store_paths:
+                store = CodeStore(store_path)
+                out_store.attrs.update(store.attrs)
+                if len(store) == 0:
+                    continue
+                codes = {name: np.asarray(store.column(name)) for name in store.code_names}
+                out_store.append(np.asarray(store.frame_ids), np.asarray(store.face_ids), codes)
+        return CodeStore(out_path)
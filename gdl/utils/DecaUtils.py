@@ -150,15 +150,21 @@ def generate_triangles(h, w, mask=None):
     # w w+1
     # .
     # w*h
-    triangles = []
+    # two triangles per quad, the quads are ordered column by column (x is the outer loop, y the inner one),
+    # the order of the original per-pixel loop is kept since the dense mesh faces are indexed by it
     margin = 0
-    for x in range(margin, w - 1 - margin):
-        for y in range(margin, h - 1 - margin):
-            triangle0 = [y * w + x, y * w + x + 1, (y + 1) * w + x]
-            triangle1 = [y * w + x + 1, (y + 1) * w + x + 1, (y + 1) * w + x]
-            triangles.append(triangle0)
-            triangles.append(triangle1)
-    triangles = np.array(triangles)
+    x, y = np.meshgrid(np.arange(margin, w - 1 - margin), np.arange(margin, h - 1 - margin), indexing='ij')
+    top_left = (y * w + x).reshape(-1)
+    top_right = top_left + 1
+    bottom_left = top_left + w
+    bottom_right = bottom_left + 1
+    triangle0 = np.stack([top_left, top_right, bottom_left], axis=-1)
+    triangle1 = np.stack([top_right, bottom_right, bottom_left], axis=-1)
+    triangles = np.stack([triangle0, triangle1], axis=1).reshape(-1, 3)
+    if mask is not None:
+        # only the triangles with all three vertices (pixels) inside the mask are kept
+        mask = np.asarray(mask).reshape(-1) > 0
+        triangles = triangles[mask[triangles].all(axis=1)]
     triangles = triangles[:, [0, 2, 1]]
     return triangles
 
@@ -0,0 +1,212 @@
+"""
+Lightweight timing spans of the hot paths of the reconstruction pipeline (face detection, warps, encode/decode,
+rendering, the image writers). Every span aggregates the number of calls and the wall time of each call, which are
+summarized as totals and percentiles at the end of a run. Spans are thread safe, so the writes of gdl.utils.AsyncWriter
+are timed as well.
+
+The wall time of GPU code only covers launching it (unless something synchronizes), with cuda_events=True every span
+also records a pair of CUDA events on the current stream and reports the GPU time between them.
+
+Instrumentation is off by default, a disabled span is a shared no-op context manager and a disabled timed function
+costs one flag check per call.
+
+Usage:
+    from gdl.utils import Instrumentation as instrumentation
+    instrumentation.enable(cuda_events=True)
+
+    @instrumentation.timed("DecaModule.encode")
+    def encode(...):
+        ...
+
+    with instrumentation.span("export"):
+        ...
+
+    instrumentation.report("timings.json") # prints the summary and writes it as JSON
+"""
+
+import functools
+import json
+import sys
+import threading
+import time
+from array import array
+from pathlib import Path
+
+import numpy as np
+import torch
+
+
+_enabled = False
+_cuda_events = False
+_lock = threading.Lock()
+# span name -> wall times of the calls in seconds
+_wall_times = {}
+# span name -> GPU times of the calls in milliseconds
+_gpu_times = {}
+# span name -> (start, end) CUDA event pairs that have not been read yet
+_pending_events = {}
+# the pending events are read once there are this many of a span, so they do not pile up over a long video
+_MAX_PENDING_EVENTS = 256
+
+PERCENTILES = [50, 90, 99]
+
+
+def enable(cuda_events=False):
+    global _enabled, _cuda_events
+    _enabled = True
+    _cuda_events = cuda_events and torch.cuda.is_available()
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _wall_times.clear()
+        _gpu_times.clear()
+        _pending_events.clear()
+
+
+class _NoSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span(object):
+    __slots__ = ("name", "start", "start_event")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start_event = None
+        if _cuda_events:
+            self.start_event = torch.cuda.Event(enable_timing=True)
+            self.start_event.record()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall_time = time.perf_counter() - self.start
+        end_event = None
+        if self.start_event is not None:
+            end_event = torch.cuda.Event(enable_timing=True)
+            end_event.record()
+        with _lock:
+            if self.name not in _wall_times:
+                _wall_times[self.name] = array('d')
+            _wall_times[self.name].append(wall_time)
+            if end_event is not None:
+                pending = _pending_events.setdefault(self.name, [])
+                pending.append((self.start_event, end_event))
+                if len(pending) >= _MAX_PENDING_EVENTS:
+                    _read_events(self.name, wait=False)
+        return False
+
+
+def span(name):
+    """
+    A context manager that times its block as the span name (a no-op if the instrumentation is disabled).
+    """
+    if not _enabled:
+        return _NO_SPAN
+    return _Span(name)
+
+
+def timed(name=None):
+    """
+    A decorator that times every call of the function as the span name (the qualified name of the function by default).
+    """
+    def decorator(function):
+        span_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Span(span_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _read_events(name, wait):
+    """
+    Moves the GPU times of the finished event pairs of the span into _gpu_times. Called with the lock held.
+    """
+    pending = _pending_events.get(name, [])
+    if wait and len(pending) > 0:
+        pending[-1][1].synchronize()
+    done = 0
+    gpu_times = _gpu_times.setdefault(name, array('d'))
+    for start_event, end_event in pending:
+        # the events of a stream finish in order
+        if not end_event.query():
+            break
+        gpu_times.append(start_event.elapsed_time(end_event))
+        done += 1
+    del pending[:done]
+
+
+def _stats(times, scale):
+    times = np.frombuffer(times, dtype=np.float64) * scale
+    stats = {"total_s": float(times.sum()) / 1000., "mean_ms": float(times.mean())}
+    for p, value in zip(PERCENTILES, np.percentile(times, PERCENTILES)):
+        stats["p%d_ms" % p] = float(value)
+    stats["max_ms"] = float(times.max())
+    return stats
+
+
+def summary():
+    """
+    The statistics of all the spans (count, total, mean, percentiles and max, also of the GPU time with cuda_events),
+    sorted by their total wall time.
+    """
+    with _lock:
+        for name in list(_pending_events.keys()):
+            _read_events(name, wait=True)
+        spans = {}
+        for name, wall_times in _wall_times.items():
+            spans[name] = {"count": len(wall_times)}
+            spans[name].update(_stats(wall_times, 1000.))
+            if len(_gpu_times.get(name, [])) > 0:
+                spans[name]["gpu"] = _stats(_gpu_times[name], 1.)
+    return dict(sorted(spans.items(), key=lambda item: -item[1]["total_s"]))
+
+
+def report(path=None, file=None):
+    """
+    Prints the summary as a table (to stdout by default) and writes it as JSON to path (if given). Returns the summary.
+    """
+    spans = summary()
+    file = file or sys.stdout
+    columns = ["total_s", "mean_ms"] + ["p%d_ms" % p for p in PERCENTILES] + ["max_ms"]
+    with_gpu = any("gpu" in stats for stats in spans.values())
+    header = "%-48s %8s " % ("span", "count") + " ".join("%10s" % column for column in columns)
+    if with_gpu:
+        header += " %10s %10s" % ("gpu_s", "gpu_p50_ms")
+    print(header, file=file)
+    for name, stats in spans.items():
+        line = "%-48s %8d " % (name, stats["count"]) + " ".join("%10.3f" % stats[column] for column in columns)
+        if "gpu" in stats:
+            line += " %10.3f %10.3f" % (stats["gpu"]["total_s"], stats["gpu"]["p50_ms"])
+        print(line, file=file)
+    if path is not None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"cuda_events": _cuda_events, "spans": spans}, f, indent=2)
+    return spans
@@ -0,0 +1,227 @@
+"""
+Temporal processing of the per-face codes of a video (see the keyframe mode of videoFacesToUVNDC.py): only the faces
+of keyframes are encoded, the codes of the faces in between are interpolated (linearly, the rotations of the pose on
+the sphere of unit quaternions) and the code sequences can be smoothed (One Euro or Savitzky-Golay filter).
+
+The faces are followed over the frames by their face id (the index of the face in its frame), which is stable on
+single-face footage and with face tracking. A track ends where the face is missing in a frame or its crop jumps
+(i.e. the face ids of two people swapped), nothing is interpolated or smoothed across the end of a track.
+
+All the functions work on numpy arrays with a row per face (the rows of DetectionIndexedData).
+"""
+import numpy as np
+
+
+# the axis-angle rotations (global and jaw) of the posecode are interpolated on the rotation group
+POSE_CODE = "posecode"
+# the codes of the geometry, the texture and the light do not need smoothing for the UV export
+SMOOTHED_CODES = ["shapecode", "expcode", "posecode", "cam", "detailcode", "detailemocode"]
+
+
+def face_tracks(frame_ids, face_ids, centers, sizes, max_jump=0.5):
+    """
+    Splits the faces (rows) into tracks: the same face id in consecutive frames, with a crop center that moves less
+    than max_jump times the crop size from one frame to the next. Returns a list of row index arrays sorted by frame.
+    """
+    frame_ids = np.asarray(frame_ids)
+    face_ids = np.asarray(face_ids)
+    centers = np.asarray(centers, dtype=np.float32).reshape(-1, 2)
+    sizes = np.asarray(sizes, dtype=np.float32).reshape(-1)
+    if len(frame_ids) == 0:
+        return []
+    order = np.lexsort((frame_ids, face_ids))
+    jump = np.linalg.norm(np.diff(centers[order], axis=0), axis=1) > max_jump * sizes[order][1:]
+    breaks = (np.diff(face_ids[order]) != 0) | (np.diff(frame_ids[order]) != 1) | jump
+    return np.split(order, np.nonzero(breaks)[0] + 1)
+
+
+def _motion(landmarks, centers, sizes, row, key_row):
+    """
+    How far the face moved since the keyframe, relative to its crop size: the largest landmark displacement,
+    or the displacement of the crop center and the change of its size without landmarks.
+    """
+    if landmarks is not None:
+        displacement = np.max(np.linalg.norm(landmarks[row, :, :2] - landmarks[key_row, :, :2], axis=-1))
+    else:
+        displacement = np.linalg.norm(centers[row] - centers[key_row]) + abs(sizes[row] - sizes[key_row])
+    return displacement / sizes[row]
+
+
+def select_keyframes(tracks, frame_ids, centers, sizes, interval, landmarks=None, motion_threshold=None):
+    """
+    Returns the boolean mask of the faces that are encoded: the first and the last face of every track, a face every
+    interval frames and every face that moved more than motion_threshold (see _motion) since the last keyframe.
+    landmarks are the [N, num landmarks, 2 or 3] landmarks of the faces in the frame (optional).
+    """
+    frame_ids = np.asarray(frame_ids)
+    centers = np.asarray(centers, dtype=np.float32).reshape(-1, 2)
+    sizes = np.asarray(sizes, dtype=np.float32).reshape(-1)
+    keyframes = np.zeros(len(frame_ids), dtype=bool)
+    for rows in tracks:
+        keyframes[rows[0]] = True
+        keyframes[rows[-1]] = True
+        key_row = rows[0]
+        for row in rows[1:-1]:
+            if frame_ids[row] - frame_ids[key_row] >= interval or (motion_threshold is not None and motion_threshold > 0
+                    and _motion(landmarks, centers, sizes, row, key_row) > motion_threshold):
+                keyframes[row] = True
+                key_row = row
+    return keyframes
+
+
+def axis_angle_to_quaternion(axis_angle):
+    """
+    [..., 3] axis-angle rotations to [..., 4] unit quaternions (w, x, y, z).
+    """
+    angle = np.linalg.norm(axis_angle, axis=-1, keepdims=True)
+    # sin(angle / 2) / angle, 1/2 in the limit
+    scale = np.where(angle > 1e-8, np.sin(angle / 2) / np.maximum(angle, 1e-8), 0.5)
+    return np.concatenate([np.cos(angle / 2), axis_angle * scale], axis=-1)
+
+
+def quaternion_to_axis_angle(quaternion):
+    """
+    [..., 4] unit quaternions (w, x, y, z) to [..., 3] axis-angle rotations.
+    """
+    # the same rotation with w >= 0, so the angle is in [0, pi]
+    quaternion = np.where(quaternion[..., :1] < 0, -quaternion, quaternion)
+    sin_half = np.linalg.norm(quaternion[..., 1:], axis=-1, keepdims=True)
+    angle = 2 * np.arctan2(sin_half, quaternion[..., :1])
+    scale = np.where(sin_half > 1e-8, angle / np.maximum(sin_half, 1e-8), 2. / np.maximum(quaternion[..., :1], 1e-8))
+    return quaternion[..., 1:] * scale
+
+
+def slerp_axis_angle(axis_angle0, axis_angle1, t):
+    """
+    Spherical linear interpolation of [N, ..., 3] axis-angle rotations, t is [N] in [0, 1].
+    """
+    q0 = axis_angle_to_quaternion(axis_angle0)
+    q1 = axis_angle_to_quaternion(axis_angle1)
+    t = np.asarray(t, dtype=np.float64).reshape((-1,) + (1,) * (q0.ndim - 1))
+    dot = np.sum(q0 * q1, axis=-1, keepdims=True)
+    # the shorter way around
+    q1 = np.where(dot < 0, -q1, q1)
+    dot = np.clip(np.abs(dot), 0., 1.)
+    theta = np.arccos(dot)
+    sin_theta = np.sin(theta)
+    # nearly identical rotations are interpolated linearly
+    linear = sin_theta < 1e-6
+    w0 = np.where(linear, 1 - t, np.sin((1 - t) * theta) / np.where(linear, 1., sin_theta))
+    w1 = np.where(linear, t, np.sin(t * theta) / np.where(linear, 1., sin_theta))
+    q = w0 * q0 + w1 * q1
+    q = q / np.linalg.norm(q, axis=-1, keepdims=True)
+    return quaternion_to_axis_angle(q).astype(axis_angle0.dtype)
+
+
+def interpolate_codes(key_codes, tracks, frame_ids, keyframes):
+    """
+    The codes of all the faces from the codes of the keyframes.
+    key_codes: {code name: [K, ...] array} of the keyframe faces (in the order of np.nonzero(keyframes))
+    Every face between two keyframes of its track is interpolated linearly by its frame, except for the posecode
+    (global rotation and jaw, [N, 6]) whose two rotations are interpolated with slerp_axis_angle.
+    Returns {code name: [N, ...] array}.
+    """
+    frame_ids = np.asarray(frame_ids)
+    key_rows = np.nonzero(keyframes)[0]
+    key_index = np.full(len(frame_ids), -1, dtype=np.int64)
+    key_index[key_rows] = np.arange(len(key_rows))
+    codes = {}
+    for name, values in key_codes.items():
+        codes[name] = np.zeros((len(frame_ids),) + values.shape[1:], dtype=values.dtype)
+        codes[name][key_rows] = values
+
+    for rows in tracks:
+        is_key = keyframes[rows]
+        assert is_key[0] and is_key[-1], "The first and the last face of a track have to be keyframes"
+        if is_key.all():
+            continue
+        track_keys = rows[is_key]
+        key_frames = frame_ids[track_keys]
+        others = rows[~is_key]
+        others_frames = frame_ids[others]
+        next_key = np.searchsorted(key_frames, others_frames)
+        previous_key = next_key - 1
+        t = (others_frames - key_frames[previous_key]) / (key_frames[next_key] - key_frames[previous_key])
+        rows0 = key_index[track_keys[previous_key]]
+        rows1 = key_index[track_keys[next_key]]
+        for name, values in key_codes.items():
+            if name == POSE_CODE:
+                rotations0 = values[rows0].reshape(len(others), -1, 3)
+                rotations1 = values[rows1].reshape(len(others), -1, 3)
+                codes[name][others] = slerp_axis_angle(rotations0, rotations1, t).reshape((len(others),) + values.shape[1:])
+            else:
+                weights = t.reshape((-1,) + (1,) * (values.ndim - 1)).astype(values.dtype)
+                codes[name][others] = values[rows0] + (values[rows1] - values[rows0]) * weights
+    return codes
+
+
+def savgol_smooth(values, window_length=9, polyorder=2):
+    """
+    Savitzky-Golay filter of a [T, ...] sequence along the time. Sequences shorter than the window are filtered with
+    the longest odd window that fits (and not at all if it is not longer than polyorder).
+    """
+    from scipy.signal import savgol_filter
+    window_length = min(window_length, len(values) if len(values) % 2 == 1 else len(values) - 1)
+    if window_length <= polyorder:
+        return values
+    return savgol_filter(values, window_length, polyorder, axis=0, mode="interp").astype(values.dtype)
+
+
+class OneEuroFilter(object):
+    """
+    The One Euro filter (Casiez et al., CHI 2012): an exponential smoothing with a cutoff frequency that grows with the
+    speed of the signal, so the jitter of a still face is smoothed strongly while fast motion lags little.
+    min_cutoff (Hz) sets the smoothing of slow motion, beta how fast the cutoff grows with the speed.
+    """
+
+    def __init__(self, fps, min_cutoff=1.0, beta=0.0, d_cutoff=1.0):
+        self.fps = fps
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+
+    @staticmethod
+    def _alpha(dt, cutoff):
+        tau = 1. / (2 * np.pi * cutoff)
+        return 1. / (1. + tau / dt)
+
+    def __call__(self, values, frame_ids):
+        """
+        Filters a [T, ...] sequence sampled at the given frames.
+        """
+        smoothed = np.array(values, dtype=np.float64)
+        derivative = np.zeros_like(smoothed[0])
+        for i in range(1, len(smoothed)):
+            dt = (frame_ids[i] - frame_ids[i - 1]) / self.fps
+            raw_derivative = (smoothed[i] - smoothed[i - 1]) / dt
+            derivative = derivative + self._alpha(dt, self.d_cutoff) * (raw_derivative - derivative)
+            alpha = self._alpha(dt, self.min_cutoff + self.beta * np.abs(derivative))
+            smoothed[i] = smoothed[i - 1] + alpha * (smoothed[i] - smoothed[i - 1])
+        return smoothed.astype(np.asarray(values).dtype)
+
+
+def smooth_codes(codes, tracks, frame_ids, method, fps=25., names=None, window_length=9, polyorder=2,
+                 min_cutoff=1.0, beta=0.0, d_cutoff=1.0):
+    """
+    Smooths the codes (names, SMOOTHED_CODES by default) of every track along the time.
+    method: "savgol" (window_length and polyorder) or "one_euro" (fps, min_cutoff, beta and d_cutoff).
+    The posecode is smoothed as axis-angle vectors, which is accurate for the small changes between frames.
+    Returns a new dict with the smoothed codes.
+    """
+    if method not in ["savgol", "one_euro"]:
+        raise ValueError(f"Invalid code smoothing '{method}', supported are 'savgol' and 'one_euro'")
+    frame_ids = np.asarray(frame_ids)
+    names = [name for name in (names or SMOOTHED_CODES) if name in codes]
+    one_euro = OneEuroFilter(fps, min_cutoff=min_cutoff, beta=beta, d_cutoff=d_cutoff)
+    smoothed = dict(codes)
+    for name in names:
+        smoothed[name] = np.array(codes[name])
+    for rows in tracks:
+        if len(rows) < 2:
+            continue
+        for name in names:
+            if method == "savgol":
+                smoothed[name][rows] = savgol_smooth(codes[name][rows], window_length, polyorder)
+            else:
+                smoothed[name][rows] = one_euro(codes[name][rows], frame_ids[rows])
+    return smoothed
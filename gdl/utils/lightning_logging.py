@@ -1,6 +1,5 @@
 from skimage.io import imsave
 from pathlib import Path
-from wandb import Image
 import numpy as np
 
 
@@ -19,6 +18,8 @@ def _log_wandb_image(path, image, caption=None):
         caption_file = Path(path).parent / (Path(path).stem + ".txt")
         with open(caption_file, "w") as f:
             f.write(caption)
+    # wandb is only imported when actually logging to it
+    from wandb import Image
     wandb_image = Image(str(path), caption=caption)
     return wandb_image
 
@@ -13,6 +13,12 @@ def class_from_str(str, module=None, none_on_fail = False) -> type:
     raise RuntimeError(f"Class '{str}' not found.")
 
 
+def is_skvideo_reader(obj) -> bool:
+    # an FFmpegReader can only exist if skvideo has already been imported, no need to import it just for the check
+    skvideo_io = sys.modules.get("skvideo.io")
+    return skvideo_io is not None and isinstance(obj, skvideo_io.FFmpegReader)
+
+
 def get_path_to_assets() -> Path:
     import gdl
     return Path(gdl.__file__).parents[1] / "assets"
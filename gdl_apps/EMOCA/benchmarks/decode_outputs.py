@@ -0,0 +1,165 @@
+"""
+Checks that output-driven decoding (DecaModule.decode(..., outputs=S)) produces the same tensors as the full path
+(decode() followed by _visualization_checkpoint()) on the same codes, for several sets of requested outputs and with
+both renderers: the shaded one of gdl/models/Renderer.py (render_shape_uses_detail_normals=True) and the UV NDC one
+of the root Renderer.py (render_shape_uses_detail_normals=False). Also reports the time of both paths.
+
+    python gdl_apps/EMOCA/benchmarks/decode_outputs.py
+    python gdl_apps/EMOCA/benchmarks/decode_outputs.py --input clip.mp4 --device cpu
+    python gdl_apps/EMOCA/benchmarks/decode_outputs.py --synthetic # random weights and synthetic faces, no checkpoint
+"""
+import argparse
+import importlib.util
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+import gdl
+from gdl.utils.AssetBundle import get_asset_bundle
+
+
+# the requested output sets that are compared, the ones with detail outputs are skipped for coarse models
+OUTPUT_SETS = [
+    {"geometry_detail"},
+    {"geometry_coarse"},
+    {"verts", "trans_verts"},
+    {"uv_detail_normals"},
+    {"geometry_coarse", "geometry_detail"},
+]
+DETAIL_OUTPUTS = {"geometry_detail", "uv_detail_normals", "uv_z", "displacement_map"}
+
+# the renderer modules, the root one is the deployed overlay of gdl/models/Renderer.py
+RENDERER_FILES = {
+    "gdl": Path(gdl.__file__).parent / "models" / "Renderer.py",
+    "root": Path(gdl.__file__).parents[1] / "Renderer.py",
+}
+
+
+def load_renderer(name, config, device):
+    """
+    SRenderY of the renderer module (loaded from its file, both define the same module name) set up like
+    DECA._setup_renderer does it.
+    """
+    spec = importlib.util.spec_from_file_location("decode_outputs_renderer_" + name, RENDERER_FILES[name])
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    renderer = module.SRenderY(config.image_size, obj_filename=config.topology_path, uv_size=config.uv_size,
+                               asset_bundle=get_asset_bundle(config))
+    return renderer.to(device)
+
+
+def load_codes(emoca, args):
+    """
+    The codes of the faces of the clip (or of synthetic faces), encoded once so both paths decode the same values.
+    """
+    if args.synthetic:
+        from gdl_apps.EMOCA.benchmarks.video_pipeline.synthetic import draw_frame
+        rng = np.random.default_rng(args.seed)
+        images = torch.from_numpy(np.stack([draw_frame(224, 224, 1, fid, rng) for fid in range(args.max_frames)]))
+        images = images.permute(0, 3, 1, 2).float() / 255.
+    else:
+        from gdl_apps.EMOCA.benchmarks.inference_precision import load_faces
+        images = load_faces(args.input, args.max_frames)
+    with torch.no_grad():
+        return emoca.encode({"image": images.to(emoca.device)}, training=False)
+
+
+def copy_codes(codes):
+    # both paths add their results into the dict they decode
+    return {key: value.clone() if isinstance(value, torch.Tensor) else value for key, value in codes.items()}
+
+
+def decode_full(emoca, codes):
+    values = emoca.decode(copy_codes(codes), training=False)
+    visdict, _ = emoca._visualization_checkpoint(values['verts'], values['trans_verts'], values['ops'],
+        values.get('uv_detail_normals', None), values, 0, "", "", save=False)
+    return values, visdict
+
+
+def reference_value(key, values, visdict):
+    if key in ["geometry_coarse", "geometry_detail"]:
+        return visdict[key]
+    return values[key]
+
+
+def compared(key, value):
+    # the renderer shifts the depth of trans_verts in place every time it rasterizes, so only x and y are compared
+    if key == "trans_verts":
+        return value[..., :2]
+    return value
+
+
+def timed_run(fn, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    with torch.no_grad():
+        result = fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str,
+        default=str(Path(gdl.__file__).parents[1] / "assets/data/EMOCA_test_example_data/videos/82-25-854x480_affwild2.mp4"),
+        help="The fixed clip (a video or a folder of images).")
+    parser.add_argument('--max_frames', type=int, default=20, help="Only the faces of the first frames of the clip are used.")
+    parser.add_argument('--model_name', type=str, default='EMOCA_v2_lr_mse_20')
+    parser.add_argument('--path_to_models', type=str, default=str(Path(gdl.__file__).parents[1] / "assets/EMOCA/models"))
+    parser.add_argument('--mode', type=str, default="detail", choices=["detail", "coarse"])
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--renderers', type=str, nargs='+', default=["gdl", "root"], choices=list(RENDERER_FILES.keys()))
+    parser.add_argument('--synthetic', action='store_true',
+        help="Random weights (only the cfg.yaml of the model is needed) and synthetic faces instead of the clip.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--atol', type=float, default=1e-5)
+    parser.add_argument('--rtol', type=float, default=1e-4)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    if args.synthetic:
+        from gdl_apps.EMOCA.benchmarks.video_pipeline.synthetic import build_stub_model
+        emoca = build_stub_model(args.path_to_models, args.model_name, args.mode, seed=args.seed)
+    else:
+        from gdl_apps.EMOCA.utils.load import load_model
+        emoca, conf = load_model(args.path_to_models, args.model_name, args.mode)
+    emoca.to(device)
+    emoca.eval()
+    codes = load_codes(emoca, args)
+    output_sets = [outputs for outputs in OUTPUT_SETS if args.mode == "detail" or len(outputs & DETAIL_OUTPUTS) == 0]
+
+    print("%-10s %-32s %12s %12s %14s %s" % ("renderer", "outputs", "full [ms]", "outputs [ms]", "max abs err", "equal"))
+    failures = []
+    for renderer_name in args.renderers:
+        if not RENDERER_FILES[renderer_name].is_file():
+            print("%-10s skipped, '%s' does not exist" % (renderer_name, RENDERER_FILES[renderer_name]))
+            continue
+        emoca.deca.render = load_renderer(renderer_name, emoca.deca.config, device)
+        (values, visdict), full_time = timed_run(lambda: decode_full(emoca, codes), device)
+        for outputs in output_sets:
+            decoded, outputs_time = timed_run(lambda: emoca.decode(copy_codes(codes), training=False, outputs=outputs), device)
+            errors = {}
+            equal = True
+            for key in sorted(outputs):
+                reference = compared(key, reference_value(key, values, visdict))
+                value = compared(key, decoded[key])
+                if value.shape != reference.shape:
+                    errors[key] = float("inf")
+                else:
+                    errors[key] = (value - reference).abs().max().item()
+                if value.shape != reference.shape or not torch.allclose(value, reference, atol=args.atol, rtol=args.rtol):
+                    equal = False
+                    failures += ["%s renderer, outputs %s: '%s' differs (max abs error %.3e)"
+                                 % (renderer_name, sorted(outputs), key, errors[key])]
+            print("%-10s %-32s %12.2f %12.2f %14.3e %s" % (renderer_name, ",".join(sorted(outputs)), 1000. * full_time,
+                                                          1000. * outputs_time, max(errors.values()), equal))
+    if len(failures) > 0:
+        raise AssertionError("Output-driven decoding differs from the full path:\n" + "\n".join(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+Checks that an interrupted and resumed face detection with tracking gives exactly the same detection store as an
+uninterrupted one. The detection of the clip is stopped after --interrupt_frame frames (like a killed process, the
+frames detected since the last commit are lost), continued by a new data module from the store it left behind, and
+every column of the store (frames, centers, sizes, landmarks, sources and the face crops) is compared bit for bit
+with the one of a straight run.
+
+Needs ffmpeg for the synthetic clip (or --input and the FAN weights).
+
+    python -m gdl_apps.EMOCA.benchmarks.detection_resume
+    python -m gdl_apps.EMOCA.benchmarks.detection_resume --num_frames 300 --interrupt_frame 157 --keyframe_interval 25
+    python -m gdl_apps.EMOCA.benchmarks.detection_resume --input clip.mp4 --device cuda
+"""
+import argparse
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from gdl.datasets.DetectionStore import DetectionStore
+from gdl_apps.EMOCA.benchmarks.video_pipeline.synthetic import write_synthetic_clip, SyntheticFaceDetector
+
+
+class Interrupted(Exception):
+    pass
+
+
+def detect(clip, output_dir, args, interrupt_frame=None):
+    """
+    Runs the tracked detection of the clip into output_dir, stops (by raising in the tracker) once interrupt_frame
+    frames were processed. Returns the path of the detection store.
+    """
+    from gdl.datasets.FaceVideoDataModule import TestFaceVideoDM
+    dm = TestFaceVideoDM(clip, str(output_dir), processed_subfolder="processed", num_workers=0,
+        device=torch.device(args.device), unpack_videos=False, save_detection_images=False,
+        face_tracking=True, tracking_keyframe_interval=args.keyframe_interval)
+    dm._detection_checkpoint_frequency = args.checkpoint_frequency
+    if args.input is None:
+        dm.face_detector = SyntheticFaceDetector(args.num_faces)
+    dm._gather_data(exist_ok=True)
+
+    if interrupt_frame is not None:
+        track_faces_in_image = dm._track_faces_in_image
+        processed = [0]
+
+        def track_until_interrupted(image_or_path):
+            if processed[0] == interrupt_frame:
+                raise Interrupted()
+            processed[0] += 1
+            return track_faces_in_image(image_or_path)
+        dm._track_faces_in_image = track_until_interrupted
+
+    try:
+        dm._detect_faces()
+    except Interrupted:
+        pass
+    return DetectionStore.path_for(dm._get_path_to_sequence_detections(0) / "bboxes.pkl")
+
+
+def compare_stores(path, reference_path):
+    """
+    The differing columns of the two stores, as a list of messages.
+    """
+    store, reference = DetectionStore(path), DetectionStore(reference_path)
+    differences = []
+    if store.last_frame_id != reference.last_frame_id:
+        differences += ["last frame %d instead of %d" % (store.last_frame_id, reference.last_frame_id)]
+    if len(store.store) != len(reference.store):
+        return differences + ["%d detections instead of %d" % (len(store.store), len(reference.store))]
+    for name in sorted(set(store.store.columns) | set(reference.store.columns)):
+        if name not in store.store.columns or name not in reference.store.columns:
+            differences += ["column '%s' is missing in one of the stores" % name]
+            continue
+        values, reference_values = store.store.column(name), reference.store.column(name)
+        if values.dtype != reference_values.dtype:
+            differences += ["column '%s' is %s instead of %s" % (name, values.dtype, reference_values.dtype)]
+        elif not np.array_equal(values, reference_values):
+            rows = np.nonzero(np.any((values != reference_values).reshape(len(values), -1), axis=1))[0]
+            differences += ["column '%s' differs in %d rows, the first in frame %d"
+                            % (name, len(rows), reference.store.frame_ids[rows[0]])]
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, default=None, help="A video (detected with FAN), a synthetic clip by default.")
+    parser.add_argument('--num_frames', type=int, default=120, help="Length of the synthetic clip.")
+    parser.add_argument('--num_faces', type=int, default=2, help="Faces of the synthetic clip.")
+    parser.add_argument('--resolution', type=str, default="640x360", help="Resolution of the synthetic clip.")
+    parser.add_argument('--interrupt_frame', type=int, default=57, help="Number of frames detected before the interruption.")
+    parser.add_argument('--checkpoint_frequency', type=int, default=20, help="Frames between the commits of the store.")
+    parser.add_argument('--keyframe_interval', type=int, default=10)
+    parser.add_argument('--device', type=str, default="cpu")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ffmpeg', type=str, default="ffmpeg")
+    parser.add_argument('--work_dir', type=str, default=str(Path(tempfile.gettempdir()) / "detection_resume_check"))
+    parser.add_argument('--keep_work_dir', action='store_true')
+    args = parser.parse_args()
+
+    work_dir = Path(args.work_dir)
+    if work_dir.exists():
+        shutil.rmtree(work_dir)
+    if args.input is None:
+        width, height = [int(v) for v in args.resolution.lower().split("x")]
+        clip = write_synthetic_clip(work_dir / "clip.mp4", width, height, args.num_frames, args.num_faces,
+                                    seed=args.seed, ffmpeg=args.ffmpeg)
+    else:
+        clip = Path(args.input)
+
+    straight = detect(clip, work_dir / "straight", args)
+    interrupted = detect(clip, work_dir / "resumed", args, interrupt_frame=args.interrupt_frame)
+    last_frame_id = DetectionStore(interrupted).last_frame_id
+    if last_frame_id < 0 or last_frame_id >= DetectionStore(straight).last_frame_id:
+        raise RuntimeError("Nothing to resume, the interrupted detection committed up to frame %d "
+                           "(change --interrupt_frame or --checkpoint_frequency)" % last_frame_id)
+    print("Interrupted after frame %d, the store is committed up to frame %d" % (args.interrupt_frame - 1, last_frame_id))
+    resumed = detect(clip, work_dir / "resumed", args)
+
+    differences = compare_stores(resumed, straight)
+    if not args.keep_work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if len(differences) > 0:
+        raise AssertionError("The resumed detection differs from the straight one:\n" + "\n".join(differences))
+    print("The resumed detection is identical to the straight one")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Compares the vectorized gdl.utils.DecaUtils.generate_triangles with the original per-pixel loop
+(the dense UV mesh built by SRenderY.__init__) across UV sizes. The outputs must be identical, including
+the order of the faces, which the dense vertex normals depend on.
+
+    python gdl_apps/EMOCA/benchmarks/generate_triangles.py
+    python gdl_apps/EMOCA/benchmarks/generate_triangles.py --uv_sizes 256 1024 --skip_reference_above 512
+"""
+import argparse
+import time
+
+import numpy as np
+
+from gdl.utils.DecaUtils import generate_triangles
+
+
+def generate_triangles_reference(h, w):
+    """
+    The original implementation, kept only as the reference of the benchmark.
+    """
+    triangles = []
+    margin = 0
+    for x in range(margin, w - 1 - margin):
+        for y in range(margin, h - 1 - margin):
+            triangle0 = [y * w + x, y * w + x + 1, (y + 1) * w + x]
+            triangle1 = [y * w + x + 1, (y + 1) * w + x + 1, (y + 1) * w + x]
+            triangles.append(triangle0)
+            triangles.append(triangle1)
+    triangles = np.array(triangles)
+    triangles = triangles[:, [0, 2, 1]]
+    return triangles
+
+
+def timed(fn, *args, repeats=1):
+    best = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def check_mask(uv_size):
+    """
+    A full mask has to give the unmasked triangles, an empty one none of them.
+    """
+    triangles = generate_triangles(uv_size, uv_size)
+    assert np.array_equal(generate_triangles(uv_size, uv_size, mask=np.ones((uv_size, uv_size))), triangles)
+    assert len(generate_triangles(uv_size, uv_size, mask=np.zeros((uv_size, uv_size)))) == 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--uv_sizes', type=int, nargs='+', default=[256, 512, 1024, 2048])
+    parser.add_argument('--repeats', type=int, default=3, help="The best time of this many runs is reported.")
+    parser.add_argument('--skip_reference_above', type=int, default=2048,
+        help="The loop is not run for larger UV sizes (it takes minutes and a lot of memory at 2048).")
+    args = parser.parse_args()
+
+    print("%8s %14s %14s %10s %s" % ("uv_size", "reference [s]", "vectorized [s]", "speedup", "equal"))
+    for uv_size in args.uv_sizes:
+        triangles, vectorized_time = timed(generate_triangles, uv_size, uv_size, repeats=args.repeats)
+        if uv_size <= args.skip_reference_above:
+            reference, reference_time = timed(generate_triangles_reference, uv_size, uv_size)
+            equal = reference.dtype == triangles.dtype and np.array_equal(reference, triangles)
+            print("%8d %14.3f %14.4f %9.1fx %s" % (uv_size, reference_time, vectorized_time,
+                                                   reference_time / vectorized_time, equal))
+            if not equal:
+                raise AssertionError("The vectorized triangles differ from the reference for uv_size %d" % uv_size)
+        else:
+            print("%8d %14s %14.4f %10s %s" % (uv_size, "-", vectorized_time, "-", "-"))
+        check_mask(min(uv_size, 64))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Measures the startup cost of the inference path. Every module is imported in a fresh interpreter
+(python -X importtime), so nothing is shared between the measurements, and the slowest imports it pulls in are reported.
+It also lists the training-only/optional dependencies that got imported, which should not happen for the inference modules.
+
+    python gdl_apps/EMOCA/benchmarks/import_time.py
+    python gdl_apps/EMOCA/benchmarks/import_time.py --modules gdl.models.DECA --top 30
+"""
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+
+INFERENCE_MODULES = [
+    "gdl_apps.EMOCA.utils.load",
+    "gdl_apps.EMOCA.utils.io",
+    "gdl.models.DECA",
+    "gdl.datasets.FaceVideoDataModule",
+]
+
+# these should only be imported when training or when an optional feature is used
+TRAINING_ONLY_MODULES = [
+    "adabound",
+    "wandb",
+    "pandas",
+    "imgaug",
+    "facenet_pytorch",
+    "hickle",
+    "compress_pickle",
+    "skvideo",
+    "gdl.datasets.AffectNetDataModule",
+    "gdl.datasets.AffWild2Dataset",
+    "gdl.layers.losses.EmoNetLoss",
+    "gdl.layers.losses.DecaLosses",
+    "gdl.layers.losses.VGGLoss",
+]
+
+
+def measure_import(module, python=sys.executable):
+    """
+    Imports the module in a new interpreter. Returns a dict {imported module: (self us, cumulative us)}.
+    """
+    result = subprocess.run([python, "-X", "importtime", "-c", "import %s" % module],
+        cwd=str(Path(__file__).parents[3]), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError("Importing '%s' failed:\n%s" % (module, result.stderr.splitlines()[-1] if result.stderr else ""))
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time:  self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def report(module, times, top=15):
+    total = times.get(module, (0, max([t[1] for t in times.values()] or [0])))[1]
+    print("%s: %.2f s (%d modules)" % (module, total / 1e6, len(times)))
+    slowest = sorted(times.items(), key=lambda item: item[1][1], reverse=True)[:top]
+    for name, (self_us, cumulative_us) in slowest:
+        print("    %8.1f ms cumulative %8.1f ms self  %s" % (cumulative_us / 1e3, self_us / 1e3, name))
+    unwanted = [name for name in TRAINING_ONLY_MODULES if name in times]
+    if len(unwanted) > 0:
+        print("    training-only/optional modules imported: " + ", ".join(unwanted))
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modules', type=str, nargs='+', default=INFERENCE_MODULES, help="Modules to import.")
+    parser.add_argument('--top', type=int, default=15, help="Number of the slowest (cumulative) imports reported per module.")
+    args = parser.parse_args()
+
+    for module in args.modules:
+        report(module, measure_import(module), args.top)
+
+
+if __name__ == '__main__':
+    main()
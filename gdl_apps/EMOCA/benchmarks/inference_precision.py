@@ -0,0 +1,111 @@
+"""
+Regression harness of the inference precisions (DecaModule.set_inference_precision). Runs the model on the faces of
+a fixed clip in fp32 and in each of the requested precisions (optionally also in channels_last) and reports the
+largest deviation from fp32 of the vertices, the displacement map (uv_z) and the exported UV image (geometry_detail),
+together with the time per face.
+
+    python gdl_apps/EMOCA/benchmarks/inference_precision.py
+    python gdl_apps/EMOCA/benchmarks/inference_precision.py --input clip.mp4 --precisions bf16 --channels_last --device cpu
+    python gdl_apps/EMOCA/benchmarks/inference_precision.py --max_vertex_error 1e-3 --max_uv_error 1e-2
+"""
+import argparse
+import time
+from pathlib import Path
+
+import torch
+
+import gdl
+from gdl.datasets.ImageTestDataset import TestData
+from gdl_apps.EMOCA.utils.load import load_model
+from gdl_apps.EMOCA.utils.io import test
+
+
+# the compared outputs, the UV image is what videoFacesToUVNDC.py exports
+COMPARED_OUTPUTS = {"verts": "vertex", "uv_z": "displacement", "geometry_detail": "UV image"}
+
+
+def load_faces(input_path, max_frames):
+    """
+    The face crops of the first max_frames images (or video frames) of the clip as one [N, 3, 224, 224] tensor.
+    """
+    dataset = TestData(str(input_path), face_detector="fan", max_detection=20)
+    images = []
+    for i in range(min(len(dataset), max_frames)):
+        images += [dataset[i]["image"]]
+    return torch.cat(images, dim=0)
+
+
+def run(emoca, images, batch_size, outputs):
+    """
+    Returns the requested outputs of all the faces (on the CPU) and the time per face in ms.
+    """
+    results = {key: [] for key in outputs}
+    elapsed = 0.
+    with torch.no_grad():
+        for start in range(0, images.shape[0], batch_size):
+            batch = {"image": images[start:start + batch_size]}
+            if emoca.device.type == "cuda":
+                torch.cuda.synchronize(emoca.device)
+            start_time = time.perf_counter()
+            vals, visdict = test(emoca, batch, outputs=set(outputs))
+            if emoca.device.type == "cuda":
+                torch.cuda.synchronize(emoca.device)
+            elapsed += time.perf_counter() - start_time
+            for key in outputs:
+                results[key] += [vals[key].float().cpu()]
+    return {key: torch.cat(values, dim=0) for key, values in results.items()}, 1000. * elapsed / images.shape[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str,
+        default=str(Path(gdl.__file__).parents[1] / "assets/data/EMOCA_test_example_data/videos/82-25-854x480_affwild2.mp4"),
+        help="The fixed clip (a video or a folder of images).")
+    parser.add_argument('--max_frames', type=int, default=100, help="Only the faces of the first frames of the clip are used.")
+    parser.add_argument('--model_name', type=str, default='EMOCA_v2_lr_mse_20')
+    parser.add_argument('--path_to_models', type=str, default=str(Path(gdl.__file__).parents[1] / "assets/EMOCA/models"))
+    parser.add_argument('--mode', type=str, default="detail", choices=["detail", "coarse"])
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--batch_size', type=int, default=20)
+    parser.add_argument('--precisions', type=str, nargs='+', default=["bf16", "fp16"], choices=["fp32", "bf16", "fp16"])
+    parser.add_argument('--channels_last', action='store_true', help="Also runs every precision in channels_last.")
+    parser.add_argument('--max_vertex_error', type=float, default=None, help="Fails if a vertex deviates more from fp32.")
+    parser.add_argument('--max_uv_error', type=float, default=None, help="Fails if a UV image pixel deviates more from fp32.")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    emoca, conf = load_model(args.path_to_models, args.model_name, args.mode)
+    emoca.to(device)
+    emoca.eval()
+    outputs = [key for key in COMPARED_OUTPUTS if args.mode == "detail" or key == "verts"]
+
+    images = load_faces(args.input, args.max_frames)
+    print(f"{images.shape[0]} faces of '{args.input}' on {device}")
+
+    emoca.set_inference_precision("fp32", channels_last=False)
+    reference, reference_time = run(emoca, images, args.batch_size, outputs)
+
+    print("%-22s %10s " % ("precision", "ms/face") + " ".join("%16s" % ("max " + COMPARED_OUTPUTS[key] + " err") for key in outputs))
+    print("%-22s %10.2f " % ("fp32", reference_time) + " ".join("%16s" % "-" for key in outputs))
+    failures = []
+    for precision in args.precisions:
+        if precision == "fp16" and device.type == "cpu":
+            print("%-22s skipped, fp16 autocast needs a GPU" % precision)
+            continue
+        for channels_last in ([False, True] if args.channels_last else [False]):
+            name = precision + (" channels_last" if channels_last else "")
+            emoca.set_inference_precision(precision, channels_last=channels_last)
+            results, face_time = run(emoca, images, args.batch_size, outputs)
+            errors = {key: (results[key] - reference[key]).abs().max().item() for key in outputs}
+            print("%-22s %10.2f " % (name, face_time) + " ".join("%16.3e" % errors[key] for key in outputs))
+            if args.max_vertex_error is not None and errors["verts"] > args.max_vertex_error:
+                failures += ["%s: vertex error %.3e" % (name, errors["verts"])]
+            if args.max_uv_error is not None and "geometry_detail" in errors and errors["geometry_detail"] > args.max_uv_error:
+                failures += ["%s: UV image error %.3e" % (name, errors["geometry_detail"])]
+    emoca.set_inference_precision("fp32", channels_last=False)
+    if len(failures) > 0:
+        raise AssertionError("The precisions deviate too much from fp32:\n" + "\n".join(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Per-stage measurements of the video pipeline benchmark: wall time, peak RSS and the bytes the process read and wrote.
+The memory and I/O counters come from /proc (Linux), elsewhere only the wall time and the peak RSS of the whole
+process so far (getrusage) are reported.
+"""
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+IO_COUNTERS = {"rchar": "read_chars", "wchar": "write_chars", "read_bytes": "read_bytes", "write_bytes": "write_bytes"}
+
+
+def read_io_counters():
+    """
+    The I/O of the process so far: read_chars/write_chars are all the bytes passed through read/write calls
+    (including the pipes, i.e. the frames streamed from ffmpeg), read_bytes/write_bytes are the ones that hit the storage.
+    """
+    try:
+        with open("/proc/self/io", "r") as f:
+            counters = dict(line.split(":") for line in f.read().splitlines() if ":" in line)
+    except OSError:
+        return {}
+    return {name: int(counters[key]) for key, name in IO_COUNTERS.items() if key in counters}
+
+
+def reset_peak_rss():
+    """
+    Resets the peak RSS (VmHWM) of the process, so that the next read_peak_rss only covers what follows.
+    Returns False if it is not supported.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def read_peak_rss():
+    """
+    The peak RSS in bytes since the last reset_peak_rss (or since the start of the process).
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is not None:
+        # kilobytes on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return None
+
+
+def folder_size(path):
+    return sum(f.stat().st_size for f in Path(path).rglob("*") if f.is_file()) if Path(path).is_dir() else 0
+
+
+class StageMeter(object):
+    """
+    Accumulates the measurements of the stages of a run. A stage can be entered several times (i.e. once per batch),
+    its wall time and I/O add up and its peak RSS is the largest one. The I/O of the background writer threads counts
+    towards the stage during which it happens.
+
+    Usage:
+        meter = StageMeter()
+        with meter.stage("detect_faces"):
+            ...
+        meter.results(num_frames)
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        reset_peak_rss()
+        io_start = read_io_counters()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - start
+            io_end = read_io_counters()
+            peak_rss = read_peak_rss()
+            stats = self.stages.setdefault(name, {"wall_s": 0., "calls": 0, "peak_rss_bytes": None})
+            stats["wall_s"] += wall_time
+            stats["calls"] += 1
+            if peak_rss is not None:
+                stats["peak_rss_bytes"] = max(stats["peak_rss_bytes"] or 0, peak_rss)
+            for key in io_end:
+                stats[key] = stats.get(key, 0) + io_end[key] - io_start.get(key, 0)
+
+    def results(self, num_frames, pipeline_stages=None):
+        """
+        The stages with their frames/s and the totals over pipeline_stages (all the stages by default).
+        """
+        pipeline_stages = pipeline_stages or list(self.stages.keys())
+        stages = OrderedDict()
+        for name, stats in self.stages.items():
+            stages[name] = dict(stats)
+            stages[name]["fps"] = num_frames / stats["wall_s"] if stats["wall_s"] > 0 else None
+        measured = [self.stages[name] for name in pipeline_stages if name in self.stages]
+        total = {"wall_s": sum(stats["wall_s"] for stats in measured)}
+        total["fps"] = num_frames / total["wall_s"] if total["wall_s"] > 0 else None
+        peaks = [stats["peak_rss_bytes"] for stats in measured if stats["peak_rss_bytes"] is not None]
+        total["peak_rss_bytes"] = max(peaks) if len(peaks) > 0 else None
+        for key in IO_COUNTERS.values():
+            total[key] = sum(stats.get(key, 0) for stats in measured)
+        return stages, total
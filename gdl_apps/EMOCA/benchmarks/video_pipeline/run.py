@@ -0,0 +1,240 @@
+"""
+Reproducible end-to-end benchmark of the video -> UV NDC pipeline (videoFacesToUVNDC.py) on the CPU. A synthetic clip
+is run through the face detection, the model (with random weights) and the export of the UV NDC TIFFs for every
+combination of resolution, batch size and number of faces, and the wall time, frames/s, peak RSS and bytes
+read/written of each stage are written into a JSON file. Every combination runs in its own process, so the peak RSS
+and the caches of one do not leak into the next.
+
+Needs ffmpeg, the FLAME assets and the cfg.yaml of the model (not its checkpoint).
+
+    python -m gdl_apps.EMOCA.benchmarks.video_pipeline.run --out before.json
+    python -m gdl_apps.EMOCA.benchmarks.video_pipeline.run --out after.json --compare before.json
+    python -m gdl_apps.EMOCA.benchmarks.video_pipeline.run --resolutions 1920x1080 --batch_sizes 16 --face_counts 1 2 4
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import torch
+
+import gdl
+from gdl.utils.AsyncWriter import AsyncWriter
+from gdl_apps.EMOCA.benchmarks.video_pipeline.measure import StageMeter, folder_size
+from gdl_apps.EMOCA.benchmarks.video_pipeline.synthetic import write_synthetic_clip, SyntheticFaceDetector, build_stub_model
+
+
+RESULTS_VERSION = 1
+
+# the stages of videoFacesToUVNDC.py, the synthetic clip and the model are set up outside of the measured pipeline
+PIPELINE_STAGES = ["prepare_data", "detect_faces", "setup", "load_batch", "encode", "decode", "save_images", "export"]
+
+
+def cell_name(cell):
+    return "%s_bs%d_faces%d" % (cell["resolution"], cell["batch_size"], cell["num_faces"])
+
+
+def parse_resolution(resolution):
+    width, height = resolution.lower().split("x")
+    return int(width), int(height)
+
+
+def run_cell(cell, args):
+    """
+    Runs the pipeline on one combination of the matrix and returns its measurements.
+    """
+    # imported here, the data module and the io pull in the whole model stack
+    from gdl.datasets.FaceVideoDataModule import TestFaceVideoDM
+    from gdl_apps.EMOCA.utils.io import decode, save_images
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cpu")
+    width, height = parse_resolution(cell["resolution"])
+    work_dir = Path(args.work_dir) / cell_name(cell)
+    if work_dir.exists():
+        shutil.rmtree(work_dir)
+
+    meter = StageMeter()
+    with meter.stage("synthesize_clip"):
+        clip = write_synthetic_clip(work_dir / "clip.mp4", width, height, args.num_frames, cell["num_faces"],
+                                    seed=args.seed, ffmpeg=args.ffmpeg)
+    with meter.stage("load_model"):
+        emoca = build_stub_model(args.path_to_models, args.model_name, args.mode, seed=args.seed)
+        emoca.to(device)
+
+    dm = TestFaceVideoDM(clip, str(work_dir / "tmp"), processed_subfolder="processed",
+        batch_size=cell["batch_size"], num_workers=0, device=device,
+        unpack_videos=args.unpack_frames, save_detection_images=args.save_detection_images,
+        face_detector_batch_size=cell["batch_size"])
+    if not hasattr(dm, "create_reconstruction_frames"):
+        raise RuntimeError("The export needs the deployed FaceVideoDataModule.py (with create_reconstruction_frames)")
+    dm.face_detector = SyntheticFaceDetector(cell["num_faces"])
+
+    # TestFaceVideoDM.prepare_data, split into its stages
+    with meter.stage("prepare_data"):
+        dm._gather_data(exist_ok=True)
+        if dm.unpack_videos:
+            dm._unpack_videos()
+    with meter.stage("detect_faces"):
+        dm._detect_faces()
+    with meter.stage("setup"):
+        dm.setup()
+        dl = dm.test_dataloader()
+
+    # export_video of videoFacesToUVNDC.py
+    name = clip.stem
+    out_folder = work_dir / "output"
+    dest_path = out_folder / name
+    dest_path.mkdir(parents=True, exist_ok=True)
+    writer = AsyncWriter(num_workers=args.num_writers) if args.num_writers > 0 else None
+    num_faces = 0
+    batches = iter(dl)
+    with torch.no_grad():
+        while True:
+            with meter.stage("load_batch"):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            with meter.stage("encode"):
+                batch["image"] = batch["image"].to(device)
+                vals = emoca.encode(batch, training=False)
+            with meter.stage("decode"):
+                vals, visdict = decode(emoca, vals, training=False, outputs={"geometry_detail"})
+            if args.save_reconstructions:
+                with meter.stage("save_images"):
+                    for i in range(len(batch["image_name"])):
+                        save_images(str(out_folder / "results"), batch["image_name"][i], visdict, i, writer=writer)
+            with meter.stage("export"):
+                dm.create_reconstruction_frames(0, visdict["geometry_detail"], batch["frame_id"], batch["face_id"],
+                    batch["center"], batch["size"], dest_path, image_type="geometry_detail", out_name=name,
+                    tiff_dtype=args.tiff_dtype, tiff_compression=args.tiff_compression, writer=writer)
+            num_faces += len(batch["image_name"])
+    if writer is not None:
+        # the writes still in flight belong to the export
+        with meter.stage("export"):
+            writer.close()
+
+    stages, total = meter.results(args.num_frames, PIPELINE_STAGES)
+    result = {
+        "name": cell_name(cell),
+        "config": dict(cell, num_frames=args.num_frames, unpack_frames=args.unpack_frames,
+                       save_detection_images=args.save_detection_images, save_reconstructions=args.save_reconstructions,
+                       tiff_dtype=args.tiff_dtype, tiff_compression=args.tiff_compression,
+                       num_writers=args.num_writers, threads=torch.get_num_threads(), seed=args.seed),
+        "num_faces_reconstructed": num_faces,
+        "stages": stages,
+        "total": total,
+        "output_bytes": folder_size(out_folder),
+        "intermediate_bytes": folder_size(work_dir / "tmp"),
+    }
+    if not args.keep_work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+
+def run_cell_in_subprocess(cell, argv):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cell_output = Path(tmp_dir) / "cell.json"
+        cmd = [sys.executable, "-m", "gdl_apps.EMOCA.benchmarks.video_pipeline.run", *argv,
+               "--cell", json.dumps(cell), "--cell_output", str(cell_output)]
+        subprocess.run(cmd, check=True)
+        with open(cell_output, "r") as f:
+            return json.load(f)
+
+
+def environment():
+    repo = Path(gdl.__file__).parents[1]
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "torch": torch.__version__,
+            "platform": platform.platform(), "processor": platform.processor(), "cpu_count": os.cpu_count(),
+            "torch_threads": torch.get_num_threads()}
+
+
+def print_results(results, baseline=None):
+    baseline_cells = {cell["name"]: cell for cell in baseline["cells"]} if baseline is not None else {}
+    print("%-28s %10s %10s %12s %12s" % ("cell", "total s", "fps", "peak RSS MB", "written MB")
+          + ("  %10s" % "vs baseline" if baseline is not None else ""))
+    for cell in results["cells"]:
+        total = cell["total"]
+        line = "%-28s %10.2f %10.2f %12.1f %12.1f" % (cell["name"], total["wall_s"], total["fps"] or 0.,
+            (total["peak_rss_bytes"] or 0) / 2 ** 20, total.get("write_chars", 0) / 2 ** 20)
+        if cell["name"] in baseline_cells:
+            line += "  %9.2fx" % (baseline_cells[cell["name"]]["total"]["wall_s"] / total["wall_s"])
+        print(line)
+        for stage in PIPELINE_STAGES:
+            if stage not in cell["stages"]:
+                continue
+            stats = cell["stages"][stage]
+            line = "  %-26s %10.2f %10.2f %12.1f %12.1f" % (stage, stats["wall_s"], stats["fps"] or 0.,
+                (stats["peak_rss_bytes"] or 0) / 2 ** 20, stats.get("write_chars", 0) / 2 ** 20)
+            baseline_stages = baseline_cells.get(cell["name"], {}).get("stages", {})
+            if stage in baseline_stages:
+                line += "  %9.2fx" % (baseline_stages[stage]["wall_s"] / stats["wall_s"])
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resolutions', type=str, nargs='+', default=["640x360", "1280x720"])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[4, 16])
+    parser.add_argument('--face_counts', type=int, nargs='+', default=[1, 3])
+    parser.add_argument('--num_frames', type=int, default=48)
+    parser.add_argument('--model_name', type=str, default='EMOCA_v2_lr_mse_20')
+    parser.add_argument('--path_to_models', type=str, default=str(Path(gdl.__file__).parents[1] / "assets/EMOCA/models"))
+    parser.add_argument('--mode', type=str, default="detail", choices=["detail", "coarse"])
+    parser.add_argument('--unpack_frames', action='store_true', help="Writes the frames to disk instead of streaming them.")
+    parser.add_argument('--save_detection_images', action='store_true', help="Writes the face crops to disk.")
+    parser.add_argument('--save_reconstructions', action='store_true', help="Also saves the reconstruction of every face.")
+    parser.add_argument('--tiff_dtype', type=str, default="uint16", choices=["uint16", "float16", "float32"])
+    parser.add_argument('--tiff_compression', type=str, default="zlib")
+    parser.add_argument('--num_writers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=0, help="Number of torch threads, 0 keeps the default.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ffmpeg', type=str, default="ffmpeg")
+    parser.add_argument('--work_dir', type=str, default=str(Path(tempfile.gettempdir()) / "video_pipeline_benchmark"))
+    parser.add_argument('--keep_work_dir', action='store_true')
+    parser.add_argument('--out', type=str, default="video_pipeline_benchmark.json")
+    parser.add_argument('--compare', type=str, default=None, help="A previous result file to compare the times with.")
+    # internal, a single cell of the matrix run by the parent process
+    parser.add_argument('--cell', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--cell_output', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cell is not None:
+        result = run_cell(json.loads(args.cell), args)
+        with open(args.cell_output, "w") as f:
+            json.dump(result, f)
+        return
+
+    # the options shared by all the cells are passed on as they are
+    argv = sys.argv[1:]
+    cells = [{"resolution": resolution, "batch_size": batch_size, "num_faces": num_faces}
+             for resolution, batch_size, num_faces in itertools.product(args.resolutions, args.batch_sizes, args.face_counts)]
+    results = {"version": RESULTS_VERSION, "environment": environment(), "cells": []}
+    for i, cell in enumerate(cells):
+        print("[%d/%d] %s" % (i + 1, len(cells), cell_name(cell)))
+        results["cells"] += [run_cell_in_subprocess(cell, argv)]
+        # written after every cell, so an interrupted run keeps what it measured
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    print("Results written to '%s'" % args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+The synthetic inputs of the video pipeline benchmark: a generated clip with a known number of faces at known
+positions, a face detector that returns exactly these faces (so neither the FAN weights nor real footage are needed)
+and the model with randomly initialized weights (only the config and the FLAME assets are needed, no checkpoint).
+Everything is seeded, so two runs (i.e. on two commits) process the same pixels with the same weights.
+"""
+import subprocess
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf, open_dict
+
+from gdl.utils.FaceDetector import FaceDetector
+
+
+def face_boxes(width, height, num_faces):
+    """
+    The [left, top, right, bottom] boxes of the faces of the clip, side by side in the middle of the frame.
+    """
+    size = min(0.5 * height, width / (num_faces + 1))
+    boxes = []
+    for fi in range(num_faces):
+        cx = width * (fi + 1) / (num_faces + 1)
+        cy = height / 2
+        boxes += [[cx - size / 2, cy - size / 2, cx + size / 2, cy + size / 2]]
+    return boxes
+
+
+def _landmark_template():
+    """
+    A rough 68 point (iBUG) face layout in the unit square: jaw, brows, nose, eyes and mouth.
+    """
+    jaw = [(0.5 + 0.5 * np.cos(a), 0.35 + 0.65 * np.sin(a)) for a in np.linspace(np.pi, 0, 17)]
+    brows = [(0.1 + 0.3 * t, 0.25 - 0.05 * np.sin(np.pi * t)) for t in np.linspace(0, 1, 5)] \
+        + [(0.6 + 0.3 * t, 0.25 - 0.05 * np.sin(np.pi * t)) for t in np.linspace(0, 1, 5)]
+    nose = [(0.5, 0.3 + 0.05 * i) for i in range(4)] + [(0.4 + 0.05 * i, 0.55) for i in range(5)]
+    eyes = []
+    for cx in [0.3, 0.7]:
+        eyes += [(cx + 0.1 * np.cos(a), 0.38 + 0.04 * np.sin(a)) for a in np.linspace(np.pi, -np.pi, 7)[:6]]
+    mouth = [(0.5 + 0.2 * np.cos(a), 0.75 + 0.08 * np.sin(a)) for a in np.linspace(np.pi, -np.pi, 13)[:12]] \
+        + [(0.5 + 0.12 * np.cos(a), 0.75 + 0.03 * np.sin(a)) for a in np.linspace(np.pi, -np.pi, 9)[:8]]
+    landmarks = np.array(jaw + brows + nose + eyes + mouth, dtype=np.float32)
+    assert landmarks.shape == (68, 2)
+    return landmarks
+
+
+LANDMARK_TEMPLATE = _landmark_template()
+
+
+def draw_frame(width, height, num_faces, fid, rng):
+    """
+    A frame of the synthetic clip: a noisy gradient background with skin colored faces (with eyes and a mouth)
+    at face_boxes. The noise changes every frame, so the video does not compress into nothing.
+    """
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    frame = np.stack([40 + 80 * x / width, 60 + 60 * y / height, 90 + 40 * np.sin(0.1 * fid) * np.ones_like(x)], axis=-1)
+    frame += rng.normal(0, 8, size=frame.shape)
+    for left, top, right, bottom in face_boxes(width, height, num_faces):
+        cx, cy, r = (left + right) / 2, (top + bottom) / 2, (right - left) / 2
+        face = ((x - cx) / (0.8 * r)) ** 2 + ((y - cy) / r) ** 2 <= 1
+        frame[face] = [205, 160, 130]
+        for landmark in LANDMARK_TEMPLATE[36:68]:
+            lx, ly = left + landmark[0] * (right - left), top + landmark[1] * (bottom - top)
+            frame[(x - lx) ** 2 + (y - ly) ** 2 <= (0.02 * r) ** 2] = [60, 30, 30]
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def write_synthetic_clip(path, width, height, num_frames, num_faces, fps=25, seed=0, ffmpeg="ffmpeg"):
+    """
+    Encodes the synthetic clip (H.264, yuv420p, a keyframe every second) through an ffmpeg pipe.
+    """
+    rng = np.random.default_rng(seed)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    cmd = [ffmpeg, "-v", "error", "-y", "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", "%dx%d" % (width, height),
+           "-r", str(fps), "-i", "-", "-c:v", "libx264", "-preset", "veryfast", "-crf", "18", "-g", str(fps),
+           "-pix_fmt", "yuv420p", str(path)]
+    process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        for fid in range(num_frames):
+            process.stdin.write(draw_frame(width, height, num_faces, fid, rng).tobytes())
+    finally:
+        process.stdin.close()
+        if process.wait() != 0:
+            raise RuntimeError("ffmpeg failed to write the synthetic clip '%s'" % path)
+    return Path(path)
+
+
+class SyntheticFaceDetector(FaceDetector):
+    """
+    Returns the faces of the synthetic clip (face_boxes, with the template landmarks) for any frame of its size,
+    in the format of FAN.run. The landmarks of the tracked crops are the template in the middle of the crop.
+    """
+
+    def __init__(self, num_faces):
+        self.num_faces = num_faces
+
+    def run(self, image, with_landmarks=False, detected_faces=None):
+        height, width = image.shape[:2]
+        boxes = []
+        landmarks = []
+        for left, top, right, bottom in face_boxes(width, height, self.num_faces):
+            kpt = np.stack([left + LANDMARK_TEMPLATE[:, 0] * (right - left),
+                            top + LANDMARK_TEMPLATE[:, 1] * (bottom - top)], axis=1)
+            # the box of the landmarks, like FAN returns it
+            boxes += [[np.min(kpt[:, 0]), np.min(kpt[:, 1]), np.max(kpt[:, 0]), np.max(kpt[:, 1])]]
+            landmarks += [kpt]
+        if with_landmarks:
+            return boxes, 'kpt68', landmarks
+        return boxes, 'kpt68'
+
+    def landmarks_from_batch_no_face_detection(self, images):
+        # the tracking crops span twice the landmark box, so the face is the middle half of the crop
+        pts = np.tile(0.25 + 0.5 * LANDMARK_TEMPLATE[None], (images.shape[0], 1, 1))
+        scores = np.ones((images.shape[0], LANDMARK_TEMPLATE.shape[0]), dtype=np.float32)
+        return pts, scores
+
+    def optimal_landmark_detector_im_size(self):
+        return 256
+
+    def landmark_type(self):
+        return 'kpt68'
+
+
+def _random_resnet50():
+    from gdl.models.ResNet import ResNet, Bottleneck
+    return ResNet(Bottleneck, [3, 4, 6, 3])
+
+
+def build_stub_model(path_to_models, model_name, mode="detail", seed=0):
+    """
+    The model of path_to_models/model_name with random weights: the config is taken from its cfg.yaml, the checkpoint
+    is not loaded, the encoders do not start from the ImageNet weights and the losses (which would need their own
+    pretrained networks) are off. The compute is the same as with the trained weights.
+    """
+    from gdl.models.DECA import DecaModule
+    from gdl_apps.EMOCA.utils.load import replace_asset_dirs
+
+    conf = OmegaConf.load(Path(path_to_models) / model_name / "cfg.yaml")
+    conf = replace_asset_dirs(conf, Path(path_to_models) / model_name)
+    cfg = conf[mode]
+    with open_dict(cfg.model):
+        cfg.model.resume_training = False
+        cfg.model.mrfwr = 0
+        cfg.model.idw = 0
+        cfg.model.vggw = 0
+        cfg.model.emonet_model_path = ""
+        cfg.model.pop("au_loss", None)
+        cfg.model.pop("lipread_loss", None)
+    torch.manual_seed(seed)
+    with mock.patch("gdl.models.ResNet.load_ResNet50Model", _random_resnet50):
+        emoca = DecaModule(cfg.model, cfg.learning, cfg.inout, "testing")
+    emoca.eval()
+    return emoca
@@ -0,0 +1,76 @@
+"""
+Compiles the FLAME model, texture space, topology and UV masks of a model into the asset bundle
+(see gdl.utils.AssetBundle), so that the first load of the model does not have to parse them either.
+The bundle is filled on the first load anyway, this is for read-only deployments and containers.
+
+    python gdl_apps/EMOCA/utils/compile_assets.py --path_to_models assets/EMOCA/models --model_name EMOCA_v2_lr_mse_20
+"""
+import argparse
+import copy
+import shutil
+from pathlib import Path
+
+from omegaconf import OmegaConf, open_dict
+
+from gdl.models.DECA import DECA
+from gdl.models.DecaFLAME import FLAME, FLAME_mediapipe, FLAMETex
+from gdl.models.Renderer import SRenderY
+from gdl.utils.AssetBundle import get_asset_bundle, load_assets
+from gdl_apps.EMOCA.utils.load import replace_asset_dirs
+
+
+def compile_assets(model_cfg, force=False):
+    """
+    Builds all the bundle entries of the model config. With force, the whole bundle is rebuilt.
+    """
+    bundle = get_asset_bundle(model_cfg)
+    if bundle is None:
+        print("The asset bundle is disabled by the config ('asset_bundle_dir' is empty).")
+        return None
+    if force and bundle.bundle_dir.is_dir():
+        shutil.rmtree(bundle.bundle_dir)
+
+    # the constructors fill the bundle
+    # (EMICA models with MICA shape dimensions get their FLAME entry on the first load)
+    flame_cfg = copy.deepcopy(model_cfg)
+    if 'flame_mediapipe_lmk_embedding_path' not in flame_cfg.keys():
+        FLAME(flame_cfg, asset_bundle=bundle)
+    else:
+        FLAME_mediapipe(flame_cfg, asset_bundle=bundle)
+    if 'use_texture' not in model_cfg.keys() or model_cfg.use_texture:
+        FLAMETex(model_cfg, asset_bundle=bundle)
+    SRenderY(model_cfg.image_size, obj_filename=model_cfg.topology_path, uv_size=model_cfg.uv_size, asset_bundle=bundle)
+
+    uv_sources = [model_cfg.face_mask_path, model_cfg.face_eye_mask_path]
+    if Path(model_cfg.fixed_displacement_path).is_file():
+        uv_sources += [model_cfg.fixed_displacement_path]
+    load_assets(bundle, "uv_masks", {"uv_size": model_cfg.uv_size}, uv_sources,
+                lambda: DECA._build_uv_mask_assets(model_cfg))
+    return bundle
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path_to_models', type=str, default=str(Path(__file__).parents[3] / "assets/EMOCA/models"))
+    parser.add_argument('--model_name', type=str, default='EMOCA_v2_lr_mse_20', help='Name of the model to compile the assets of.')
+    parser.add_argument('--stage', type=str, default='detail', help='Stage of the model config (coarse or detail).')
+    parser.add_argument('--bundle_dir', type=str, default=None,
+        help="Where to put the bundle, by default assets/compiled (or the 'asset_bundle_dir' of the model config).")
+    parser.add_argument('--force', action='store_true', help="If set, the bundle is deleted and rebuilt from scratch.")
+    args = parser.parse_args()
+
+    with open(Path(args.path_to_models) / args.model_name / "cfg.yaml", "r") as f:
+        conf = OmegaConf.load(f)
+    conf = replace_asset_dirs(conf, Path(args.path_to_models) / args.model_name)
+    model_cfg = conf[args.stage].model
+    if args.bundle_dir is not None:
+        with open_dict(model_cfg):
+            model_cfg.asset_bundle_dir = args.bundle_dir
+
+    bundle = compile_assets(model_cfg, force=args.force)
+    if bundle is not None:
+        print(f"Assets of '{args.model_name}' compiled into '{bundle.bundle_dir}'")
+
+
+if __name__ == '__main__':
+    main()
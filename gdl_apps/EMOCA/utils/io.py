@@ -2,7 +2,6 @@ from gdl_apps.EMOCA.utils.load import load_model
 from gdl.utils.FaceDetector import FAN
 from gdl.datasets.FaceVideoDataModule import TestFaceVideoDM
 import gdl
-import matplotlib.pyplot as plt
 import gdl.utils.DecaUtils as util
 import numpy as np
 import os
@@ -10,6 +9,7 @@ import torch
 from skimage.io import imsave
 from pathlib import Path
 from gdl.utils.lightning_logging import _fix_image
+from gdl.utils.Instrumentation import span
 
 
 def torch_img_to_np(img):
@@ -46,45 +46,89 @@ def save_obj(emoca, filename, opdict, i=0):
                    inverse_face_order=True)
 
 
-def save_images(outfolder, name, vis_dict, i = 0, with_detection=False):
-    prefix = None
-    final_out_folder = Path(outfolder) / name
-    final_out_folder.mkdir(parents=True, exist_ok=True)
-
-    if with_detection:
-        imsave(final_out_folder / f"inputs.png",  _fix_image(torch_img_to_np(vis_dict['inputs'][i])))
-    imsave(final_out_folder / f"geometry_coarse.png",  _fix_image(torch_img_to_np(vis_dict['geometry_coarse'][i])))
-    imsave(final_out_folder / f"geometry_detail.png", _fix_image(torch_img_to_np(vis_dict['geometry_detail'][i])))
-    imsave(final_out_folder / f"out_im_coarse.png", _fix_image(torch_img_to_np(vis_dict['output_images_coarse'][i])))
-    imsave(final_out_folder / f"out_im_detail.png", _fix_image(torch_img_to_np(vis_dict['output_images_detail'][i])))
-
-
-def save_codes(output_folder, name, vals, i = None):
-    if i is None:
-        np.save(output_folder / name / f"shape.npy", vals["shapecode"].detach().cpu().numpy())
-        np.save(output_folder / name / f"exp.npy", vals["expcode"].detach().cpu().numpy())
-        np.save(output_folder / name / f"tex.npy", vals["texcode"].detach().cpu().numpy())
-        np.save(output_folder / name / f"pose.npy", vals["posecode"].detach().cpu().numpy())
-        np.save(output_folder / name / f"detail.npy", vals["detailcode"].detach().cpu().numpy())
-    else: 
-        np.save(output_folder / name / f"shape.npy", vals["shapecode"][i].detach().cpu().numpy())
-        np.save(output_folder / name / f"exp.npy", vals["expcode"][i].detach().cpu().numpy())
-        np.save(output_folder / name / f"tex.npy", vals["texcode"][i].detach().cpu().numpy())
-        np.save(output_folder / name / f"pose.npy", vals["posecode"][i].detach().cpu().numpy())
-        np.save(output_folder / name / f"detail.npy", vals["detailcode"][i].detach().cpu().numpy())
-
-
-def test(deca, img):
-    img["image"] = img["image"].cuda()
+def save_images(outfolder, name, vis_dict, i = 0, with_detection=False, writer=None):
+    if writer is not None:
+        # written in the background by the AsyncWriter (vis_dict should come from writer.to_host)
+        writer.submit(save_images, outfolder, name, vis_dict, i, with_detection)
+        return
+    with span("save_images"):
+        prefix = None
+        final_out_folder = Path(outfolder) / name
+        final_out_folder.mkdir(parents=True, exist_ok=True)
+
+        if with_detection:
+            imsave(final_out_folder / f"inputs.png",  _fix_image(torch_img_to_np(vis_dict['inputs'][i])))
+        # only what is in the vis_dict is saved (output-driven decoding only produces the requested images)
+        if 'geometry_coarse' in vis_dict.keys():
+            imsave(final_out_folder / f"geometry_coarse.png",  _fix_image(torch_img_to_np(vis_dict['geometry_coarse'][i])))
+        if 'geometry_detail' in vis_dict.keys():
+            imsave(final_out_folder / f"geometry_detail.png", _fix_image(torch_img_to_np(vis_dict['geometry_detail'][i])))
+        if 'output_images_coarse' in vis_dict.keys():
+            imsave(final_out_folder / f"out_im_coarse.png", _fix_image(torch_img_to_np(vis_dict['output_images_coarse'][i])))
+        if 'output_images_detail' in vis_dict.keys():
+            imsave(final_out_folder / f"out_im_detail.png", _fix_image(torch_img_to_np(vis_dict['output_images_detail'][i])))
+
+
+def save_codes(output_folder, name, vals, i = None, writer=None):
+    if writer is not None:
+        # written in the background by the AsyncWriter (vals should come from writer.to_host)
+        writer.submit(save_codes, output_folder, name, vals, i)
+        return
+    with span("save_codes"):
+        if i is None:
+            np.save(output_folder / name / f"shape.npy", vals["shapecode"].detach().cpu().numpy())
+            np.save(output_folder / name / f"exp.npy", vals["expcode"].detach().cpu().numpy())
+            np.save(output_folder / name / f"tex.npy", vals["texcode"].detach().cpu().numpy())
+            np.save(output_folder / name / f"pose.npy", vals["posecode"].detach().cpu().numpy())
+            np.save(output_folder / name / f"detail.npy", vals["detailcode"].detach().cpu().numpy())
+        else: 
+            np.save(output_folder / name / f"shape.npy", vals["shapecode"][i].detach().cpu().numpy())
+            np.save(output_folder / name / f"exp.npy", vals["expcode"][i].detach().cpu().numpy())
+            np.save(output_folder / name / f"tex.npy", vals["texcode"][i].detach().cpu().numpy())
+            np.save(output_folder / name / f"pose.npy", vals["posecode"][i].detach().cpu().numpy())
+            np.save(output_folder / name / f"detail.npy", vals["detailcode"][i].detach().cpu().numpy())
+
+
+
+# the codes needed to decode the faces again (see gdl.utils.CodeStore)
+CODE_NAMES = ["shapecode", "texcode", "expcode", "posecode", "cam", "lightcode", "detailcode", "detailemocode"]
+
+
+def append_codes(store, vals, frame_ids, face_ids, writer=None, extra=None):
+    """
+    Appends the codes of a whole batch to a CodeStore, one row per face. 
+    The counterpart of save_codes without a file per face and code.
+    extra are additional per-face columns, i.e. the crop centers and sizes needed to decode the faces into the frames again.
+    """
+    codes = {key: vals[key] for key in CODE_NAMES if key in vals.keys() and isinstance(vals[key], torch.Tensor)}
+    if extra is not None:
+        codes.update(extra)
+    if writer is not None:
+        # the store is thread safe, the rows carry their ids so the order of the writes does not matter
+        writer.submit(store.append, frame_ids, face_ids, writer.to_host(codes))
+        return
+    store.append(frame_ids, face_ids, codes)
+
+
+def test(deca, img, outputs=None):
+    img["image"] = img["image"].to(deca.device)
     if len(img["image"].shape) == 3:
         img["image"] = img["image"].view(1,3,224,224)
     vals = deca.encode(img, training=False)
-    vals, visdict = decode(deca, vals, training=False)
+    vals, visdict = decode(deca, vals, training=False, outputs=outputs)
     return vals, visdict
 
 
-def decode(emoca, values, training=False):
+def decode(emoca, values, training=False, outputs=None):
+    """
+    If outputs is specified (i.e. {"geometry_detail"}), only the requested outputs are computed and put into the 
+    visualization dict (see DecaModule.decode_outputs). 
+    """
     with torch.no_grad():
+        if outputs is not None:
+            values = emoca.decode(values, training=training, outputs=outputs)
+            visualizations = {key: values[key] for key in outputs}
+            return values, visualizations
         values = emoca.decode(values, training=training)
         # losses = deca.compute_loss(values, training=False)
         # batch_size = values["expcode"].shape[0]
@@ -5,7 +5,6 @@ from omegaconf import OmegaConf
 
 from gdl.models.DECA import DecaModule
 from gdl.models.IO import locate_checkpoint
-from gdl_apps.EMOCA.training.test_and_finetune_deca import prepare_data
 from gdl.utils.other import get_path_to_assets
 
 
@@ -126,6 +125,8 @@ def load_deca_and_data(path_to_models=None,
     print("EMOCA loaded")
     if not load_data:
         return deca
+    # the training data modules are only needed here, not for loading the model
+    from gdl_apps.EMOCA.training.test_and_finetune_deca import prepare_data
     dm, name = prepare_data(cfg)
     dm.setup()
     return deca, dm
@@ -1,26 +1,32 @@
 import tkinter as tk
 from tkinter import filedialog
-import os
-import subprocess
+import argparse
 import time
 from datetime import timedelta
 
+from batchVideoFacesToUVNDC import reconstruct_videos
+from videoFacesToUVNDC import add_reconstruction_args
+
 root = tk.Tk()
 root.withdraw()
 
-process_path = "videoFacesToUVNDC.py"
-
 video_paths = filedialog.askopenfilenames(title="Select video files", filetypes=[("Video files", "*.mov")])
 output_path = filedialog.askdirectory(title="Select output folder")
 
 
 start_time = time.time() # Start time
 
-for video_path in video_paths:
-    filename = os.path.splitext(os.path.basename(video_path))[0]
-    cmd = ["python", process_path, "--input_video", video_path, "--tmp_output_folder", output_path]
-    print("command line is : ", f"python {process_path} --input_video {video_path} --tmp_output_folder {output_path}")
-    subprocess.run(cmd)
+# all the videos are processed in this process, the detector and EMOCA are only loaded once
+parser = argparse.ArgumentParser()
+add_reconstruction_args(parser)
+args = parser.parse_args([])
+args.input_videos = list(video_paths)
+args.tmp_output_folder = output_path
+args.tmp_folder = "emoca_temp"
+args.prefetch_videos = 1
+# the videos picked in the dialog are always processed again, like before (there is no --restart in the GUI)
+args.restart = True
+reconstruct_videos(args)
 
 end_time = time.time() # End time
 elapsed_time = end_time - start_time # Calculate the elapsed time
@@ -0,0 +1,139 @@
+from gdl_apps.EMOCA.utils.load import load_model
+from gdl_apps.EMOCA.utils.io import decode
+from gdl.datasets.FaceVideoDataModule import FaceVideoDataModule
+from gdl.utils.AsyncWriter import AsyncWriter
+from gdl.utils.CodeStore import CodeStore
+from gdl.utils.TemporalCodes import face_tracks
+from videoFacesToUVNDC import get_code_store_path, str2bool, add_smoothing_args, smooth_codes_from_args
+import gdl
+from pathlib import Path
+from tqdm import auto
+import argparse
+import os
+import numpy as np
+import torch
+
+import time
+from datetime import timedelta
+
+
+def set_render_resolution(emoca, image_size=None, uv_size=None):
+    """
+    Rebuilds the renderer of the model for a different rendering and/or UV resolution (the codes do not depend on them).
+    """
+    config = emoca.deca.config
+    if image_size is not None:
+        config.image_size = image_size
+    if uv_size is not None:
+        config.uv_size = uv_size
+    if image_size is not None or uv_size is not None:
+        device = emoca.device
+        emoca.deca._setup_renderer()
+        emoca.deca.to(device)
+
+
+def redecode_video(args):
+    """
+    Decodes the codes saved by videoFacesToUVNDC.py (--save_codes) and places the reconstructions into the frames
+    again, without the video, the face detection or the encoders. Only the decoding and the export run,
+    so different export settings (image type, resolutions, TIFF precision) are cheap to iterate on.
+    """
+    start_time = time.time()
+    code_store_path = args.codes if args.codes is not None else get_code_store_path(args.tmp_output_folder, args.input_video)
+    store = CodeStore(code_store_path)
+    if len(store) == 0:
+        print(f"No codes in '{code_store_path}'")
+        return None
+    attrs = store.attrs
+    frame_shape = (attrs["frame_height"], attrs["frame_width"])
+    model_name = args.model_name or attrs.get("model_name")
+    mode = args.mode or attrs.get("mode", "detail")
+    if model_name != attrs.get("model_name"):
+        print(f"[WARNING] The codes were produced by '{attrs.get('model_name')}', decoding them with '{model_name}'")
+
+    emoca, conf = load_model(args.path_to_models, model_name, mode)
+    emoca.cuda()
+    emoca.eval()
+    set_render_resolution(emoca, args.image_size, args.uv_size)
+    emoca.set_inference_precision(args.precision, args.channels_last)
+
+    baseMediaName = args.out_name or Path(attrs.get("video", Path(code_store_path).name)).stem
+    destPath = Path(os.path.join(args.tmp_output_folder, baseMediaName)).absolute()
+    destPath.mkdir(parents=True, exist_ok=True)
+    outfile = destPath / (baseMediaName + ".tif")
+
+    # sorted by frame and face, every face is written into its own file so the frames can be split between batches
+    codes = store.load()
+    frame_ids = codes.pop("frame_id").numpy()
+    face_ids = codes.pop("face_id").numpy()
+    centers = codes.pop("center").numpy()
+    sizes = codes.pop("size").numpy()
+    if args.code_smoothing != "none":
+        tracks = face_tracks(frame_ids, face_ids, centers, sizes)
+        codes = smooth_codes_from_args({key: value.numpy() for key, value in codes.items()}, tracks, frame_ids, 
+            attrs.get("fps", 25.), args)
+        codes = {key: torch.from_numpy(np.ascontiguousarray(value)) for key, value in codes.items()}
+
+    writer = AsyncWriter(num_workers=args.num_writers) if args.num_writers > 0 else None
+    try:
+        for start in auto.tqdm(range(0, len(frame_ids), args.batch_size)):
+            end = min(start + args.batch_size, len(frame_ids))
+            vals = {key: value[start:end].cuda(non_blocking=True) for key, value in codes.items()}
+            vals, visdict = decode(emoca, vals, training=False, outputs={args.image_type})
+            images = visdict[args.image_type]
+            # the frame numbers of the TIFFs are 1-based
+            for fid in np.unique(frame_ids[start:end]):
+                indices = np.nonzero(frame_ids[start:end] == fid)[0]
+                FaceVideoDataModule.write_reconstruction_frame(outfile, int(fid) + 1, 
+                    images[torch.from_numpy(indices).to(images.device)].float(),
+                    centers[start:end][indices], sizes[start:end][indices], [int(nd) for nd in face_ids[start:end][indices]],
+                    frame_shape, args.tiff_dtype, args.tiff_compression, writer)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    print("Exported TIF image sequence(s) to " + str(destPath))
+    print(f"Elapsed time: {str(timedelta(seconds=time.time() - start_time)).split('.')[0]}")
+    return destPath
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--codes', type=str, default=None,
+        help="Code store written by videoFacesToUVNDC.py --save_codes. By default <tmp_output_folder>/<input_video name>_codes.")
+    parser.add_argument('--input_video', type=str, default=None, help="Video the codes were computed for (only used to find them).")
+    parser.add_argument('--tmp_output_folder', type=str, default="emocaOutput", help="Output folder to save the result to.")
+    parser.add_argument('--out_name', type=str, default=None, help="Name of the exported sequence, by default the name of the video.")
+    parser.add_argument('--model_name', type=str, default=None, help='Name of the model, by default the one that produced the codes.')
+    parser.add_argument('--path_to_models', type=str, default=str(Path(gdl.__file__).parents[1] / "assets/EMOCA/models"))
+    parser.add_argument('--mode', type=str, default=None, choices=["detail", "coarse"],
+        help="Which model to use for the decoding, by default the one that produced the codes.")
+    parser.add_argument('--image_type', type=str, default="geometry_detail", choices=["geometry_detail", "geometry_coarse"],
+        help="Which reconstruction is exported.")
+    parser.add_argument('--image_size', type=int, default=None, help="Overrides the rendering resolution of the model.")
+    parser.add_argument('--uv_size', type=int, default=None, help="Overrides the UV resolution of the model.")
+    parser.add_argument('--batch_size', type=int, default=60, help="Number of faces decoded at once.")
+    parser.add_argument('--precision', type=str, default="fp32", choices=["fp32", "bf16", "fp16"], 
+        help="Autocast precision of the detail decoder (FLAME and the rendering stay in fp32).")
+    parser.add_argument('--channels_last', type=str2bool, default=False, 
+        help="If true, the detail decoder runs in the channels_last memory format.")
+    parser.add_argument('--tiff_dtype', type=str, default="uint16", choices=["uint16", "float16", "float32"],
+        help="Precision of the exported TIFFs. uint16 maps the UV NDCs with the fixed mapping round(clip(uv, 0, 1) * 65535).")
+    parser.add_argument('--tiff_compression', type=str, default="zlib",
+        help="Compression codec of the exported TIFFs (i.e. zlib, lzw, zstd or none).")
+    parser.add_argument('--num_writers', type=int, default=4,
+        help="Number of background threads writing the outputs. 0 writes them synchronously in the decoding loop.")
+    add_smoothing_args(parser)
+    args = parser.parse_args()
+    if args.codes is None and args.input_video is None:
+        parser.error("Either --codes or --input_video has to be given.")
+    return args
+
+
+def main():
+    args = parse_args()
+    redecode_video(args)
+
+
+if __name__ == '__main__':
+    main()
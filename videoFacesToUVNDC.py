@@ -4,43 +4,24 @@ import gdl
 from pathlib import Path
 from tqdm import auto
 import argparse
-from gdl_apps.EMOCA.utils.io import save_obj, save_images, save_codes, test
-import os, shutil, ntpath, glob, re
+from gdl_apps.EMOCA.utils.io import save_obj, save_images, save_codes, append_codes, test, decode, CODE_NAMES
+from gdl.utils.AsyncWriter import AsyncWriter
+from gdl.utils.CodeStore import CodeStore
+import gdl.utils.Instrumentation as instrumentation
+from gdl.utils.TemporalCodes import face_tracks, select_keyframes, interpolate_codes, smooth_codes
+import os, shutil, ntpath
 from pathlib import Path
+from multiprocessing import get_context
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
 
 import time
 from datetime import timedelta
 import winsound
 
-import tifffile
-import imagecodecs
-
 start_time = time.time() # Start time
 
-def process_batch(batch, input_folder, output_folder):
-    for file_name in batch:
-        try:
-            input_path = os.path.join(input_folder, file_name)
-            output_path = os.path.join(output_folder, file_name)
-
-            tiff_data = tifffile.imread(input_path)
-            tiff_data_normalized = (tiff_data - tiff_data.min()) / (tiff_data.max() - tiff_data.min())
-            tiff_data_16bit = (tiff_data_normalized * 65535).astype('uint16')
-
-            tifffile.imwrite(output_path, tiff_data_16bit, dtype='uint16', compression='zlib')
-
-            print(f"Converted and saved {file_name}")
-        except Exception as e:
-            print(f"Error processing {file_name}: {e}")
-
-def batch_process_files(input_folder, output_folder, batch_size):
-    input_files = [file_name for file_name in os.listdir(input_folder)
-                   if file_name.lower().endswith((".tif", ".tiff"))]
-
-    for i in range(0, len(input_files), batch_size):
-        batch = input_files[i:i + batch_size]
-        process_batch(batch, input_folder, output_folder)
-
 def str2bool(v):
     if isinstance(v, bool):
         return v
@@ -52,31 +33,127 @@ def str2bool(v):
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
-def reconstruct_video(args):
-    path_to_models = args.path_to_models
-    input_video = args.input_video
-    model_name = args.model_name
-    tmp_output_folder = "emoca_temp"
-    outputPath = args.tmp_output_folder
-
-    mode = args.mode
-   
-    ## 1) Process the video - extract the frames from video and run face detection
+@instrumentation.timed()
+def prepare_video(input_video, tmp_output_folder, args, face_detector=None, device=None, processed_subfolder=None, 
+                  start_frame=0, end_frame=None, warmup_frames=0):
+    """
+    Extracts the frames of the video and runs the face detection on them. 
+    If face_detector is given, it is used instead of instantiating a new one.
+    If a frame range is given, only the frames [start_frame, end_frame) are processed (see reconstruct_video_sharded).
+    """
     dm = TestFaceVideoDM(input_video, 
         tmp_output_folder, 
-        processed_subfolder=None, 
+        processed_subfolder=processed_subfolder, 
         batch_size=60, 
-        num_workers=0)
+        num_workers=0, 
+        device=device, 
+        unpack_videos=args.unpack_frames, 
+        save_detection_images=args.save_detection_images, 
+        face_detector_batch_size=args.detection_batch_size, 
+        face_tracking=args.face_tracking, 
+        tracking_keyframe_interval=args.tracking_keyframe_interval, 
+        start_frame=start_frame, 
+        end_frame=end_frame, 
+        warmup_frames=warmup_frames)
+    if face_detector is not None:
+        dm.face_detector = face_detector
     dm.prepare_data()
     dm.setup()
-    processed_subfolder = Path(dm.output_dir).name
+    return dm
+
+
+def get_code_store_path(outputPath, input_video):
+    return Path(outputPath) / (Path(input_video).stem + "_codes")
+
+
+def get_timing_report_path(outputPath, input_video, args, suffix=""):
+    if args.profile_output:
+        path = Path(args.profile_output)
+        return path.with_name(path.stem + suffix + path.suffix)
+    return Path(outputPath) / (Path(input_video).stem + "_timings" + suffix + ".json")
 
-    # ## 2) Load the model
-    emoca, conf = load_model(path_to_models, model_name, mode)
-    emoca.cuda()
-    emoca.eval()
 
-    if Path(tmp_output_folder).is_absolute():
+def get_video_fps(dm, sequence_id=0):
+    # ffprobe gives the frame rate as a fraction, i.e. '30000/1001'
+    num, _, den = str(dm.video_metas[sequence_id]['fps']).partition('/')
+    return float(num) / float(den or 1)
+
+
+def uses_temporal_codes(args):
+    return args.keyframe_interval > 1 or args.keyframe_motion_threshold > 0 or args.code_smoothing != "none"
+
+
+def smooth_codes_from_args(codes, tracks, frame_ids, fps, args):
+    return smooth_codes(codes, tracks, frame_ids, args.code_smoothing, fps=fps, window_length=args.smoothing_window, 
+        polyorder=args.smoothing_polyorder, min_cutoff=args.one_euro_min_cutoff, beta=args.one_euro_beta)
+
+
+@instrumentation.timed()
+def export_faces_temporal(emoca, dm, destPath, baseMediaName, args, writer=None, code_store=None):
+    """
+    Temporal counterpart of the model loop of export_video. Only the faces of the keyframes (every 
+    args.keyframe_interval frames of a face, and the frames where it moved more than args.keyframe_motion_threshold 
+    of its size) run through the encoders, the codes of the other faces are interpolated and optionally smoothed 
+    (see gdl.utils.TemporalCodes). Then all the faces are decoded in batches and placed into their frames.
+    """
+    testdata = dm.testdata
+    frame_ids, face_ids, centers, sizes = testdata.frame_ids, testdata.face_ids, testdata.centers, testdata.sizes
+    tracks = face_tracks(frame_ids, face_ids, centers, sizes)
+    landmarks = None
+    if args.keyframe_motion_threshold > 0:
+        landmarks = dm.get_detection_landmarks(0, frame_ids, face_ids)
+        if landmarks is None:
+            print("[WARNING] The landmarks of the detections are not available, the motion is measured on the face crops.")
+    keyframes = select_keyframes(tracks, frame_ids, centers, sizes, args.keyframe_interval, 
+        landmarks=landmarks, motion_threshold=args.keyframe_motion_threshold)
+    key_rows = np.nonzero(keyframes)[0]
+    print(f"Encoding {len(key_rows)} keyframe faces out of {len(frame_ids)}.")
+    if args.save_reconstructions:
+        print("[WARNING] The reconstructions of the face crops are not saved with keyframes or code smoothing.")
+
+    key_codes = {}
+    dl = DataLoader(Subset(testdata, key_rows.tolist()), batch_size=dm.batch_size, num_workers=dm.num_workers, shuffle=False)
+    with torch.no_grad():
+        for batch in auto.tqdm(dl):
+            batch["image"] = batch["image"].to(emoca.device)
+            vals = emoca.encode(batch, training=False)
+            for key in CODE_NAMES:
+                if key in vals.keys() and isinstance(vals[key], torch.Tensor):
+                    key_codes.setdefault(key, []).append(vals[key].float().cpu().numpy())
+    key_codes = {key: np.concatenate(values) for key, values in key_codes.items()}
+
+    codes = interpolate_codes(key_codes, tracks, frame_ids, keyframes)
+    if args.code_smoothing != "none":
+        codes = smooth_codes_from_args(codes, tracks, frame_ids, get_video_fps(dm), args)
+
+    print("Decoding all the faces.")
+    with torch.no_grad():
+        for start in auto.tqdm(range(0, len(frame_ids), dm.batch_size)):
+            end = min(start + dm.batch_size, len(frame_ids))
+            vals = {key: torch.from_numpy(value[start:end]).to(emoca.device) for key, value in codes.items()}
+            vals, visdict = decode(emoca, vals, training=False, outputs={"geometry_detail"})
+            if code_store is not None:
+                append_codes(code_store, vals, frame_ids[start:end], face_ids[start:end], writer=writer, 
+                    extra={"center": centers[start:end], "size": sizes[start:end]})
+            dm.create_reconstruction_frames(0, visdict["geometry_detail"], frame_ids[start:end], face_ids[start:end], 
+                centers[start:end], sizes[start:end], destPath, image_type="geometry_detail", out_name=baseMediaName, 
+                tiff_dtype=args.tiff_dtype, tiff_compression=args.tiff_compression, writer=writer)
+
+
+@instrumentation.timed()
+def export_video(emoca, dm, input_video, tmp_output_folder, outputPath, args, writer=None, results_folder=None, 
+                 code_store=None):
+    """
+    Runs the model on the detected faces of the video and writes the UV NDC TIFFs into outputPath/<video name>.
+    The optional reconstructions are saved into results_folder (if given).
+    If a code store (gdl.utils.CodeStore) is given, the codes of all the faces are appended to it.
+    """
+    model_name = args.model_name
+    processed_subfolder = Path(dm.output_dir).name
+
+    if results_folder is not None:
+        outfolder = results_folder
+    elif Path(tmp_output_folder).is_absolute():
         outfolder = tmp_output_folder
     else:
         outfolder = str(Path(tmp_output_folder) / processed_subfolder / Path(input_video).stem / "results" / model_name)
@@ -84,66 +161,181 @@ def reconstruct_video(args):
     ## 3) Get the data loader with the detected faces
     dl = dm.test_dataloader()
 
+    # The frames are written once, straight into the final destination under their final name
+    baseMediaName = str(Path(input_video).stem)
+    destPath = Path(os.path.join(outputPath, baseMediaName)).absolute()
+    destPath.mkdir(parents=True, exist_ok=True)
+
+    if uses_temporal_codes(args):
+        ## 4) Encode the keyframes, interpolate the codes in between and decode all the faces
+        export_faces_temporal(emoca, dm, destPath, baseMediaName, args, writer=writer, code_store=code_store)
+        finish_export(dm, input_video, args, writer=writer, code_store=code_store)
+        return destPath
+
     ## 4) Run the model on the data
     print("Running model on the data.")
     for j, batch in enumerate (auto.tqdm(dl)):
         current_bs = batch["image"].shape[0]
         img = batch
-        vals, visdict = test(emoca, img)
+        # only the detail geometry is exported, so nothing else gets decoded
+        vals, visdict = test(emoca, img, outputs={"geometry_detail"})
         #print("vals: " + str(vals))  # Convert vals to a string using str() function
 
-        for i in range(current_bs):
-            name =  batch["image_name"][i]
-            sample_tmp_output_folder = Path(outfolder) /name
-            sample_tmp_output_folder.mkdir(parents=True, exist_ok=True)
-            save_images(outfolder, name, visdict, i)
-
-    ## 5) Create the reconstruction video
-    outFileSpec = dm.create_reconstruction_video(0,  
-            rec_method=model_name, 
-            image_type="geometry_detail",
-            overwrite=True, 
-            cat_dim=0, 
-            include_transparent=False, 
-            include_original=False, 
-            include_rec = True,
-            black_background=True, 
-            use_mask=False, 
-            out_folder=outfolder)
-
-    # Calculate path of final output
-    baseMediaName = str(Path(input_video).stem)
-    destPath = Path(os.path.join(outputPath, baseMediaName)).absolute()
-    # Make sure destination path exists
-    try:
-        #os.makedirs(Path(destPath).parent.absolute())
-        os.makedirs(destPath)
-    except:
-        pass
-
-    # Get list of output files
-    fileList = glob.glob(outFileSpec)
-
-    # Iterate over the file list and copy each file to the destination directory, changing the base name
-    for file in fileList:
-        origFilename = str(Path(file).stem) + ".tif"
-        newFilename = re.sub(re.sub(r"_face\d\.\d\d\d\d\.tif", "", origFilename, flags=re.IGNORECASE), baseMediaName, origFilename, flags=re.IGNORECASE)
-        newFilePath = os.path.join(destPath, newFilename)
-        shutil.copy(file, newFilePath)
+        if code_store is not None:
+            # the detection index of the faces comes with the batch (see DetectionIndexedData)
+            append_codes(code_store, vals, batch["frame_id"], batch["face_id"], writer=writer, 
+                extra={"center": batch["center"], "size": batch["size"]})
+
+        if args.save_reconstructions:
+            host_visdict = writer.to_host(visdict) if writer is not None else visdict
+            for i in range(current_bs):
+                name =  batch["image_name"][i]
+                sample_tmp_output_folder = Path(outfolder) /name
+                sample_tmp_output_folder.mkdir(parents=True, exist_ok=True)
+                save_images(outfolder, name, host_visdict, i, writer=writer)
+
+        ## 5) Place the reconstructions into the original frames (on the GPU, straight from the model output)
+        dm.create_reconstruction_frames(0, visdict["geometry_detail"], batch["frame_id"], batch["face_id"], 
+            batch["center"], batch["size"], destPath, image_type="geometry_detail", out_name=baseMediaName, 
+            tiff_dtype=args.tiff_dtype, tiff_compression=args.tiff_compression, writer=writer)
+
+    finish_export(dm, input_video, args, writer=writer, code_store=code_store)
+    return destPath
+
+
+def finish_export(dm, input_video, args, writer=None, code_store=None):
+    if writer is not None:
+        # wait for the last frames to be written (and raise if any of the writes failed)
+        writer.flush()
+    if code_store is not None:
+        # everything redecodeVideoToUVNDC.py needs to place the faces into the frames without the video
+        frame_shape = dm._get_frame_shape(0, dm._get_frames_for_sequence(0))
+        code_store.attrs.update({"video": str(Path(input_video).absolute()), "frame_height": int(frame_shape[0]), 
+            "frame_width": int(frame_shape[1]), "fps": get_video_fps(dm), "model_name": args.model_name, "mode": args.mode})
+        code_store.flush()
+
+
+def _reconstruct_shard(input_video, tmp_output_folder, outputPath, results_folder, shard_idx, start_frame, end_frame, 
+                       warmup_frames, device, args):
+    """
+    Runs in a worker process of reconstruct_video_sharded, with its own detector and model on the given device.
+    """
+    device = torch.device(device)
+    if device.type == "cuda":
+        torch.cuda.set_device(device)
+    if args.profile:
+        # every shard process has its own spans and writes its own report
+        instrumentation.enable(cuda_events=args.profile_cuda)
+    dm = prepare_video(input_video, tmp_output_folder, args, device=device, processed_subfolder="shard_%03d" % shard_idx, 
+        start_frame=start_frame, end_frame=end_frame, warmup_frames=warmup_frames)
+
+    with instrumentation.span("load_model"):
+        emoca, conf = load_model(args.path_to_models, args.model_name, args.mode)
+        emoca.to(device)
+        emoca.eval()
+        emoca.set_inference_precision(args.precision, args.channels_last)
+
+    writer = AsyncWriter(num_workers=args.num_writers) if args.num_writers > 0 else None
+    # the shards cannot append to the same store, each gets its own and they are merged at the end
+    code_store = CodeStore(_get_shard_code_store_path(tmp_output_folder, shard_idx), mode='w') if args.save_codes else None
+    export_video(emoca, dm, input_video, tmp_output_folder, outputPath, args, writer=writer, results_folder=results_folder, 
+        code_store=code_store)
+    if writer is not None:
+        writer.close()
+    if code_store is not None:
+        code_store.close()
+    if args.profile:
+        instrumentation.report(get_timing_report_path(outputPath, input_video, args, suffix="_shard_%03d" % shard_idx))
+    return dm.output_dir, warmup_frames
+
+
+def _get_shard_code_store_path(tmp_output_folder, shard_idx):
+    return Path(tmp_output_folder) / "codes" / ("shard_%03d" % shard_idx)
+
+
+def reconstruct_video_sharded(args):
+    """
+    Splits the video into args.num_shards frame ranges that are detected and reconstructed in parallel processes 
+    (on the devices of args.shard_devices, round robin). The frames are exported with their frame number in the 
+    whole video, so the TIFF sequence is the same as the one of reconstruct_video. The detections of the shards are 
+    merged back into one bboxes.pkl (in emoca_temp/merged, see --keep_tmp_folder).
+    """
+    input_video = args.input_video
+    tmp_output_folder = "emoca_temp"
+    outputPath = args.tmp_output_folder
+
+    dm = TestFaceVideoDM(input_video, tmp_output_folder, processed_subfolder="merged", 
+        unpack_videos=args.unpack_frames, save_detection_images=args.save_detection_images)
+    dm._gather_data(exist_ok=True)
+    shards = dm.get_frame_shards(0, args.num_shards, overlap=args.shard_overlap if args.face_tracking else 0)
+    devices = args.shard_devices.split(",")
+    results_folder = str(Path(tmp_output_folder) / "results" / args.model_name)
+    print(f"Processing {len(shards)} shards of '{input_video}' on {', '.join(devices)}")
+
+    shard_args = [(input_video, tmp_output_folder, outputPath, results_folder, si, start, end, warmup, devices[si % len(devices)], args) 
+        for si, (start, end, warmup) in enumerate(shards)]
+    # spawn, CUDA cannot be used in forked processes
+    with get_context("spawn").Pool(len(shards)) as pool:
+        shard_results = pool.starmap(_reconstruct_shard, shard_args)
+    dm._merge_frame_shards(0, shard_results)
+    if args.save_codes:
+        CodeStore.merge([_get_shard_code_store_path(tmp_output_folder, si) for si in range(len(shards))], 
+            get_code_store_path(outputPath, input_video))
+
+    print("Exported TIF image sequence(s) to " + str(Path(os.path.join(outputPath, Path(input_video).stem)).absolute()))
+    if not args.keep_tmp_folder:
+        shutil.rmtree(Path(tmp_output_folder).absolute())
+    print("Done")
+
+
+def reconstruct_video(args):
+    if args.num_shards > 1:
+        reconstruct_video_sharded(args)
+        return
+    path_to_models = args.path_to_models
+    input_video = args.input_video
+    model_name = args.model_name
+    tmp_output_folder = "emoca_temp"
+    outputPath = args.tmp_output_folder
+
+    mode = args.mode
+    if args.profile:
+        instrumentation.enable(cuda_events=args.profile_cuda)
+   
+    ## 1) Process the video - extract the frames from video and run face detection
+    dm = prepare_video(input_video, tmp_output_folder, args)
+
+    # ## 2) Load the model
+    with instrumentation.span("load_model"):
+        emoca, conf = load_model(path_to_models, model_name, mode)
+        emoca.cuda()
+        emoca.eval()
+        emoca.set_inference_precision(args.precision, args.channels_last)
+
+    # the outputs are written in the background while the GPU works on the next batch
+    writer = AsyncWriter(num_workers=args.num_writers) if args.num_writers > 0 else None
+    code_store = CodeStore(get_code_store_path(outputPath, input_video), mode='w') if args.save_codes else None
+    destPath = export_video(emoca, dm, input_video, tmp_output_folder, outputPath, args, writer=writer, code_store=code_store)
+    if writer is not None:
+        writer.close()
+    if code_store is not None:
+        code_store.close()
+        print("Saved the codes to " + str(code_store.path))
 
     print("Exported TIF image sequence(s) to " + str(destPath))
 
     # Kill off temporary export folder
-    deleteFolder = Path(tmp_output_folder).absolute()
-    print("Killing off " + str(deleteFolder) + "...")
-    shutil.rmtree(deleteFolder)
+    if not args.keep_tmp_folder:
+        deleteFolder = Path(tmp_output_folder).absolute()
+        print("Killing off " + str(deleteFolder) + "...")
+        shutil.rmtree(deleteFolder)
     print("Done")
 
-    #Eric Added to Convert 32-bit to 16-bit
-    input_folder = destPath
-    output_folder = input_folder
-    batch_size = 50
-    batch_process_files(input_folder, output_folder, batch_size)
+    if args.profile:
+        print()
+        report_path = get_timing_report_path(outputPath, input_video, args)
+        instrumentation.report(report_path)
+        print("Saved the timings to " + str(report_path))
 
     end_time = time.time() # End time
     elapsed_time = end_time - start_time # Calculate the elapsed time
@@ -152,15 +344,76 @@ def reconstruct_video(args):
     print(f"Elapsed time: {formatted_time}") # Print the elapsed time
     #winsound.Beep(1000, 500)
 
+def add_reconstruction_args(parser):
+    """
+    Adds the options shared by the single video and the batch entry points.
+    """
+    parser.add_argument('--model_name', type=str, default='EMOCA_v2_lr_mse_20', help='Name of the model to use. Currently EMOCA or DECA are available.')
+    parser.add_argument('--path_to_models', type=str, default=str(Path(gdl.__file__).parents[1] / "assets/EMOCA/models"))
+    parser.add_argument('--mode', type=str, default="detail", choices=["detail", "coarse"], help="Which model to use for the reconstruction.")
+    parser.add_argument('--unpack_frames', type=str2bool, default=False, 
+        help="If true, the video frames are written to disk as PNGs. Otherwise they are streamed from the video.")
+    parser.add_argument('--save_detection_images', type=str2bool, default=False, 
+        help="If true, the face crops are written to disk as PNGs. Otherwise they are kept in memory.")
+    parser.add_argument('--detection_batch_size', type=int, default=16, 
+        help="Number of frames passed through the face detector at once. Use 1 for the old frame by frame detection.")
+    parser.add_argument('--tiff_dtype', type=str, default="uint16", choices=["uint16", "float16", "float32"], 
+        help="Precision of the exported TIFFs. uint16 maps the UV NDCs with the fixed mapping round(clip(uv, 0, 1) * 65535).")
+    parser.add_argument('--tiff_compression', type=str, default="zlib", 
+        help="Compression codec of the exported TIFFs (i.e. zlib, lzw, zstd or none).")
+    parser.add_argument('--num_writers', type=int, default=4, 
+        help="Number of background threads writing the outputs. 0 writes them synchronously in the inference loop.")
+    parser.add_argument('--save_reconstructions', type=str2bool, default=False, 
+        help="If true, the reconstruction of each face crop is also saved to disk (it is not needed for the export).")
+    parser.add_argument('--save_codes', type=str2bool, default=False, 
+        help="If true, the FLAME, camera, light and detail codes of all the faces are saved into <output folder>/<video name>_codes.")
+    parser.add_argument('--face_tracking', type=str2bool, default=False, 
+        help="If true, the face detector only runs on keyframes and the faces are tracked from the previous landmarks in between.")
+    parser.add_argument('--tracking_keyframe_interval', type=int, default=10, 
+        help="Number of frames between two runs of the full face detector when tracking.")
+    parser.add_argument('--precision', type=str, default="fp32", choices=["fp32", "bf16", "fp16"], 
+        help="Autocast precision of the encoders and the detail decoder (FLAME and the rendering stay in fp32). fp16 needs a GPU.")
+    parser.add_argument('--channels_last', type=str2bool, default=False, 
+        help="If true, the encoders and the detail decoder run in the channels_last memory format.")
+    parser.add_argument('--keyframe_interval', type=int, default=1, 
+        help="Number of frames between two encoded frames of a face, the codes in between are interpolated. 1 encodes every frame.")
+    parser.add_argument('--keyframe_motion_threshold', type=float, default=0., 
+        help="A frame is also encoded if the landmarks of the face moved more than this fraction of its size since the "
+             "last encoded one (i.e. 0.05). 0 disables it.")
+    add_smoothing_args(parser)
+    parser.add_argument('--profile', type=str2bool, default=False, 
+        help="If true, the hot paths are timed and a summary (count, total and percentiles per span) is printed at the end.")
+    parser.add_argument('--profile_cuda', type=str2bool, default=False, 
+        help="If true, the spans also record CUDA events and the summary includes their GPU time.")
+    parser.add_argument('--profile_output', type=str, default="", 
+        help="JSON file of the timing summary. Defaults to <output folder>/<video name>_timings.json.")
+    parser.add_argument('--keep_tmp_folder', type=str2bool, default=False, help="If true, the intermediate files are not deleted.")
+    return parser
+
+
+def add_smoothing_args(parser):
+    parser.add_argument('--code_smoothing', type=str, default="none", choices=["none", "savgol", "one_euro"], 
+        help="Temporal smoothing of the shape, expression, pose, camera and detail codes of every face.")
+    parser.add_argument('--smoothing_window', type=int, default=9, help="Window (in frames) of the Savitzky-Golay smoothing.")
+    parser.add_argument('--smoothing_polyorder', type=int, default=2, help="Polynomial order of the Savitzky-Golay smoothing.")
+    parser.add_argument('--one_euro_min_cutoff', type=float, default=1.0, 
+        help="Cutoff frequency (Hz) of the One Euro smoothing of slow motion, lower smooths more.")
+    parser.add_argument('--one_euro_beta', type=float, default=0.0, 
+        help="How fast the cutoff of the One Euro smoothing grows with the speed, higher lags less on fast motion.")
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_video', type=str, default=str(Path(gdl.__file__).parents[1] / "/assets/data/EMOCA_test_example_data/videos/82-25-854x480_affwild2.mp4"), 
         help="Filename of the video for reconstruction.")
     parser.add_argument('--tmp_output_folder', type=str, default="emocaOutput", help="Output folder to save the result to.")
-    parser.add_argument('--model_name', type=str, default='EMOCA_v2_lr_mse_20', help='Name of the model to use. Currently EMOCA or DECA are available.')
-    parser.add_argument('--path_to_models', type=str, default=str(Path(gdl.__file__).parents[1] / "assets/EMOCA/models"))
-    parser.add_argument('--mode', type=str, default="detail", choices=["detail", "coarse"], help="Which model to use for the reconstruction.")
-
+    parser.add_argument('--num_shards', type=int, default=1, 
+        help="Number of frame ranges of the video processed in parallel processes, each with its own detector and model.")
+    parser.add_argument('--shard_devices', type=str, default="cuda:0", 
+        help="Comma separated devices the shards run on (round robin), i.e. 'cuda:0,cuda:1' or 'cpu'.")
+    parser.add_argument('--shard_overlap', type=int, default=10, 
+        help="Number of frames before its range each shard detects (but does not reconstruct) to warm up the face tracker.")
+    add_reconstruction_args(parser)
     args = parser.parse_args()
     return args
 